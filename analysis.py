@@ -99,6 +99,8 @@ class WalkData:
                 all_sample_id.append(np.full(length, i))
         
         self.positions = np.vstack(all_pos)
+        #number of coordinates of the positions, 3 for walks in three dimensions
+        self.dimension = self.positions.shape[1]
         self.iters = np.concatenate(all_iters)
         self.angles = np.concatenate(all_angles)
         self.branch_id = np.concatenate(all_branch_id)
@@ -126,6 +128,7 @@ class Analysis:
         self.iters = walkdata.iters
         self.angles = walkdata.angles
         self.positions = walkdata.positions
+        self.dimension = self.positions.shape[1]
         self.branch_id = walkdata.branch_id
         self.parent_id = walkdata.parent_id
         self.sample_id = walkdata.sample_id
@@ -163,21 +166,20 @@ class Analysis:
         positions = self.positions[mask]
         
         unique_branches = np.unique(branch_ids)
+        #walks in three dimensions are drawn on 3D axes
+        ax = plt.gca() if self.dimension == 2 else plt.figure().add_subplot(projection = "3d")
         
         for b in unique_branches:
             pts = positions[branch_ids == b]
-            x, y = pts[:,0], pts[:,1] 
-            plt.plot(x, y, color = col, linewidth = lw)
+            ax.plot(*pts.T, color = col, linewidth = lw)
         
         
         if iteration[0] == 0:
             somas = self.positions[(self.iters == 0) & m_sample]
             for soma in somas:
-                x, y = soma[0], soma[1]
-                plt.plot(x, y, color = 'red', marker = 'o', markersize = 2.5)
+                ax.plot(*soma[:, None], color = 'red', marker = 'o', markersize = 2.5)
             
-        plt.gca().set_aspect('equal')
-        ax = plt.gca()
+        ax.set_aspect('equal')
         ax.set_facecolor("white")
         
         if name:
@@ -197,8 +199,8 @@ class Analysis:
         m_iter = self.iters == iteration
         
         current_pts = self.positions[m_sample & m_iter]
-        x, y = current_pts[:,0], current_pts[:,1]
-        plt.scatter(x, y, color = col)
+        ax = plt.gca() if self.dimension == 2 else plt.figure().add_subplot(projection = "3d")
+        ax.scatter(*current_pts.T, color = col)
         
         if name:
             plt.savefig("plots/" + name + ".png", dpi=300, bbox_inches='tight')
@@ -211,7 +213,8 @@ class Analysis:
                   name = None,
                   show = True,
                   x_log = False,
-                  y_log = False):
+                  y_log = False,
+                  exact = None):
         
         if sample is None:
             sample = np.unique(self.sample_id)
@@ -230,6 +233,9 @@ class Analysis:
             list_of_averages.append(np.mean(distance_squared[iters == t]))
         
         plt.plot(list_of_averages)
+        #exact MSD curve to compare against, eg from RandomWalk.exact_msd
+        if exact is not None:
+            plt.plot(exact, linestyle = "--", color = "black")
         plt.xlabel("Number of steps")
         plt.ylabel("Mean Squared Distance")
         if x_log:
@@ -334,6 +340,7 @@ class Analysis:
             plt.show()
        
         
+    #walks in three dimensions are animated on 3D axes, like graph_walk
     def animate_walk(self, 
                      sample = 0, 
                      name = "Animation", 
@@ -353,27 +360,39 @@ class Analysis:
         positions = self.positions[m_sample]
         x_min, x_max = positions[:,0].min(), positions[:,0].max()
         y_min, y_max = positions[:,1].min(), positions[:,1].max()
+        planar = self.dimension == 2
 
-        fig, ax = plt.subplots(figsize=(6,6))
+        if planar:
+            fig, ax = plt.subplots(figsize=(6,6))
+        else:
+            fig = plt.figure(figsize=(6,6))
+            ax = fig.add_subplot(projection = "3d")
         fig.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=None, hspace=None)
         ax.set_aspect('equal')
         ax.set_facecolor(bg)
         
-        plt.gca().axes.get_xaxis().set_visible(False)
-        plt.gca().axes.get_yaxis().set_visible(False)
+        if planar:
+            plt.gca().axes.get_xaxis().set_visible(False)
+            plt.gca().axes.get_yaxis().set_visible(False)
+        else:
+            ax.set_axis_off()
         """
         ax.set_xlim(x_min - buffer * abs(x_min), x_max + buffer * abs(x_max))
         ax.set_ylim(y_min - buffer * abs(y_min), y_max + buffer * abs(y_max))
         """
-        ax.set_xlim(min(x_min, y_min), max(x_max, y_max))
-        ax.set_ylim(min(x_min, y_min), max(x_max, y_max))
+        #every axis gets the same limits, over all coordinates, so the walk isn't stretched
+        low, high = positions.min(), positions.max()
+        ax.set_xlim(low, high)
+        ax.set_ylim(low, high)
+        if not planar:
+            ax.set_zlim(low, high)
         branches = np.unique(self.branch_id[self.sample_id == sample])
         lines = []
 
         for b in branches:
             line, = ax.plot([], [], color = col, linewidth = lw)
             lines.append(line)
-        active_walkers_scatter = ax.scatter([], [], color = m_col, marker='o', s = m_size)
+        active_walkers_scatter = ax.scatter(*[[]] * self.dimension, color = m_col, marker='o', s = m_size)
         
 
         def update(frame):
@@ -387,17 +406,23 @@ class Analysis:
                         line.set_data(pts[:,0], pts[:,1])
                     else:
                         line.set_data([], [])
+                    if not planar:
+                        line.set_3d_properties(pts[:,2] if len(pts) > 0 else [])
                 
                 if show_dot:
                     active_walkers = self.positions[(self.sample_id == sample) & (self.iters == frame)]
-                    active_walkers_scatter.set_offsets(active_walkers)
+                    if planar:
+                        active_walkers_scatter.set_offsets(active_walkers[:, :2])
+                    else:
+                        active_walkers_scatter._offsets3d = tuple(active_walkers.T)
             
             return lines + [active_walkers_scatter]
 
         ani = FuncAnimation(fig, 
                             update, 
                             frames = range(0, self.iters[self.sample_id == sample].max() + 30), 
-                            blit=True
+                            #3D axes redraw their projection every frame, which blitting skips
+                            blit = planar
                             )
   
         ani.save("animations/" + name, fps = 30, dpi = 300)
\ No newline at end of file
@@ -0,0 +1,153 @@
+"""
+Guidance from diffusing chemoattractants
+
+Rather than writing guidance fields by hand, guidance can come from the
+concentration c of an attractant released by sources (eg target somas, or lines
+of attractant along a tissue boundary) which diffuses with coefficient D and
+decays at rate 1 / tau. Its steady state solves
+
+    lap c - c / decay_length^2 = -s / D,    decay_length = sqrt(D tau)
+
+whose solution is the convolution of the source density s with the Green's
+function K0(r / decay_length) / (2pi D). D is taken as 1, since only the
+direction and relative size of the gradient guide the walkers. In Fourier space
+the convolution is a division by |k|^2 + 1 / decay_length^2, so the field of any
+number of sources costs one FFT and its inverse. The sources are spread onto a
+grid by linear (cloud in cell) weights, and grids over non periodic extents are
+padded by 4 decay lengths each side, so the periodic images of the FFT are too far
+away to matter. Sources further outside the extent than that are ignored.
+
+chemoattractant(...) gives the guidance as rasterised fields (see raster.py),
+which plug into the simulations as guidance_angle and guidance_strength. Walkers
+are guided up the gradient, with strength gain * decay_length |grad c| / (c +
+threshold). Without a threshold this is sensing the gradient of log c, which is
+about gain anywhere the field of one source dominates, and threshold damps the
+guidance where the attractant is too dilute to sense
+"""
+import math as maths
+import numpy as np
+
+import raster
+
+"""
+1: Spreading sources onto a grid
+"""
+#points and weights of sources given as (x, y) or (x, y, weight)
+def point_sources(sources):
+    if sources is None or len(sources) == 0:
+        return np.zeros((0, 2)), np.zeros(0)
+    points = []
+    weights = []
+    for source in sources:
+        if len(source) not in [2, 3]:
+            raise ValueError(f"A source is (x, y) or (x, y, weight), not {source}")
+        points.append(source[:2])
+        weights.append(source[2] if len(source) == 3 else 1)
+    return np.array(points, dtype = float), np.array(weights, dtype = float)
+
+#lines of attractant ((x0, y0), (x1, y1)) or ((x0, y0), (x1, y1), weight per unit
+#length), as points at the middles of pieces at most spacing long
+def line_sources(lines, spacing):
+    if lines is None or len(lines) == 0:
+        return np.zeros((0, 2)), np.zeros(0)
+    points = []
+    weights = []
+    for line in lines:
+        if len(line) not in [2, 3]:
+            raise ValueError(f"A line source is ((x0, y0), (x1, y1)) or with a weight per unit length, not {line}")
+        start, end = np.array(line[0], dtype = float), np.array(line[1], dtype = float)
+        length = float(np.linalg.norm(end - start))
+        num_pieces = max(maths.ceil(length / spacing), 1)
+        fractions = (np.arange(num_pieces) + 0.5) / num_pieces
+        points.append(start + fractions[:, None] * (end - start))
+        weights.append(np.full(num_pieces, (line[2] if len(line) == 3 else 1) * length / num_pieces))
+    return np.concatenate(points), np.concatenate(weights)
+
+#density of the weighted points on the grid with nodes lower + (i, j) * spacing,
+#each point shared linearly between its four nearest nodes. Points off a non
+#periodic grid are dropped
+def deposit(points, weights, lower, spacing, shape, periodic = False):
+    density = np.zeros(shape)
+    u = (points - lower) / spacing
+    cell = np.floor(u).astype(int)
+    fraction = u - cell
+    for di in [0, 1]:
+        for dj in [0, 1]:
+            share = weights * np.abs(1 - di - fraction[:, 0]) * np.abs(1 - dj - fraction[:, 1])
+            i, j = cell[:, 0] + di, cell[:, 1] + dj
+            if periodic:
+                i, j = i % shape[0], j % shape[1]
+            else:
+                on_grid = (i >= 0) & (i < shape[0]) & (j >= 0) & (j < shape[1])
+                i, j, share = i[on_grid], j[on_grid], share[on_grid]
+            np.add.at(density, (i, j), share)
+    return density / (spacing[0] * spacing[1])
+
+"""
+2: The steady state concentration and its gradient
+"""
+#steady concentration of the source density on a periodic grid, by dividing its
+#transform by |k|^2 + 1 / decay_length^2, and its gradient by central differences
+def steady_state(density, spacing, decay_length):
+    kx = 2*maths.pi * np.fft.fftfreq(density.shape[0], spacing[0])
+    ky = 2*maths.pi * np.fft.rfftfreq(density.shape[1], spacing[1])
+    k_squared = kx[:, None]**2 + ky[None, :]**2
+    transform = np.fft.rfft2(density) / (k_squared + 1 / decay_length**2)
+    concentration = np.fft.irfft2(transform, s = density.shape)
+    #the periodic grid wraps round, so the differences can too
+    gx = (np.roll(concentration, -1, axis = 0) - np.roll(concentration, 1, axis = 0)) / (2 * spacing[0])
+    gy = (np.roll(concentration, -1, axis = 1) - np.roll(concentration, 1, axis = 1)) / (2 * spacing[1])
+    return concentration, gx, gy
+
+#concentration made by the point sources and lines of attractant (see point_sources
+#and line_sources) over extent, a Domain or ((x_min, x_max), (y_min, y_max)), at
+#nodes about resolution apart. Returns the concentration and the x and y
+#components of its gradient as (nx, ny) arrays, and the coordinates of the nodes
+#along each axis
+def concentration(sources, extent, resolution = 0.1, decay_length = 5, lines = None):
+    if decay_length <= 0:
+        raise ValueError(f"The decay length must be positive, not {decay_length}")
+    bounds, periodic = raster.extent_bounds(extent)
+    axes = raster.grid_axes(bounds, resolution, periodic)
+    spacing = np.array([axis[1] - axis[0] for axis in axes])
+    shape = tuple(len(axis) for axis in axes)
+    pad = np.zeros(2, dtype = int) if periodic else np.ceil(4 * decay_length / spacing).astype(int)
+    lower = np.array([axes[0][0], axes[1][0]]) - pad * spacing
+
+    points, weights = [np.concatenate(parts) for parts in zip(point_sources(sources), line_sources(lines, resolution))]
+    density = deposit(points, weights, lower, spacing, tuple(np.add(shape, 2 * pad)), periodic)
+    fields = steady_state(density, spacing, decay_length)
+    inner = (slice(pad[0], pad[0] + shape[0]), slice(pad[1], pad[1] + shape[1]))
+    c, gx, gy = [field[inner] for field in fields]
+    return c, gx, gy, axes
+
+"""
+3: Guidance fields
+"""
+#(guidance_angle, guidance_strength) fields, cached by their arguments
+_fields = {}
+
+#guidance up the gradient of the concentration made by the sources and lines
+#(see concentration), as rasterised guidance_angle and guidance_strength fields.
+#The strength is gain * decay_length |grad c| / (c + threshold)
+def chemoattractant(sources, extent, resolution = 0.1, decay_length = 5, lines = None,
+                    gain = 1, threshold = 0, directory = None):
+    bounds, periodic = raster.extent_bounds(extent)
+    key = (tuple(map(tuple, point_sources(sources)[0])), tuple(point_sources(sources)[1]),
+           repr(lines), bounds, periodic, float(resolution), float(decay_length),
+           float(gain), float(threshold), directory)
+    if key in _fields:
+        return _fields[key]
+
+    c, gx, gy, axes = concentration(sources, extent, resolution, decay_length, lines)
+    gradient = np.hypot(gx, gy)
+    sensed = c + threshold
+    strength = gain * decay_length * np.divide(gradient, sensed, out = np.zeros_like(c), where = sensed > 0)
+
+    lower = (axes[0][0], axes[1][0])
+    spacing = (axes[0][1] - axes[0][0], axes[1][1] - axes[1][0])
+    #the gradient vectors themselves are interpolated to give the angles
+    angle = raster.saved_grid(np.stack([gx, gy], axis = -1), lower, spacing, True, periodic, directory)
+    strength = raster.saved_grid(strength[..., None], lower, spacing, False, periodic, directory)
+    _fields[key] = angle, strength
+    return angle, strength
@@ -2,6 +2,9 @@
 Various helper functions for the random walk simulations
 """
 import math as maths
+import os
+import random
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -36,6 +39,111 @@ def sample(n, f, *args, **kwargs):
         output.append(f(*args, **kwargs))
     return output
 
+#the replicate being run by run_ensemble. Pool workers are forked, so they inherit
+#this rather than having it pickled, as the simulations hold unpicklable closures
+_ensemble_task = None
+
+#the simulation run_ensemble reseeds for every replicate: the one given, or the one
+#f is a bound method of. Raises when there is none, or f belongs to another
+def _ensemble_simulation(f, simulation, seeded):
+    owner = getattr(f, "__self__", None)
+    owner = owner if hasattr(owner, "reseed") else None
+    if seeded:
+        if simulation != None:
+            raise ValueError("Give either simulation or seeded = True, not both")
+        return None
+    if simulation == None:
+        simulation = owner
+    elif owner != None and owner is not simulation:
+        raise ValueError("f is a method of a different simulation to the one given")
+    if simulation == None:
+        raise ValueError("run_ensemble needs f to be a bound method of a simulation (eg sim.get_barw), "
+                         "the simulation to reseed as simulation = ..., or seeded = True for f(seed, ...)")
+    if not hasattr(simulation, "reseed"):
+        raise ValueError(f"The simulation {simulation} has no reseed method")
+    return simulation
+
+#reseeds replicate i of the current ensemble task: its simulation's Generator and the
+#random / np.random global states used by distributions without an array sampler
+#(e.g. lambdas). Returns what the simulation's restore needs
+def _reseed_replicate(i):
+    f, simulation, seeded, seeds, args, kwargs = _ensemble_task
+    state = seeds[i].generate_state(2)
+    random.seed(int(state[0]))
+    np.random.seed(int(state[1]))
+    if simulation != None:
+        return simulation.reseed(seeds[i])
+
+#runs replicate i of the current ensemble task, after _reseed_replicate
+def _call_replicate(i):
+    f, simulation, seeded, seeds, args, kwargs = _ensemble_task
+    if seeded:
+        return f(seeds[i], *args, **kwargs)
+    return f(*args, **kwargs)
+
+#runs replicate i of the current ensemble task with its own seed, in a pool worker
+def _run_replicate(i):
+    _reseed_replicate(i)
+    return _call_replicate(i)
+
+#parallel version of sample, runs f(*args, **kwargs) n times over a pool of worker
+#processes and returns the results as a list in sample order, ready for WalkData.
+#workers defaults to the number of cpus, and replicates are handed to the workers
+#chunk_size at a time. Every replicate gets an independent seed spawned from
+#np.random.SeedSequence(seed), so the output for a given seed does not depend on
+#workers or chunk_size, and seed = None gives a fresh random ensemble.
+#The simulation reseeded with it is f's own when f is a bound method such as
+#sim.get_barw, or else must be given as simulation = ... (eg for a functools.partial
+#or lambda of a method). With seeded = True, f is instead called as
+#f(seed, *args, **kwargs) with the replicate's SeedSequence, for functions that make
+#their own simulations. Like the forked workers, the serial path leaves the
+#simulation's Generator and the global random states as they were.
+#Needs the fork start method, without it (e.g. Windows) the replicates run serially
+def run_ensemble(n, f, *args, workers = None, chunk_size = 1, seed = None, simulation = None, seeded = False,
+                 **kwargs):
+    global _ensemble_task
+    if workers == None:
+        workers = os.cpu_count() or 1
+    if workers < 1 or chunk_size < 1:
+        raise ValueError("workers and chunk_size must be at least 1")
+    simulation = _ensemble_simulation(f, simulation, seeded)
+    
+    seeds = np.random.SeedSequence(seed).spawn(n)
+    _ensemble_task = (f, simulation, seeded, seeds, args, kwargs)
+    try:
+        if workers == 1 or n <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+            return _run_serially(n, simulation)
+        with multiprocessing.get_context("fork").Pool(min(workers, n)) as pool:
+            return pool.map(_run_replicate, range(n), chunksize = chunk_size)
+    finally:
+        _ensemble_task = None
+
+#runs the replicates in this process, then restores the simulation's Generator and
+#the global random states
+def _run_serially(n, simulation):
+    random_state, numpy_state = random.getstate(), np.random.get_state()
+    previous = None
+    try:
+        results = []
+        for i in range(n):
+            restore = _reseed_replicate(i)
+            previous = restore if i == 0 else previous
+            results.append(_call_replicate(i))
+        return results
+    finally:
+        if simulation != None and previous != None:
+            simulation.restore(previous)
+        random.setstate(random_state)
+        np.random.set_state(numpy_state)
+
+#cumulative sums restarting at every segment of values, for segments of the given
+#lengths laid end to end, eg lengths [2, 3] sums values[0:2] and values[2:5] separately
+def segment_cumsum(values, lengths):
+    totals = np.cumsum(values)
+    first = np.cumsum(lengths) - lengths
+    offsets = totals[first] - values[first]
+    return totals - np.repeat(offsets, lengths)
+
 def mean(lst):
     return sum(lst) / len(lst)
 
@@ -83,6 +191,56 @@ def mask_relatives(index_np, iteration_np, walker_index, walker_dict):
         return combine_masks([mask1, mask2, mask3, mask4])
     return combine_masks([mask1, mask2])
 
+#precomputed form of mask_relatives, built once when walkers are created
+#gives 4 windows of (branch id, bound) per walker, for its parent, grandparent,
+#sibling and uncle. Points in windows 0 and 1 are ignored when their iteration is
+#>= bound + walker iteration, points in windows 2 and 3 when their iteration is
+#<= bound. Unused windows have id -1, and all windows only apply while the
+#walker's iteration is <= k. Takes arrays of new walkers' parents and siblings,
+#plus the parent, sibling and current iteration of every walker
+def exclusion_windows(parents, siblings, parent_of, sibling_of, iteration_of):
+    parents = np.asarray(parents)
+    has_parent = parents >= 0
+    p = np.maximum(parents, 0)
+    #a branch has one more position than it has taken steps
+    p_len = iteration_of[p] + 1
+    
+    grandparents = np.where(has_parent, parent_of[p], -1)
+    has_grandparent = has_parent & (grandparents >= 0) & (p_len < k)
+    gp_len = iteration_of[np.maximum(grandparents, 0)] + 1
+    
+    ids = np.stack([np.where(has_parent, parents, -1),
+                    np.where(has_grandparent, grandparents, -1),
+                    np.where(has_parent, siblings, -1),
+                    np.where(has_grandparent, sibling_of[p], -1)], axis = -1)
+    bounds = np.stack([p_len - k,
+                       gp_len - k + p_len,
+                       np.full_like(p_len, k),
+                       np.full_like(p_len, k)], axis = -1)
+    return ids, bounds
+
+#squared distance from a point, or array of points, to each segment s0 -> s1
+def point_segment_distance_squared(p, s0, s1):
+    d = s1 - s0
+    length_squared = np.einsum('ij,ij->i', d, d)
+    t = np.einsum('ij,ij->i', p - s0, d) / np.where(length_squared > 0, length_squared, 1)
+    diff = s0 + np.clip(t, 0, 1)[:, None] * d - p
+    return np.einsum('ij,ij->i', diff, diff)
+
+#squared distance between the segment a0 -> a1 and each of the segments b0 -> b1,
+#zero where they cross and otherwise the smallest endpoint to segment distance
+def segment_distance_squared(a0, a1, b0, b1):
+    a0, a1 = np.broadcast_to(a0, b0.shape), np.broadcast_to(a1, b0.shape)
+    da, db = a1 - a0, b1 - b0
+    cross = lambda u, v: u[:, 0]*v[:, 1] - u[:, 1]*v[:, 0]
+    crossing = ((cross(da, b0 - a0) * cross(da, b1 - a0) < 0) &
+                (cross(db, a0 - b0) * cross(db, a1 - b0) < 0))
+    distance_squared = np.minimum.reduce([point_segment_distance_squared(a0, b0, b1),
+                                          point_segment_distance_squared(a1, b0, b1),
+                                          point_segment_distance_squared(b0, a0, a1),
+                                          point_segment_distance_squared(b1, a0, a1)])
+    return np.where(crossing, 0.0, distance_squared)
+
 """
 4: Some functions to be used in global guidance
 
@@ -93,6 +251,8 @@ i.e. guidance can vary with position
 def constant(c):
     def inner_func(x,y):
         return c 
+    #lets the compiled kernels recognise constant fields
+    inner_func.value = c
     return inner_func
 
 def f(x,y):
@@ -100,6 +260,15 @@ def f(x,y):
     y = np.asarray(y)
     return np.where(x<0, 0, np.pi)
 
+#evaluates a field function at arrays of positions, returning an array of
+#matching shape. fields written for scalars only are called point by point
+def evaluate_field(field, x, y):
+    try:
+        values = np.asarray(field(x, y), dtype = float)
+    except (TypeError, ValueError):
+        values = np.array([field(a, b) for a, b in zip(x, y)], dtype = float)
+    return np.broadcast_to(values, np.shape(x))
+
 #set offset = 0 for radial field, pi/2 for circlular
 def swirl(offset):    
     def inner_func(x,y):
@@ -3,29 +3,46 @@ Code for Branching, Annihilating, Arresting, Interacting etc.... Random Walks
 """
 
 import math as maths
+import heapq
 import numpy as np
 
-from aux import Particle, combine_masks, mask_past, mask_relatives, constant
-from distributions import uniform, exponential
+import aux
+import distributions
+from aux import evaluate_field, segment_cumsum, segment_distance_squared
+from distributions import uniform, exponential, fixed, sample_array, bound
+import kernels
+import heading
+import sphere
+from simulation import Simulation
+from spatial import BruteForceIndex, Clearance, make_index
+from storage import WalkerState, WalkerState3D
 
 """
 some constants:
 """
 k = 1 #global guidance strength scaler
 
-class BranchingRandomWalk:
+class BranchingRandomWalk(Simulation):
+    #distributions drawn from, and the names of their block buffered copies (see distributions.Seeded)
+    draws = {"angle_dist": "draw_angle", "step_dist": "draw_step", "branch_angle_dist": "draw_branch_angle",
+             "branch_waiting_dist": "draw_waiting", "initial_pos_dist": "draw_initial_pos",
+             "initial_angle_dist": "draw_initial_angle"}
+
     def __init__(self, 
                  dimension = 2,
-                 step_dist = lambda : 1, 
+                 step_dist = fixed(1), 
                  angle_dist = uniform(-maths.pi/5, maths.pi/5), 
                  branch_prob = exponential(1/15),
-                 branch_angle_dist = lambda : maths.pi / 3,
+                 branch_angle_dist = fixed(maths.pi / 3),
                  initial_pos_dist = uniform(-5,5),
                  initial_angle_dist = uniform(0, 2*maths.pi),
                  guidance_strength = 0,
-                 guidance_angle = 0):
+                 guidance_angle = 0,
+                 domain = None,
+                 obstacles = None,
+                 seed = None):
                 
-        self.dimension = dimension
+        self._set_space(dimension, domain, obstacles)
         self.step_dist = step_dist
         self.angle_dist = angle_dist
         
@@ -40,413 +57,884 @@ class BranchingRandomWalk:
         self.initial_pos_dist = initial_pos_dist
         self.initial_angle_dist = initial_angle_dist
         
-        if type(guidance_angle) in [float, int]:
-            self.guidance_angle = constant(guidance_angle)
-        else:
-            self.guidance_angle = guidance_angle
-        if type(guidance_strength) in [float, int]:
-            self.guidance_strength = constant(guidance_strength)
-        else:
-            self.guidance_strength = guidance_strength
-          
-    #defines a bias function to nudge walker in the direction of the guiding field
-    #this is used in place of the angle distribution on its own    
-    def biased_angle_dist(self, walker):
-        angle_difference = walker.angle - self.guidance_angle(*walker.position)
-        unbiased_angle = self.angle_dist()
-        biased_angle = - k * self.guidance_strength(*walker.position) * maths.sin(angle_difference)
-        return biased_angle + unbiased_angle
-    
-    
-    #performs a branching random walk, keeping track of all information with a dictionary
-    #returned output is this dictionary, to be stored in WalkData and analysed in Analysis objects
+        self._set_guidance(guidance_strength, guidance_angle)
+        
+        self.reseed(seed)
+
+    #the guidance strength scaler, read when used so that changes to k apply
+    def guidance_scale(self):
+        return k
+
+    #creates the two children of walker parent_id, returning their ids
+    #children start at the parent's tip, turned either side of its heading
+    def __branch(self, parent_id, state):
+        #calculate size of state ready for new indices
+        size = state.size
+        angle1 = abs(self.draw_branch_angle())
+        angle2 = abs(self.draw_branch_angle())
+        position = (state.x[parent_id], state.y[parent_id])
+        angle = state.angle[parent_id]
+
+        time1 = time2 = -1
+        if self.branch_waiting_dist != None:
+            time1 = maths.ceil(self.draw_waiting())
+            time2 = maths.ceil(self.draw_waiting())
+
+        state.add_branch(position, angle + angle1, parent_id, size + 1, time1)
+        state.add_branch(position, angle - angle2, parent_id, size, time2)
+        return [size, size + 1]
+
+    #vectorised __branch, creating two children with consecutive ids for each of
+    #an increasing array of parent ids, and returning the children's ids
+    def __branch_many(self, parents, state, by_time = True):
+        num_new = 2 * len(parents)
+        branch_angles = np.abs(sample_array(self.draw_branch_angle, num_new)).reshape(-1, 2)
+        child_angle = (state.angle[parents, None] + branch_angles * np.array([1, -1])).ravel()
+        child_pos = np.repeat(np.column_stack([state.x[parents], state.y[parents]]), 2, axis = 0)
+        siblings = state.size + np.arange(num_new) + 1 - 2 * (np.arange(num_new) % 2)
+
+        child_time = -1
+        if by_time:
+            child_time = np.ceil(sample_array(self.draw_waiting, num_new)).astype(int)
+        return state.add_branches(child_pos, child_angle, np.repeat(parents, 2), siblings, child_time,
+                                  np.repeat(state.sample[parents], 2))
+
+
+    #stationary density of the headings of the walk's points without annihilation,
+    #from the heading master equation on num_bins bins (see heading.py), for comparing
+    #with Analysis.graph_angles at a fraction of the cost of simulating. Exclusion
+    #windows aren't modelled, so it only approximates walks that annihilate
+    def stationary_heading(self, num_bins = 360):
+        self._check_planar("stationary_heading")
+        self._check_unbounded("stationary_heading")
+        return heading.stationary_heading(self, k, num_bins)
+
+    #heading densities of the points laid down in each of the first num_steps iterations
+    #of get_brw from initial_angle, and the expected number of points in each
+    def transient_heading(self, num_steps, initial_angle = 0, num_bins = 360):
+        self._check_planar("transient_heading")
+        self._check_unbounded("transient_heading")
+        return heading.transient_heading(self, num_steps, k, initial_angle, num_bins)
+
+
+    #performs a branching random walk, keeping track of all information in a WalkerState
+    #returned output is its dictionary, to be stored in WalkData and analysed in Analysis objects
+    #
+    #nothing interacts and every branch_time is drawn when the branch is created, so
+    #rather than stepping each branch once per iteration, the whole segment a branch
+    #walks before branching is generated as soon as it is created (see __segments).
+    #The branching events are then handled from a priority queue ordered by the
+    #iteration they happen in, then by walker id, all events of one iteration
+    #together. This is the order the per step loop created children in, so the
+    #walker ids are the same as stepping every branch would give
     def get_brw(self, num_steps, initial_pos = (0,0), initial_angle = 0):
-        #dictionary keeps track of all walkers, how long they travel before branching,
+        self._check_planar("get_brw")
+        self._check_unbounded("get_brw")
+        #state keeps track of all walkers, how long they travel before branching,
         #whether they are active and the trajectory taken so far
-        walker_dict = {0:{"walker" : Particle(initial_pos, initial_angle),
-                          "dead" : False,
-                          "positions" : [initial_pos],
-                          "angles" : [initial_angle % (2*maths.pi)],
-                          "branch_time" : maths.ceil(self.branch_waiting_dist()),
-                          "parent" : None,
-                          "sibling" : None
-                          }}
+        state = WalkerState(branch_times = True)
+        state.add_branch(initial_pos, initial_angle, branch_time = maths.ceil(self.draw_waiting()))
 
-        iteration = 1
-        
-        while iteration < num_steps:
-            #initialise list of walkers that branch this iteration
-            new_branches = []
-            #loop over ids in walker_dict
-            for i in walker_dict.keys():
-                #pre-calculate walker's sub-dictionary and its particle
-                walker_i = walker_dict[i]
-                w = walker_i["walker"]
-                #skip inactive walkers
-                if walker_i["dead"]:
-                    continue
-                
-                #if branching point not yet reached, jump one step
-                if w.iteration < walker_i["branch_time"]:
-                    angle = self.biased_angle_dist(w)
-                    w.rotate(angle)
-                    w.move(self.step_dist())
-                    w.iteration += 1
-                    walker_i["positions"].append(w.position)
-                    walker_i["angles"].append(w.angle)
-                
-                #skip walkers that will not branch next iteration
-                if w.iteration < walker_i["branch_time"]:
-                    continue                
-                #what remains are walkers that are about to branch
-                #initialise child walkers now, so that they can start
-                #walking next iteration without any pause
-                walker_i["dead"] = True
-                new_branches.append(i)
-                
-            #add new branches for this iteration after for loop
-            for parent_id in new_branches:
-                #calculate size of dictionary ready for new indices
-                size = len(walker_dict)
-                angle1 = abs(self.branch_angle_dist())
-                angle2 = abs(self.branch_angle_dist())
-                parent = walker_dict[parent_id]["walker"]
-                walker_dict[size] = {"walker" : Particle(parent.position, parent.angle + angle1),
-                                     "dead" : False,
-                                     "positions" : [parent.position],
-                                     "angles" : [ (parent.angle + angle1) % (2*maths.pi)],
-                                     "branch_time" : maths.ceil(self.branch_waiting_dist()),
-                                     "parent" : parent_id,
-                                     "sibling" : size + 1}
-            
-                walker_dict[size+1] = {"walker" : Particle(parent.position, parent.angle - angle2),
-                                       "dead" : False,
-                                       "positions" : [parent.position],
-                                       "angles" : [(parent.angle - angle2) % (2*maths.pi)],
-                                       "branch_time" : maths.ceil(self.branch_waiting_dist()),
-                                       "parent" : parent_id,
-                                       "sibling" : size}        
-            iteration += 1
-                
+        #queue of (iteration, walker id) branching events
+        events = []
+        self.__segments(np.array([0]), 1, num_steps, state, events)
+        while events:
+            iteration = events[0][0]
+            parents = []
+            while events and events[0][0] == iteration:
+                parents.append(heapq.heappop(events)[1])
+            state.alive[parents] = False
+            #children start walking the iteration after their parents branched
+            children = self.__branch_many(np.array(parents), state)
+            self.__segments(children, iteration + 1, num_steps, state, events)
+
+        return state.to_dict()
+
+    #generates the segments walked by the walkers ids from iteration start, until
+    #they branch or the simulation ends, and queues the branching events that happen
+    #in time. As in the per step loop, a walker steps while its iteration is below
+    #its branch_time, and branches in the iteration it reaches it
+    def __segments(self, ids, start, num_steps, state, events):
+        if start >= num_steps:
+            return
+        length = np.maximum(state.branch_time[ids], 0)
+        n = np.minimum(length, num_steps - start)
+        walking = n > 0
+        if np.any(walking):
+            ids_walking, n = ids[walking], n[walking]
+            x, y, angles = self.__walk(state.x[ids_walking], state.y[ids_walking], state.angle[ids_walking], n)
+            state.advance_segments(ids_walking, n, x, y, angles)
+
+        #a walker with no steps to take still uses up one iteration to branch
+        branch_iteration = start + np.maximum(length, 1) - 1
+        for iteration, i in zip(branch_iteration.tolist(), ids.tolist()):
+            if iteration < num_steps:
+                heapq.heappush(events, (iteration, i))
+
+    #x, y and angle arrays of the points visited by walkers starting from arrays
+    #x, y, angle and taking n steps each, concatenated walker by walker.
+    #the turning angles and step lengths of all segments are drawn as vectors.
+    #Without guidance the angles and positions are then cumulative sums, otherwise
+    #the angles depend on the positions, so every segment is advanced together
+    #one step at a time from the drawn noise
+    def __walk(self, x, y, angle, n):
+        total = int(n.sum())
+        turns = sample_array(self.draw_angle, total)
+        steps = sample_array(self.draw_step, total)
+        segment = np.repeat(np.arange(len(n)), n)
+
+        if getattr(self.guidance_strength, "value", None) == 0:
+            angles = np.mod(angle[segment] + segment_cumsum(turns, n), 2*maths.pi)
+            return (x[segment] + segment_cumsum(steps * np.cos(angles), n),
+                    y[segment] + segment_cumsum(steps * np.sin(angles), n),
+                    angles)
+
+        points = np.empty((3, total))
+        first = np.cumsum(n) - n
+        for t in range(int(n.max())):
+            walking = np.flatnonzero(n > t)
+            rows = first[walking] + t
+            px, py, pa = x[walking], y[walking], angle[walking]
+            angle_difference = pa - evaluate_field(self.guidance_angle, px, py)
+            biased_angle = - k * evaluate_field(self.guidance_strength, px, py) * np.sin(angle_difference)
+            pa = np.mod(pa + (biased_angle + turns[rows]), 2*maths.pi)
+            px = steps[rows] * np.cos(pa) + px
+            py = steps[rows] * np.sin(pa) + py
+            x[walking], y[walking], angle[walking] = px, py, pa
+            points[:, rows] = px, py, pa
+        return points
+
+
+    #continuous time branching random walk, simulated from a global queue of events.
+    #Every walker takes steps at the times of a rate 1 Poisson process, and branches
+    #at rate branch_rate, by default the rate giving the same chance of branching
+    #within a unit of time as branch_prob, or the rate of an exponential waiting time
+    #
+    #a walker's lifetime is drawn when it is created, and its steps in that time are
+    #generated together with those of every walker created alongside it, as in
+    #get_brw. The queue holds (time, walker id) branching events, and the events
+    #within one unit of time of the earliest are handled together.
+    #discretise = True returns the usual walker_dict, recording each walker's
+    #position at whole times (a walker branching at time t records its branching
+    #point at ceil(t), and its children start from there). Otherwise every step is a
+    #point, and each branch also gets "times", the times of its points
+    def get_brw_continuous(self, total_time, initial_pos = (0,0), initial_angle = 0,
+                           branch_rate = None, discretise = True):
+        self._check_planar("get_brw_continuous")
+        self._check_unbounded("get_brw_continuous")
+        if branch_rate == None:
+            branch_rate = self.__branch_rate()
+        state = WalkerState(branch_times = True)
+        state.add_branch(initial_pos, initial_angle)
+        #birth and death times of every walker, and the times of its steps
+        births, deaths, step_times = [0.0], [], []
+
+        events = []
+        self.__lifetimes(np.array([0]), np.array([0.0]), total_time, branch_rate,
+                         state, deaths, step_times, events, discretise)
+        while events:
+            horizon = events[0][0] + 1
+            parents = []
+            while events and events[0][0] < horizon:
+                parents.append(heapq.heappop(events)[1])
+            parents = np.array(sorted(parents))
+            state.alive[parents] = False
+            children = self.__branch_many(parents, state, by_time = False)
+            born = np.repeat(np.array(deaths)[parents], 2)
+            births.extend(born.tolist())
+            self.__lifetimes(children, born, total_time, branch_rate,
+                             state, deaths, step_times, events, discretise)
+
+        walker_dict = state.to_dict()
+        if not discretise:
+            for i, branch in walker_dict.items():
+                #children start at their birth, and roots also logged their starting point
+                branch["times"] = [births[i]] + step_times[i].tolist()
         return walker_dict
-    
-    
-    
-    def get_barw(self, num_steps, radius = 1, initial_pos = (0,0), initial_angle = 0):
-        
+
+    #the rate of branching equivalent to the simulation's branching settings
+    def __branch_rate(self):
+        if self.branch_prob != None:
+            return -maths.log(1 - self.branch_prob)
+        code, parameters = getattr(self.branch_waiting_dist, "kernel", (None, None))
+        if code != distributions.KERNEL_EXPONENTIAL:
+            raise ValueError("Give branch_rate, or branch_prob as a probability or exponential(...)")
+        return float(parameters[0])
+
+    #draws the lifetimes of the new walkers ids born at the given times, generates
+    #their steps up to their death or total_time, and queues the deaths that happen
+    #in time. With discretise the recorded points are the positions at whole times
+    def __lifetimes(self, ids, born, total_time, branch_rate, state, deaths, step_times, events, discretise):
+        died = born + self.rng.exponential(1 / branch_rate, len(ids))
+        end = np.minimum(died, total_time)
+        deaths.extend(died.tolist())
+        for time, i in zip(died.tolist(), ids.tolist()):
+            if time < total_time:
+                heapq.heappush(events, (time, i))
+
+        #step times of all walkers, sorted within each walker's lifetime
+        n = self.rng.poisson(end - born)
+        walker = np.repeat(np.arange(len(ids)), n)
+        times = np.repeat(born, n) + self.rng.random(len(walker)) * np.repeat(end - born, n)
+        order = np.lexsort((times, walker))
+        times = times[order]
+        walking = n > 0
+        ids_walking = ids[walking]
+        x, y, angles = self.__walk(state.x[ids_walking], state.y[ids_walking], state.angle[ids_walking], n[walking])
+        step_times.extend(np.split(times, np.cumsum(n)[:-1]))
+
+        if not discretise:
+            state.advance_segments(ids_walking, n[walking], x, y, angles)
+            return
+
+        #whole times from the one after birth to the one after death, or the last one
+        #before total_time for walkers still alive then
+        first_tick = np.ceil(born).astype(int) + 1
+        last_tick = np.where(died < total_time, np.ceil(died), np.floor(total_time)).astype(int)
+        num_ticks = np.maximum(last_tick - first_tick + 1, 0)
+        state.branch_time[ids] = num_ticks
+        recorded = num_ticks > 0
+        #walkers dying before their first whole time record nothing, but their
+        #children still start where they died
+        unrecorded = np.flatnonzero(~recorded & (n > 0))
+        last_step = np.cumsum(n) - 1
+        state.x[ids[unrecorded]] = x[last_step[unrecorded]]
+        state.y[ids[unrecorded]] = y[last_step[unrecorded]]
+        state.angle[ids[unrecorded]] = angles[last_step[unrecorded]]
+        if not np.any(recorded):
+            return
+        tick_walker = np.repeat(np.arange(len(ids)), num_ticks)
+        ticks = (np.repeat(first_tick, num_ticks) + np.arange(len(tick_walker))
+                 - np.repeat(np.cumsum(num_ticks) - num_ticks, num_ticks))
+        #number of each walker's steps taken by each tick, found in one search by
+        #offsetting every walker's times past the previous walker's
+        offset = total_time + 2
+        taken = np.searchsorted(times + walker * offset, np.minimum(ticks, died[tick_walker]) + tick_walker * offset,
+                                side = "right") - (np.cumsum(n) - n)[tick_walker]
+        #ticks before a walker's first step stay at its start
+        last = (np.cumsum(n) - n)[tick_walker] + taken - 1
+        start = taken == 0
+        last[start] = 0
+        if len(x) == 0:
+            x = y = angles = np.zeros(1)
+        tick_x = np.where(start, state.x[ids][tick_walker], x[last])
+        tick_y = np.where(start, state.y[ids][tick_walker], y[last])
+        tick_angle = np.where(start, state.angle[ids][tick_walker], angles[last])
+        state.advance_segments(ids[recorded], num_ticks[recorded], tick_x, tick_y, tick_angle)
+
+
+    #search selects the spatial index used for annihilation checks,
+    #"brute" tests every stored point, "grid" only those in neighbouring cells,
+    #"kdtree" those found by a periodically rebuilt KD-tree (for very uneven densities)
+    #mode "sequential" moves walkers one at a time, "synchronous" moves all
+    #active walkers together as numpy arrays (see __get_barw_sync)
+    #backend "numba" runs the sequential mode through the compiled kernel of
+    #kernels.py, falling back to "python" when numba or kernels for the
+    #distributions / guidance / search are unavailable. The kernel draws its random
+    #numbers in a different order, so it doesn't reproduce the python engine's walks
+    #for the same seed, only their distribution
+    #skip lets walkers far from everything skip annihilation checks in the python
+    #sequential mode, from cached clearances (see spatial.Clearance). This never
+    #changes the result, and only applies when step_dist is bounded
+    #collision "point" annihilates walkers whose tip is within the radius of a
+    #stored point, "swept" those whose last step passes within the radius of a
+    #stored step, so that long steps (eg from a cauchy step_dist) can't jump over
+    #ducts. Swept collisions run in the python sequential mode, with brute or grid search
+    #with dimension = 3, initial_pos may be (x, y) or (x, y, z), and initial_angle
+    #an azimuth in the xy plane or a heading vector. Every mode then runs the
+    #vectorised engine of __get_barw_3d, with point collisions
+    def get_barw(self, num_steps, radius = 1, initial_pos = (0,0), initial_angle = 0,
+                 search = "brute", mode = "sequential", backend = "python", skip = True,
+                 collision = "point"):
+        self.__check_backend(backend, mode)
+        swept = self.__swept(collision, mode)
+        initial_pos = self.__soma(initial_pos)
+        if self.dimension == 3:
+            return self.__get_barw_3d(num_steps, radius, [initial_pos],
+                                      [sphere.heading_vector(initial_angle)], search)
+
+        if mode == "synchronous":
+            return self.__get_barw_sync(num_steps,
+                                        radius,
+                                        [initial_pos],
+                                        [initial_angle],
+                                        search)
+        if mode != "sequential":
+            raise ValueError(f"Unknown mode '{mode}', use 'sequential' or 'synchronous'")
+
+        if backend == "numba" and not swept and kernels.supports(self, search):
+            return kernels.run_barw(self, num_steps, radius, [initial_pos], [initial_angle], search, k)
+
         if self.branch_prob == None:
             return self.__get_barw_dist(num_steps,
                                         radius,
                                         initial_pos,
-                                        initial_angle)
-        
+                                        initial_angle,
+                                        search,
+                                        skip,
+                                        swept)
+
         if self.branch_waiting_dist == None:
             return self.__get_barw_prob(num_steps,
                                         radius,
                                         initial_pos,
-                                        initial_angle)
-        
+                                        initial_angle,
+                                        search,
+                                        skip,
+                                        swept)
+
+    #whether collisions are swept, checking the collision option against the mode
+    def __swept(self, collision, mode):
+        if collision not in ["point", "swept"]:
+            raise ValueError(f"Unknown collision '{collision}', use 'point' or 'swept'")
+        if collision == "swept" and self.dimension == 3:
+            raise ValueError("Swept collisions are only available in two dimensions")
+        if collision == "swept" and self.domain != None and self.domain.periodic:
+            raise ValueError("Swept collisions can't be used in a periodic domain")
+        if collision == "swept" and mode != "sequential":
+            raise ValueError("Swept collisions only run in the sequential mode")
+        return collision == "swept"
+
+    #cached clearances for a run, or None when checks are never skipped.
+    #clearances bound the distance to points, not segments, so swept runs never skip,
+    #and they don't measure distances to periodic images
+    def __clearance(self, radius, skip, swept = False):
+        if not skip or swept or (self.domain != None and self.domain.periodic):
+            return None
+        clearance = Clearance(radius, bound(self.step_dist))
+        return clearance if clearance.enabled() else None
+
+    #checks whether walker i is within the radius of any stored point,
+    #ignoring its own recent past and the ends of closely related branches
+    #with a clearance cache, the full check is skipped while the walker is known to be safe
+    #when swept, the walker's last step is tested against every stored step instead,
+    #each stored point standing for the step that ended on it
+    def __annihilated(self, i, state, radius_squared, index, clearance = None, swept = False):
+        if clearance is not None:
+            annihilated = clearance.check(i, state)
+            if annihilated is not None:
+                return annihilated
+
+        index.update(state.points)
+        if swept:
+            start, end = state.segment(i)
+            candidates = index.query_segment(start, end)
+            starts = state.points.segment_starts(candidates)
+            ends = state.points.positions[candidates]
+            #cheap bounding box test first, the exact distance is only found for overlaps
+            reach = maths.sqrt(radius_squared)
+            near = np.flatnonzero(np.all((np.minimum(starts, ends) < np.maximum(start, end) + reach) &
+                                         (np.maximum(starts, ends) > np.minimum(start, end) - reach), axis = 1))
+            candidates = near if isinstance(candidates, slice) else candidates[near]
+            distance_squared = segment_distance_squared(start, end, starts[near], ends[near])
+        else:
+            position = (state.x[i], state.y[i])
+            #only points from the index's candidate set need to be tested
+            candidates = index.query(position)
+
+            #calculate distance of candidate points from walker position
+            diff = state.points.positions[candidates] - np.array(position)
+            if self.domain != None:
+                diff = self.domain.separation(diff)
+            distance_squared = np.einsum('ij,ij->i', diff, diff)
+
+        #masks only need to be built for the few points within the radius
+        close = np.flatnonzero(distance_squared < radius_squared)
+        if len(close) > 0:
+            point_ids = close if isinstance(candidates, slice) else candidates[close]
+            #a step is checked with the exclusion windows of its start point, so that
+            #nothing the walker was allowed near on its last check can annihilate it
+            walker_iter = max(state.iteration[i] - 1, 0) if swept else state.iteration[i]
+            mask = self.__pair_mask(i, walker_iter, point_ids, distance_squared[close], state,
+                                    coincident = not swept)
+            if not np.all(mask):
+                return True
+
+        if clearance is not None:
+            clearance.refresh(i, state, index, candidates, distance_squared)
+        return False
+
     #performs a branching annihilating random walk, returning the dictionary
     #if a particle gets too close to an existing duct, it stops all movement (annihilation)
     #walker movement follows global guidance
-    def __get_barw_dist(self, num_steps, radius, initial_pos, initial_angle):
-        walker_dict = {0:{"walker" : Particle(initial_pos, initial_angle),
-                          "dead" : False,
-                          "positions" : [initial_pos],
-                          "angles" : [initial_angle % (2*maths.pi)],
-                          "branch_time" : maths.ceil(self.branch_waiting_dist()),
-                          "parent" : None,
-                          "sibling" : None
-                          }}
-        
+    def __get_barw_dist(self, num_steps, radius, initial_pos, initial_angle, search, skip, swept):
+        state = WalkerState(branch_times = True)
+        state.add_branch(initial_pos, initial_angle, branch_time = maths.ceil(self.draw_waiting()))
+        active = [0]
+
         radius_squared = radius*radius
         iteration = 1
-        
-        pos_np = np.array([(0,0)])
-        index_np = np.array([0])
-        iteration_np = np.array([0])
-        
+        clearance = self.__clearance(radius, skip, swept)
+        index = make_index(search, radius, clearance and clearance.reach, swept, domain = self.domain)
+
         while iteration < num_steps:
             new_branches = []
+            still_active = []
             #print(f"Iteration number: {iteration}")
-            for i in list(walker_dict.keys()):
-                walker_i = walker_dict[i]
-                w = walker_i["walker"]
-                #skip inactive particles
-                if walker_i["dead"]:
+            for i in active:
+                #annihilate walkers that come too close to an existing duct
+                if self.__annihilated(i, state, radius_squared, index, clearance, swept):
+                    state.alive[i] = False
                     continue
-    
-                #calculate distance of all points from walker position
-                diff = pos_np - np.array(w.position)
-                distance_squared = np.einsum('ij,ij->i', diff, diff)
-                #distance_squared = (diff * diff).sum(axis=1)
-
-                #create masks to ignore certain positions
-                #masks return true if they should be ignored
-                m_self = distance_squared < 1e-9
-                m_past = mask_past(index_np, iteration_np, i, w.iteration)
-                m_rel = mask_relatives(index_np, iteration_np, i, walker_dict)
-                
-                
-                #mask = mask_self | mask_past | mask_parent | mask_sibling
-                mask = combine_masks([m_self, m_past, m_rel])
-                too_close = (distance_squared < radius_squared) & ~mask
-                
-                if np.any(too_close):
-                    walker_i["dead"] = True
-                    continue
-                
+
                 #if branching doesn't occur, walk one step
-                if w.iteration < walker_i["branch_time"]:
-                    angle = self.biased_angle_dist(w)
-                    w.rotate(angle)
-                    w.move(self.step_dist())
-                    w.iteration += 1
-                    
-                    walker_i["positions"].append(w.position)
-                    walker_i["angles"].append(w.angle)
-                    
-                    pos_np = np.vstack([pos_np, w.position])
-                    index_np = np.hstack([index_np, i])
-                    iteration_np = np.hstack([iteration_np, w.iteration])
-                
+                if state.iteration[i] < state.branch_time[i] and self._step(i, state) == None:
+                    state.alive[i] = False
+                    continue
+
                 #skip walkers that are not about to branch
-                if w.iteration < walker_i["branch_time"]:
+                if state.iteration[i] < state.branch_time[i]:
+                    still_active.append(i)
                     continue
                 #for the remaining walkers, initialise child branches now
                 #to prevent a 'pause' in the simulation
-                walker_i["dead"] = True
+                state.alive[i] = False
                 new_branches.append(i)
-            
+
             #after one full loop, create all new branched particles together
             for parent_id in new_branches:
-                #calculate size of dictionary ready for new indices
-                size = len(walker_dict)
-                angle1 = abs(self.branch_angle_dist())
-                angle2 = abs(self.branch_angle_dist())
-                parent = walker_dict[parent_id]["walker"]
-                
-                walker_dict[size] = {"walker" : Particle(parent.position, parent.angle + angle1),
-                                     "dead" : False,
-                                     "positions" : [parent.position],
-                                     "angles" : [(parent.angle + angle1) % (2*maths.pi)],
-                                     "branch_time" : maths.ceil(self.branch_waiting_dist()),
-                                     "parent" : parent_id,
-                                     "sibling" : size + 1}
-            
-                walker_dict[size+1] = {"walker" : Particle(parent.position, parent.angle - angle2),
-                                       "dead" : False,
-                                       "positions" : [parent.position],
-                                       "angles" : [(parent.angle - angle2) % (2*maths.pi)],
-                                       "branch_time" : maths.ceil(self.branch_waiting_dist()),
-                                       "parent" : parent_id,
-                                       "sibling" : size}
-                
+                still_active.extend(self.__branch(parent_id, state))
+            active = still_active
             iteration += 1
 
-        return walker_dict
-    
-    def __get_barw_prob(self, num_steps, radius, initial_pos, initial_angle):
-        walker_dict = {0:{"walker" : Particle(initial_pos, initial_angle),
-                          "dead" : False,
-                          "positions" : [initial_pos],
-                          "angles" : [initial_angle % (2*maths.pi)],
-                          "parent" : None,
-                          "sibling" : None
-                          }}
-        
+        return state.to_dict()
+
+    def __get_barw_prob(self, num_steps, radius, initial_pos, initial_angle, search, skip, swept):
+        state = WalkerState()
+        state.add_branch(initial_pos, initial_angle)
+        active = [0]
+
         radius_squared = radius*radius
         iteration = 1
-        
-        pos_np = np.array([(0,0)])
-        index_np = np.array([0])
-        iteration_np = np.array([0])
-        
+        clearance = self.__clearance(radius, skip, swept)
+        index = make_index(search, radius, clearance and clearance.reach, swept, domain = self.domain)
+
         while iteration < num_steps:
             new_branches = []
+            still_active = []
             #print(f"Iteration number: {iteration}")
-            for i in list(walker_dict.keys()):
-                walker_i = walker_dict[i]
-                w = walker_i["walker"]
-                #skip inactive particles
-                if walker_i["dead"]:
+            for i in active:
+                #annihilate walkers that come too close to an existing duct
+                if self.__annihilated(i, state, radius_squared, index, clearance, swept):
+                    state.alive[i] = False
                     continue
-    
-                #calculate distance of all points from walker position
-                diff = pos_np - np.array(w.position)
-                distance_squared = np.einsum('ij,ij->i', diff, diff)
-                #distance_squared = (diff * diff).sum(axis=1)
-
-                #create masks to ignore certain positions
-                #masks return true if they should be ignored
-                m_self = distance_squared < 1e-9
-                m_past = mask_past(index_np, iteration_np, i, w.iteration)
-                m_rel = mask_relatives(index_np, iteration_np, i, walker_dict)
-                
-                
-                #mask = mask_self | mask_past | mask_parent | mask_sibling
-                mask = combine_masks([m_self, m_past, m_rel])
-                too_close = (distance_squared < radius_squared) & ~mask
-                
-                if np.any(too_close):
-                    walker_i["dead"] = True
-                    continue
-                
+
                 #for all walkers, take one step forward
-                angle = self.biased_angle_dist(w)
-                w.rotate(angle)
-                w.move(self.step_dist())
-                w.iteration += 1
-                
-                walker_i["positions"].append(w.position)
-                walker_i["angles"].append(w.angle)
-                
-                pos_np = np.vstack([pos_np, w.position])
-                index_np = np.hstack([index_np, i])
-                iteration_np = np.hstack([iteration_np, w.iteration])
-                
+                if self._step(i, state) == None:
+                    state.alive[i] = False
+                    continue
+
                 #if branching doesn't occur, skip to next walker
-                r = uniform(0,1)()
+                r = self.draw_uniform()
                 if r > self.branch_prob:
+                    still_active.append(i)
                     continue
-               
+
                 #otherwise, initialise child branches now
                 #to prevent a 'pause' in the simulation
-                walker_i["dead"] = True
+                state.alive[i] = False
                 new_branches.append(i)
-            
+
             #after one full loop, create all new branched particles together
             for parent_id in new_branches:
-                #calculate size of dictionary ready for new indices
-                size = len(walker_dict)
-                angle1 = abs(self.branch_angle_dist())
-                angle2 = abs(self.branch_angle_dist())
-                parent = walker_dict[parent_id]["walker"]
-                
-                walker_dict[size] = {"walker" : Particle(parent.position, parent.angle + angle1),
-                                     "dead" : False,
-                                     "positions" : [parent.position],
-                                     "angles" : [(parent.angle + angle1) % (2*maths.pi)],
-                                     "parent" : parent_id,
-                                     "sibling" : size + 1}
-            
-                walker_dict[size+1] = {"walker" : Particle(parent.position, parent.angle - angle2),
-                                       "dead" : False,
-                                       "positions" : [parent.position],
-                                       "angles" : [(parent.angle - angle2) % (2*maths.pi)],
-                                       "parent" : parent_id,
-                                       "sibling" : size}
-                
+                still_active.extend(self.__branch(parent_id, state))
+            active = still_active
             iteration += 1
 
-        return walker_dict
-    
-    
-    def get_multi_barw(self, num_steps, num_walkers, radius = 1):
-        walker_dict = {}
-
-        pos_np = np.zeros((num_walkers, 2))
-        index_np = np.zeros(num_walkers, dtype=int)
-        iteration_np = np.zeros(num_walkers, dtype=int)
-        
+        return state.to_dict()
+
+
+    def __check_backend(self, backend, mode):
+        if backend not in ["python", "numba"]:
+            raise ValueError(f"Unknown backend '{backend}', use 'python' or 'numba'")
+        if backend == "numba" and mode != "sequential":
+            raise ValueError("The numba backend only runs the sequential mode")
+
+    #a soma position for the simulation, in three dimensions (x, y) is padded to
+    #(x, y, 0), and in a domain it is wrapped or reflected into the box. Somas
+    #can't start on obstacles
+    def __soma(self, position):
+        if self.dimension == 3:
+            position = sphere.point(position)
+        if self.domain != None:
+            position = self.domain.start(position)
+        if self.obstacles != None and self.obstacles.distance(*map(float, position)) < self.obstacles.margin:
+            raise ValueError(f"Somas must start outside the obstacles, not at {tuple(position)}")
+        return position
+
+    #draws a starting position from initial_pos_dist, which may either
+    #give tuples or one coordinate at a time
+    def __initial_position(self):
+        x = self.draw_initial_pos()
+        if type(x) == tuple:
+            return x
+        return (x,) + tuple(self.draw_initial_pos() for _ in range(self.dimension - 1))
+
+
+    #search, mode, backend, skip and collision are as for get_barw, so backend = "numba"
+    #doesn't reproduce the python engine's walks for the same seed either
+    #with mode = "synchronous", a Repellent (see repellent.py) replaces annihilation
+    #by avoidance of the repellent the walk secretes, and an Interaction (see
+    #forces.py) turns the tips by the forces between them
+    def get_multi_barw(self, num_steps, num_walkers, radius = 1, search = "brute", mode = "sequential",
+                       backend = "python", skip = True, collision = "point", repellent = None,
+                       interaction = None):
+        self.__check_backend(backend, mode)
+        swept = self.__swept(collision, mode)
+        if (repellent != None or interaction != None) and (mode != "synchronous" or self.dimension != 2):
+            raise ValueError("Repellents and interactions need mode = 'synchronous' in two dimensions")
+        if self.dimension == 3:
+            angles = []
+            somas = []
+            for _ in range(num_walkers):
+                angles.append(sphere.heading_vector(self.draw_initial_angle()))
+                somas.append(self.__soma(self.__initial_position()))
+            return self.__get_barw_3d(num_steps, radius, somas, angles, search)
+        compiled = backend == "numba" and not swept and kernels.supports(self, search)
+        if mode == "synchronous" or compiled:
+            angles = []
+            somas = []
+            for _ in range(num_walkers):
+                angles.append(self.draw_initial_angle())
+                somas.append(self.__soma(self.__initial_position()))
+            if compiled:
+                return kernels.run_barw(self, num_steps, radius, somas, angles, search, k, inclusive = True)
+            return self.__get_barw_sync(num_steps, radius, somas, angles, search, repellent = repellent,
+                                        interaction = interaction)
+        if mode != "sequential":
+            raise ValueError(f"Unknown mode '{mode}', use 'sequential' or 'synchronous'")
+
+        state = WalkerState(branch_times = True)
+        clearance = self.__clearance(radius, skip, swept)
+        index = make_index(search, radius, clearance and clearance.reach, swept, domain = self.domain)
+
         for i in range(num_walkers):
-            theta = self.initial_angle_dist()
-            x = self.initial_pos_dist()
-            if type(x) == tuple:
-                x,y = x
-            else:
-                y = self.initial_pos_dist()
-            
-            walker_dict[i] = {"walker" : Particle((x,y), theta),
-                              "dead" : False,  
-                              "positions" : [(x,y)],
-                              "angles" : [theta % (2*maths.pi)],
-                              "branch_time" : maths.ceil(self.branch_waiting_dist()),
-                              "parent" : None,
-                              "sibling" : None}
-            pos_np[i] = (x,y)
-            index_np[i] = i
-            iteration_np[i] = 0
-            
+            theta = self.draw_initial_angle()
+            x, y = self.__soma(self.__initial_position())
+            state.add_branch((x,y), theta, branch_time = maths.ceil(self.draw_waiting()))
+        active = list(range(num_walkers))
+
         radius_squared = radius*radius
         iteration = 1
-             
+
         while iteration < num_steps:
             new_branches = []
+            still_active = []
             #print(f"Iteration number: {iteration}")
-            for i in list(walker_dict.keys()):
-                walker_i = walker_dict[i]
-                w = walker_i["walker"]
-                #skip inactive particles
-                if walker_i["dead"]:
+            for i in active:
+                #annihilate walkers that come too close to an existing duct
+                if self.__annihilated(i, state, radius_squared, index, clearance, swept):
+                    state.alive[i] = False
                     continue
-    
-                #calculate distance of all points from walker position
-                diff = pos_np - np.array(w.position)
-                distance_squared = np.einsum('ij,ij->i', diff, diff)
-                #distance_squared = (diff * diff).sum(axis=1)
-
-                #create masks to ignore certain positions
-                #masks return true if they should be ignored
-                m_self = distance_squared < 1e-9
-                m_past = mask_past(index_np, iteration_np, i, w.iteration)
-                m_rel = mask_relatives(index_np, iteration_np, i, walker_dict)
-                
-                
-                #mask = mask_self | mask_past | mask_parent | mask_sibling
-                mask = combine_masks([m_self, m_past, m_rel])
-                too_close = (distance_squared < radius_squared) & ~mask
-                
-                if np.any(too_close):
-                    walker_i["dead"] = True
-                    continue
-                
+
                 #if branching doesn't occur, walk one step
-                if w.iteration <= walker_i["branch_time"]:
-                    angle = self.biased_angle_dist(w)
-                    w.rotate(angle)
-                    w.move(self.step_dist())
-                    w.iteration += 1
-                    
-                    walker_i["positions"].append(w.position)
-                    walker_i["angles"].append(w.angle)
-                    
-                    pos_np = np.vstack([pos_np, w.position])
-                    index_np = np.hstack([index_np, i])
-                    iteration_np = np.hstack([iteration_np, w.iteration])
-                
+                if state.iteration[i] <= state.branch_time[i] and self._step(i, state) == None:
+                    state.alive[i] = False
+                    continue
+
                 #skip walkers that are not about to branch
-                if w.iteration < walker_i["branch_time"]:
+                if state.iteration[i] < state.branch_time[i]:
+                    still_active.append(i)
                     continue
                 #for the remaining walkers, initialise child branches now
                 #to prevent a 'pause' in the simulation
-                walker_i["dead"] = True
+                state.alive[i] = False
                 new_branches.append(i)
-            
+
             #after one full loop, create all new branched particles together
             for parent_id in new_branches:
-                #calculate size of dictionary ready for new indices
-                size = len(walker_dict)
-                angle1 = abs(self.branch_angle_dist())
-                angle2 = abs(self.branch_angle_dist())
-                parent = walker_dict[parent_id]["walker"]
-                
-                walker_dict[size] = {"walker" : Particle(parent.position, parent.angle + angle1),
-                                     "dead" : False, 
-                                     "positions" : [parent.position],
-                                     "angles" : [(parent.angle + angle1) % (2*maths.pi)],
-                                     "branch_time" : maths.ceil(self.branch_waiting_dist()),
-                                     "parent" : parent_id,
-                                     "sibling" : size + 1}
-            
-                walker_dict[size+1] = {"walker" : Particle(parent.position, parent.angle - angle2),
-                                     "dead" : False, 
-                                     "positions" : [parent.position],
-                                     "angles" : [(parent.angle - angle2) % (2*maths.pi)],
-                                     "branch_time" : maths.ceil(self.branch_waiting_dist()),
-                                     "parent" : parent_id,
-                                     "sibling" : size}
-                
+                still_active.extend(self.__branch(parent_id, state))
+            active = still_active
             iteration += 1
 
-        return walker_dict
\ No newline at end of file
+        return state.to_dict()
+
+
+    #runs num_samples independent BARWs from initial_pos together in one synchronous
+    #simulation (see __get_barw_sync), returning a list of walker_dicts for WalkData.
+    #every branch carries the id of its sample, and only annihilates on points of the
+    #same sample. guidance_strength and branch_prob may be given as one value per
+    #sample to sweep over them, replacing the simulation's own settings; giving
+    #branch_prob always branches by probability. The grid search is recommended, as
+    #brute force compares every tip with the points of every sample
+    def get_barw_ensemble(self, num_steps, num_samples, radius = 1, initial_pos = (0,0), initial_angle = 0,
+                          search = "brute", guidance_strength = None, branch_prob = None):
+        self._check_planar("get_barw_ensemble")
+        parameters = []
+        for values in [guidance_strength, branch_prob]:
+            if values is not None:
+                values = np.broadcast_to(np.asarray(values, dtype = float), (num_samples,))
+            parameters.append(values)
+
+        return self.__get_barw_sync(num_steps,
+                                    radius,
+                                    [self.__soma(initial_pos)] * num_samples,
+                                    [initial_angle] * num_samples,
+                                    search,
+                                    np.arange(num_samples),
+                                    *parameters)
+
+
+    #synchronous BARW engine, used by get_barw and get_multi_barw with mode = "synchronous"
+    #the positions, angles and iterations of all active tips are held in numpy arrays
+    #and every iteration advances all of them at once: one annihilation test, one
+    #rotation and move, one branching draw and one batch of children
+    #
+    #ordering semantics: the history is double buffered. Every tip is tested against
+    #the points stored before the iteration began, and the points laid down this
+    #iteration are only added afterwards, so tips never see each other's moves from
+    #the same iteration. The sequential engines instead update the history inside the
+    #loop over walkers, so a walker also sees the new points of every walker with a
+    #smaller id that already moved this iteration. A collision between two tips can
+    #therefore be detected up to one iteration later here, giving slightly longer
+    #branches in dense runs. Otherwise the rules (masks, step and branch timing,
+    #child ids and angles) are the same, and the output is the usual walker_dict
+    #
+    #for ensembles, samples gives the sample id of each soma, and the output is a
+    #list of walker_dicts. guidance_strength and branch_prob are then optional
+    #arrays of per sample values, overriding the simulation's own
+    #
+    #with a Repellent (see repellent.py), tips avoid the walk through the repellent it
+    #secretes instead, with no annihilation tests, so radius and search are unused.
+    #with an Interaction, the forces between the tips at the start of each iteration
+    #turn them like guidance
+    def __get_barw_sync(self, num_steps, radius, somas, soma_angles, search, samples = None,
+                        guidance_strength = None, branch_prob = None, repellent = None, interaction = None):
+        num_somas = len(somas)
+        if branch_prob is None:
+            branch_prob = self.branch_prob
+        by_time = branch_prob is None
+
+        state = WalkerState(branch_times = by_time)
+        branch_time = -1
+        if by_time:
+            branch_time = np.ceil(sample_array(self.draw_waiting, num_somas)).astype(int)
+        state.add_branches(np.array(somas, dtype=float).reshape(num_somas, 2),
+                           np.array(soma_angles, dtype=float), -1, -1, branch_time,
+                           0 if samples is None else samples)
+
+        index = make_index(search, radius, domain = self.domain)
+        radius_squared = radius*radius
+        iteration = 1
+        if repellent != None:
+            repellent.reset()
+
+        while iteration < num_steps:
+            tips = state.active()
+            if len(tips) == 0:
+                break
+
+            if repellent == None:
+                #annihilation test of all tips against the history at the start of the iteration
+                index.update(state.points)
+                alive = ~self.__annihilated_sync(tips, state, radius_squared, index)
+            else:
+                #tips stop where the repellent is too strong, and the rest turn down its gradient
+                repellent.step()
+                alive = ~repellent.arrested(state.x[tips], state.y[tips], state.angle[tips])
+                away, avoidance = repellent.avoidance(state.x[tips], state.y[tips])
+
+            if by_time:
+                moving = alive & (state.iteration[tips] < state.branch_time[tips])
+            else:
+                moving = alive.copy()
+
+            #rotate and move all moving tips together
+            ids = tips[moving]
+            x, y = state.x[ids], state.y[ids]
+            angle = state.angle[ids]
+            strength = None
+            if guidance_strength is not None:
+                strength = guidance_strength[state.sample[ids]]
+            turn = self.biased_angle_array(angle, x, y, strength)
+            if repellent != None:
+                turn -= k * avoidance[moving] * np.sin(angle - away[moving])
+            if interaction != None:
+                #forces from every tip that is still alive, moving or about to branch
+                force_angle, force = interaction.guidance(np.column_stack([state.x[tips[alive]], state.y[tips[alive]]]),
+                                                          self.domain)
+                turn -= k * force[moving[alive]] * np.sin(angle - force_angle[moving[alive]])
+            angle = np.mod(angle + turn, 2*maths.pi)
+            step = sample_array(self.draw_step, len(ids))
+            starts = np.column_stack([x, y])
+            if repellent != None:
+                #deposited before the domain wraps or reflects the steps
+                repellent.deposit(starts, starts + step[:, None] * np.column_stack([np.cos(angle), np.sin(angle)]))
+            x, y = x + step * np.cos(angle), y + step * np.sin(angle)
+            stepped = ids
+            if self.domain != None or self.obstacles != None:
+                positions, angle, inside = self._confine_many(starts, np.column_stack([x, y]), angle)
+                #tips stepping out of an absorbing domain or arrested on obstacles are removed without moving
+                alive[np.flatnonzero(moving)[~inside]] = False
+                stepped, x, y, angle = ids[inside], positions[inside, 0], positions[inside, 1], angle[inside]
+            state.advance_many(stepped, x, y, angle)
+
+            #decide which tips branch this iteration
+            if by_time:
+                branching = alive & (state.iteration[tips] >= state.branch_time[tips])
+            else:
+                if np.ndim(branch_prob) > 0:
+                    prob = branch_prob[state.sample[ids]]
+                else:
+                    prob = branch_prob
+                branching = np.zeros_like(alive)
+                branching[moving] = self.rng.random(len(ids)) <= prob
+                branching &= alive
+
+            #annihilated and branching tips are retired
+            state.alive[tips[~alive | branching]] = False
+
+            #create two children per branching tip, with consecutive ids
+            self.__branch_many(tips[branching], state, by_time)
+
+            iteration += 1
+
+        if samples is None:
+            return state.to_dict()
+        return state.to_dicts(int(np.max(samples)) + 1)
+
+    #BARW in three dimensions, from somas (x, y, z) with unit headings. As in the
+    #synchronous engine, all active tips are tested against the history at the start
+    #of each iteration, then turned on the sphere (see sphere.py), moved and branched
+    #together, with the same masks, timings and child ids. The guidance fields are
+    #evaluated at the tips' (x, y)
+    def __get_barw_3d(self, num_steps, radius, somas, headings, search):
+        num_somas = len(somas)
+        by_time = self.branch_prob is None
+
+        state = WalkerState3D(branch_times = by_time)
+        branch_time = -1
+        if by_time:
+            branch_time = np.ceil(sample_array(self.draw_waiting, num_somas)).astype(int)
+        state.add_branches(np.array(somas, dtype=float), np.array(headings, dtype=float), -1, -1, branch_time)
+
+        index = make_index(search, radius, dimension = 3, domain = self.domain)
+        radius_squared = radius*radius
+        iteration = 1
+
+        while iteration < num_steps:
+            tips = state.active()
+            if len(tips) == 0:
+                break
+
+            index.update(state.points)
+            alive = ~self.__annihilated_sync(tips, state, radius_squared, index)
+
+            if by_time:
+                moving = alive & (state.iteration[tips] < state.branch_time[tips])
+            else:
+                moving = alive.copy()
+
+            #guide, turn and move all moving tips together
+            ids = tips[moving]
+            positions = state.points.positions[state.tip_row[ids]]
+            headings = sphere.guided(state.heading[ids], positions, self.guidance_angle, self.guidance_strength, k)
+            headings = sphere.turned(headings, sample_array(self.draw_angle, len(ids)),
+                                     self.rng.uniform(0, 2*maths.pi, len(ids)))
+            step = sample_array(self.draw_step, len(ids))
+            positions = positions + step[:, None] * headings
+            stepped = ids
+            if self.domain != None:
+                positions, headings, inside = self.domain.move_many(positions, headings)
+                alive[np.flatnonzero(moving)[~inside]] = False
+                stepped, positions, headings = ids[inside], positions[inside], headings[inside]
+            state.advance_many(stepped, positions, headings)
+
+            if by_time:
+                branching = alive & (state.iteration[tips] >= state.branch_time[tips])
+            else:
+                branching = np.zeros_like(alive)
+                branching[moving] = self.rng.random(len(ids)) <= self.branch_prob
+                branching &= alive
+
+            state.alive[tips[~alive | branching]] = False
+            self.__branch_many_3d(tips[branching], state, by_time)
+            iteration += 1
+
+        return state.to_dict()
+
+    #__branch_many in three dimensions, the two children of a parent being tilted
+    #towards opposite sides of one random azimuth around its heading
+    def __branch_many_3d(self, parents, state, by_time):
+        num_new = 2 * len(parents)
+        branch_angles = np.abs(sample_array(self.draw_branch_angle, num_new))
+        azimuth = (np.repeat(self.rng.uniform(0, 2*maths.pi, len(parents)), 2) +
+                   np.tile([0, maths.pi], len(parents)))
+        child_heading = sphere.turned(np.repeat(state.heading[parents], 2, axis = 0), branch_angles, azimuth)
+        child_pos = np.repeat(state.points.positions[state.tip_row[parents]], 2, axis = 0)
+        siblings = state.size + np.arange(num_new) + 1 - 2 * (np.arange(num_new) % 2)
+
+        child_time = -1
+        if by_time:
+            child_time = np.ceil(sample_array(self.draw_waiting, num_new)).astype(int)
+        return state.add_branches(child_pos, child_heading, np.repeat(parents, 2), siblings, child_time)
+
+    #vectorised __annihilated, returning a boolean array of which tips are too close
+    #to a stored point. Pairs of tips and points within the radius are found first,
+    #then the same masks are applied to those pairs as arrays
+    def __annihilated_sync(self, tips, state, radius_squared, index):
+        num_tips = len(tips)
+        positions = state.points.positions
+        tip_pos = positions[state.tip_row[tips]]
+        #differences to the nearest periodic image in a periodic domain
+        separation = (lambda diff: diff) if self.domain == None else self.domain.separation
+
+        if isinstance(index, BruteForceIndex):
+            #compare chunks of tips with every point, to bound memory use
+            chunk = max(1, 2**20 // len(positions))
+            tip_rows = []
+            point_ids = []
+            for start in range(0, num_tips, chunk):
+                diff = separation(positions[None, :, :] - tip_pos[start:start + chunk, None, :])
+                rows, ids = np.nonzero(np.einsum('ijk,ijk->ij', diff, diff) < radius_squared)
+                tip_rows.append(rows + start)
+                point_ids.append(ids)
+            tip_rows = np.concatenate(tip_rows)
+            point_ids = np.concatenate(point_ids)
+        else:
+            candidates = index.query_many(tip_pos)
+            tip_rows = np.repeat(np.arange(num_tips), [len(c) for c in candidates])
+            point_ids = np.concatenate(candidates)
+            diff = separation(positions[point_ids] - tip_pos[tip_rows])
+            close = np.einsum('ij,ij->i', diff, diff) < radius_squared
+            tip_rows = tip_rows[close]
+            point_ids = point_ids[close]
+
+        #points of other samples of an ensemble never annihilate a tip
+        walker = tips[tip_rows]
+        same_sample = state.sample[walker] == state.sample[state.points.index[point_ids]]
+        tip_rows, point_ids, walker = tip_rows[same_sample], point_ids[same_sample], walker[same_sample]
+
+        diff = separation(positions[point_ids] - tip_pos[tip_rows])
+        distance_squared = np.einsum('ij,ij->i', diff, diff)
+        mask = self.__pair_mask(walker, state.iteration[walker], point_ids, distance_squared, state)
+        return np.bincount(tip_rows[~mask], minlength = num_tips) > 0
+
+    #creates the mask of stored points to ignore in annihilation checks, true where
+    #a point should be ignored: the walker's own position and recent past, and the
+    #ends of its parent, grandparent, sibling and uncle branches while it is young,
+    #read from the exclusion windows stored when the walker was created
+    #walker and walker_iter are either scalars, or arrays paired with point_ids
+    #coincident = False keeps points at the walker's position, for swept checks where
+    #a distance of 0 means that two steps cross
+    def __pair_mask(self, walker, walker_iter, point_ids, distance_squared, state, coincident = True):
+        history = aux.k
+        point_index = state.points.index[point_ids]
+        point_iter = state.points.iteration[point_ids]
+
+        mask = distance_squared < 1e-9 if coincident else np.zeros(len(point_ids), dtype = bool)
+        mask |= (point_index == walker) & (point_iter >= walker_iter - history)
+
+        young = walker_iter < history + 1
+        if not np.any(young):
+            return mask
+
+        #compare every point with the walker's 4 windows at once
+        window_id = state.lineage_id[walker]
+        window_bound = state.lineage_bound[walker]
+        walker_iter = np.expand_dims(walker_iter, -1)
+        point_iter = point_iter[:, None]
+        in_window = np.concatenate([point_iter >= window_bound[..., :2] + walker_iter,
+                                    point_iter <= window_bound[..., 2:]], axis = -1)
+        mask |= young & np.any((point_index[:, None] == window_id) & in_window, axis = -1)
+        return mask
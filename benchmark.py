@@ -0,0 +1,78 @@
+"""
+Timing comparisons for the performance sensitive parts of the simulations
+
+Each benchmark prints its timings, run this file directly to execute them all
+"""
+from time import perf_counter
+import numpy as np
+
+import kernels
+from barw import BranchingRandomWalk
+from storage import TrajectoryBuffer
+
+#times a single call of f(*args), returning the elapsed seconds
+def timed(f, *args):
+    t0 = perf_counter()
+    f(*args)
+    return perf_counter() - t0
+
+"""
+1: Storing trajectory history, np.vstack / np.hstack against TrajectoryBuffer
+"""
+def append_stacked(points):
+    pos_np = np.zeros((1, 2))
+    index_np = np.zeros(1, dtype=int)
+    iteration_np = np.zeros(1, dtype=int)
+    for i, p in enumerate(points):
+        pos_np = np.vstack([pos_np, p])
+        index_np = np.hstack([index_np, i])
+        iteration_np = np.hstack([iteration_np, i])
+
+def append_buffered(points):
+    buffer = TrajectoryBuffer()
+    buffer.append((0, 0), 0, 0)
+    for i, p in enumerate(points):
+        buffer.append(p, i, i)
+
+#the stacked version is quadratic, so it is skipped beyond max_stacked points
+def bench_trajectory_storage(sizes = (10**4, 10**5, 10**6), max_stacked = 10**5):
+    print("Trajectory storage (seconds):")
+    for n in sizes:
+        points = [tuple(p) for p in np.random.random((n, 2))]
+        buffered = timed(append_buffered, points)
+        if n <= max_stacked:
+            stacked = timed(append_stacked, points)
+            print(f"  {n:>8} points: vstack {stacked:8.3f}, buffer {buffered:8.3f}, speedup {stacked / buffered:6.1f}x")
+        else:
+            print(f"  {n:>8} points: vstack (skipped), buffer {buffered:8.3f}")
+
+"""
+2: The sequential BARW engine, python against the compiled numba kernel
+"""
+#the kernel is compiled (or loaded from numba's cache) by a first small run, which
+#isn't timed. The two backends draw differently, so their walks differ in size,
+#and the time per stored point is compared as well as the total
+def bench_numba_backend(num_steps = (100, 200, 300), num_walkers = 10, radius = 1, search = "grid"):
+    print("Sequential BARW, python against numba backend (seconds):")
+    if not kernels.AVAILABLE:
+        print("  numba is not installed, skipped")
+        return
+    sim = BranchingRandomWalk(seed = 0)
+    sim.get_multi_barw(10, 2, radius, search, backend = "numba")
+    for n in num_steps:
+        times, points = {}, {}
+        for backend in ["python", "numba"]:
+            sim.reseed(n)
+            t0 = perf_counter()
+            walk = sim.get_multi_barw(n, num_walkers, radius, search, backend = backend)
+            times[backend] = perf_counter() - t0
+            points[backend] = sum(len(branch["positions"]) for branch in walk.values())
+        per_point = {backend: times[backend] / points[backend] for backend in times}
+        print(f"  {n:>5} steps: python {times['python']:8.3f} ({points['python']:>7} points), "
+              f"numba {times['numba']:8.3f} ({points['numba']:>7} points), "
+              f"speedup per point {per_point['python'] / per_point['numba']:6.1f}x")
+
+
+if __name__ == "__main__":
+    bench_trajectory_storage()
+    bench_numba_backend()
@@ -7,11 +7,32 @@ fixed by function(params)
 
 Most functions work via inverse sampling, ie, take a uniform variable r = (0,1),
 and some transformation on r yields the required pdf
+
+The built in distributions also carry a vectorised sampler,
+    function(params).array(n)
+returning n samples at once as a numpy array, for use by the vectorised engines.
+sample_array(dist, n) works for any distribution, falling back to n single calls
+
+The array samplers take a numpy Generator as rng (defaulting to np.random), and
+blocked(dist, rng) uses this to draw samples in large blocks for the simulations
+
+They also carry function(params).kernel = (code, parameters), describing the
+distribution to the compiled kernels of kernels.py, see the KERNEL_ codes below
 """
 
 import random
+import functools
 import matplotlib.pyplot as plt
 import math as maths
+import numpy as np
+
+#codes identifying the built in distributions to the compiled kernels
+KERNEL_FIXED = 0
+KERNEL_UNIFORM = 1
+KERNEL_EXPONENTIAL = 2
+KERNEL_NORMAL = 3
+KERNEL_CAUCHY = 4
+KERNEL_PMF = 5
 
 #defines a pmf distribution for finite sample spaces
 #eg pmf({"H":1, "T"":2}) produces a weighted coin toss
@@ -37,6 +58,19 @@ def pmf(prob_dict):
             if cumulative[i] < r < cumulative[i+1]:
                 return values[i]
         return values[-1]
+    
+    #the number of inner cumulative bounds below r gives the sampled index
+    value_array = np.array(values)
+    def array(n, rng = np.random):
+        r = rng.random(n)
+        return value_array[np.searchsorted(cumulative[1:-1], r, side = "left")]
+    
+    sample.array = array
+    #the renormalised probabilities, for exact calculations (see propagator.py)
+    sample.prob_dict = prob_dict
+    #numeric pmfs are passed to the kernels as their values then inner cumulative bounds
+    if all(type(value) in [float, int] for value in values):
+        sample.kernel = (KERNEL_PMF, np.array(values + cumulative[1:-1], dtype = float))
     #return sample function so that behaviour is same as random.random
     return sample
 
@@ -45,6 +79,11 @@ def cauchy(location, spread):
     def sample():
         r = random.random()
         return spread * maths.tan( maths.pi * (r-0.5) ) + location
+    def array(n, rng = np.random):
+        r = rng.random(n)
+        return spread * np.tan( np.pi * (r-0.5) ) + location
+    sample.array = array
+    sample.kernel = (KERNEL_CAUCHY, np.array([location, spread], dtype = float))
     return sample
 
 #defines an exponential pdf by inverse sampling
@@ -52,17 +91,38 @@ def exponential(scale):
     def sample():
         r = random.random()
         return - (maths.log(r)) / scale
+    def array(n, rng = np.random):
+        r = 1 - rng.random(n)
+        return - np.log(r) / scale
+    sample.array = array
+    sample.kernel = (KERNEL_EXPONENTIAL, np.array([scale], dtype = float))
     return sample
 
 #I had to cheat on this one :(
+#note the second parameter is passed to normalvariate as the standard deviation
 def normal(mean, variance):
-    return lambda : random.normalvariate(mean, variance)
+    sample = lambda : random.normalvariate(mean, variance)
+    sample.array = lambda n, rng = np.random: rng.normal(mean, variance, n)
+    sample.kernel = (KERNEL_NORMAL, np.array([mean, variance], dtype = float))
+    return sample
 
 #stretches random.random to work on any given interval
 def uniform(start, end):
     def sample():
         r = random.random()
         return start + (end - start) * r
+    def array(n, rng = np.random):
+        return start + (end - start) * rng.random(n)
+    sample.array = array
+    sample.kernel = (KERNEL_UNIFORM, np.array([start, end], dtype = float))
+    return sample
+
+#always gives the same value, eg fixed(1) for unit steps
+#equivalent to lambda : value, but also usable by the vectorised engines and kernels
+def fixed(value):
+    sample = lambda : value
+    sample.array = lambda n, rng = np.random: np.full(n, value, dtype = float)
+    sample.kernel = (KERNEL_FIXED, np.array([value], dtype = float))
     return sample
 
 #is called in the same way as the other pdf, but as deterministic
@@ -76,6 +136,78 @@ def list_seq(lst):
         return lst[current_index - 1]
     return inner_func
 
+#draws n samples from any distribution as a numpy array, using the vectorised
+#sampler where one exists, and otherwise calling the distribution n times
+def sample_array(dist, n):
+    if hasattr(dist, "array"):
+        return dist.array(n)
+    return np.array([dist() for _ in range(n)], dtype = float)
+
+#the largest absolute value a distribution can give, read from its kernel
+#description, or infinity if it is unbounded or not a built in distribution
+def bound(dist):
+    code, parameters = getattr(dist, "kernel", (None, None))
+    if code in [KERNEL_FIXED, KERNEL_UNIFORM]:
+        return float(np.max(np.abs(parameters)))
+    if code == KERNEL_PMF:
+        return float(np.max(np.abs(parameters[:(len(parameters) + 1) // 2])))
+    return maths.inf
+
+#wraps a distribution so that single samples are served from blocks of samples
+#drawn in one go from the numpy Generator rng, which is much cheaper per sample.
+#behaves like the distribution itself, function() for one sample and
+#function.array(n) for n samples. Distributions without an array sampler
+#(deterministic ones such as list_seq, or plain lambdas) are returned unchanged
+def blocked(dist, rng, block_size = 4096):
+    if not hasattr(dist, "array"):
+        return dist
+    
+    def blocks():
+        while True:
+            yield from dist.array(block_size, rng).tolist()
+    
+    sample = functools.partial(next, blocks())
+    sample.array = lambda n: dist.array(n, rng)
+    return sample
+
+#base of the simulations, which own a numpy Generator (self.rng) and take their
+#random draws from blocked copies of their distributions using it. draws maps the
+#name of each distribution to the name of its copy, eg "step_dist": "draw_step",
+#and draw_uniform gives uniform(0,1) samples. Assigning one of the distributions
+#after construction rebuilds its copy
+class Seeded:
+    draws = {}
+
+    #seed can be anything np.random.default_rng accepts, including a SeedSequence.
+    #Returns the previous Generator and copies, for restore
+    def reseed(self, seed = None):
+        previous = None
+        if "rng" in vars(self):
+            previous = (self.rng, self.draw_uniform,
+                        {name: (getattr(self, name), getattr(self, draw)) for name, draw in self.draws.items()})
+        self.rng = np.random.default_rng(seed)
+        for name, draw in self.draws.items():
+            setattr(self, draw, blocked(getattr(self, name), self.rng))
+        self.draw_uniform = blocked(uniform(0,1), self.rng)
+        return previous
+
+    #puts back the Generator and copies returned by reseed, leaving everything else
+    #as it is. Distributions assigned since get copies using the restored Generator
+    def restore(self, previous):
+        rng, draw_uniform, copies = previous
+        self.rng = rng
+        self.draw_uniform = draw_uniform
+        for name, (dist, copy) in copies.items():
+            if getattr(self, name) is dist:
+                object.__setattr__(self, self.draws[name], copy)
+            else:
+                object.__setattr__(self, self.draws[name], blocked(getattr(self, name), rng))
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in self.draws and "rng" in vars(self):
+            object.__setattr__(self, self.draws[name], blocked(value, self.rng))
+
 #graphing function for testing purposes, takes a sample size n from a pdf,
 #and graphs the distribution of points. Good sanity check.
 def graph_pdf_from_sample(pdf, sample_size, axis_min, axis_max, bin_number, name = None):
@@ -0,0 +1,119 @@
+"""
+Bounded and periodic domains for the walks
+
+By default walks run in unbounded space, so guided or multi soma simulations
+keep spreading out, and the history and spatial indexes grow with the area
+covered. A Domain is instead the box of the given size centred on the origin,
+with one of three boundaries:
+
+    "periodic"   a walker leaving one side re-enters on the opposite side, and
+                 annihilation distances are to the nearest periodic image of a
+                 point (the minimum image convention), so a bulk simulation has
+                 no edges and a fixed area
+    "reflecting" a walker stepping through a wall is reflected back in off it,
+                 with its heading mirrored in the wall
+    "absorbing"  a walker stepping out of the box is removed there, like an
+                 annihilated walker, without logging the step
+
+size is one length for a square / cube, or one length per axis. Positions are
+kept inside the box, so steps longer than the box are wrapped or reflected as
+many times as needed, and periodic walks are logged at their wrapped positions,
+so graphs draw a jump across the box where they cross it. Walks are started from
+their somas wrapped or reflected into the box, and absorbing boxes need their
+somas inside them
+"""
+import math as maths
+import numpy as np
+
+BOUNDARIES = ["periodic", "reflecting", "absorbing"]
+
+class Domain:
+    def __init__(self, size, boundary = "periodic"):
+        if boundary not in BOUNDARIES:
+            raise ValueError(f"Unknown boundary '{boundary}', use 'periodic', 'reflecting' or 'absorbing'")
+        self.size = np.atleast_1d(np.asarray(size, dtype = float))
+        if self.size.ndim != 1 or np.any(self.size <= 0):
+            raise ValueError(f"A domain size is a positive length or one per axis, not {size}")
+        self.boundary = boundary
+        self.periodic = boundary == "periodic"
+        self.lower = -self.size / 2
+        #python floats of the first two axes, for the scalar moves of the sequential engines
+        self.width, self.height = float(self.size[0]), float(self.size[min(1, len(self.size) - 1)])
+
+    #lengths of the box along each of the dimension axes, raising a ValueError if
+    #the size doesn't fit the dimension
+    def sizes(self, dimension):
+        if len(self.size) not in [1, dimension]:
+            raise ValueError(f"A domain in {dimension} dimensions needs 1 or {dimension} sizes, not {len(self.size)}")
+        return np.broadcast_to(self.size, (dimension,))
+
+    #shortest separations between periodic images, for arrays of differences
+    #between positions (..., dimension). Without periodic boundaries they are unchanged
+    def separation(self, diff):
+        if not self.periodic:
+            return diff
+        size = self.sizes(diff.shape[-1])
+        return diff - size * np.round(diff / size)
+
+    #the soma a walk starts from, wrapped or reflected into the box
+    def start(self, position):
+        position = np.array([position], dtype = float)
+        if self.boundary == "absorbing":
+            if not np.all(self.inside(position)):
+                raise ValueError(f"Somas must start inside an absorbing domain, not at {tuple(position[0])}")
+            return tuple(position[0].tolist())
+        return tuple(self.move_many(position, np.zeros(1))[0][0].tolist())
+
+    #which of an array of positions lie inside the box
+    def inside(self, positions):
+        size = self.sizes(positions.shape[1])
+        return np.all((positions >= -size / 2) & (positions < size / 2), axis = 1)
+
+    #moves a walker that has just stepped to (x, y) facing angle back into the box,
+    #returning the new (x, y, angle), or None if it was absorbed
+    def move(self, x, y, angle):
+        width, height = self.width, self.height
+        if -width / 2 <= x < width / 2 and -height / 2 <= y < height / 2:
+            return x, y, angle
+        if self.boundary == "absorbing":
+            return None
+        if self.periodic:
+            return (x + width / 2) % width - width / 2, (y + height / 2) % height - height / 2, angle
+        #each reflection in a wall mirrors one component of the heading
+        x, flip_x = reflected(x, width)
+        y, flip_y = reflected(y, height)
+        angle = maths.atan2(-maths.sin(angle) if flip_y else maths.sin(angle),
+                            -maths.cos(angle) if flip_x else maths.cos(angle)) % (2*maths.pi)
+        return x, y, angle
+
+    #vectorised move, for positions (n, dimension) and either angles (n,) in two
+    #dimensions or unit headings (n, 3) in three. Returns the new positions and
+    #angles / headings, and a boolean array of which walkers are still inside
+    def move_many(self, positions, angles):
+        size = self.sizes(positions.shape[1])
+        if self.boundary == "absorbing":
+            return positions, angles, self.inside(positions)
+        offset = positions + size / 2
+        if self.periodic:
+            return np.mod(offset, size) - size / 2, angles, np.ones(len(positions), dtype = bool)
+
+        folded = np.mod(offset, 2 * size)
+        flipped = folded >= size
+        positions = np.where(flipped, 2 * size - folded, folded) - size / 2
+        #a fold landing exactly on the upper wall is put back just inside
+        positions = np.minimum(positions, np.nextafter(size / 2, 0))
+        sign = np.where(flipped, -1.0, 1.0)
+        if np.ndim(angles) == 1:
+            angles = np.mod(np.arctan2(sign[:, 1] * np.sin(angles), sign[:, 0] * np.cos(angles)), 2*maths.pi)
+        else:
+            angles = angles * sign
+        return positions, angles, np.ones(len(positions), dtype = bool)
+
+#coordinate x reflected into [-length/2, length/2) off the walls, and whether the
+#heading along that axis is reversed (an odd number of reflections)
+def reflected(x, length):
+    folded = (x + length / 2) % (2 * length)
+    flipped = folded >= length
+    position = (2 * length - folded if flipped else folded) - length / 2
+    #the same clamp as move_many, the largest float below the upper wall
+    return min(position, maths.nextafter(length / 2, 0)), flipped
@@ -0,0 +1,228 @@
+"""
+Soft interactions between the active tips of a walk
+
+Besides annihilation, tips can attract or repel each other, eg tips chemotaxing
+towards other somas. A force kernel gives the size of the force one tip exerts
+on another at distance r, positive for attraction towards it and negative for
+repulsion away from it. The total force F on each tip then turns it like a
+guidance field, by -k |F| sin(angle - angle of F).
+
+Summing over every pair of tips costs n^2, so an Interaction splits the forces:
+
+    short  a kernel for distances up to cutoff, summed exactly over the pairs in
+           neighbouring cells of a cell list of the tips, cells being at least
+           cutoff wide
+    long   a kernel for all distances, approximated by Barnes-Hut: the tips are
+           put in a quadtree, and a tip feels a whole node of it as one tip of
+           the node's total weight at its centre of mass, when the node's width
+           is less than theta times its distance. Closer nodes are opened, down
+           to leaves of at most leaf_size tips summed exactly
+
+Either may be left out. Both are evaluated for all tips at once, walking the
+quadtree for every (tip, node) pair of a level together. In a periodic domain
+the separations are to the nearest image of each tip, and a tip only feels a
+node as a whole when the node lies within half the box around it
+"""
+import numpy as np
+
+"""
+1: Force kernels
+"""
+#strength * exp(-r / length), for short range forces
+def exponential(strength, length):
+    def inner_func(r):
+        return strength * np.exp(-r / length)
+    return inner_func
+
+#strength / (r + softening)^power, for long range forces. softening keeps the force
+#between tips passing close to each other finite
+def power_law(strength, power = 1, softening = 1):
+    def inner_func(r):
+        return strength / (r + softening)**power
+    return inner_func
+
+"""
+2: Cell list and quadtree evaluation
+"""
+#forces of the kernel for the pairs of tips (i, j), given as separations d
+#from tip i to tip j, summed onto the tips i
+def pair_forces(kernel, i, d, num_tips, weights = 1):
+    r = np.linalg.norm(d, axis = 1)
+    apart = r > 0
+    magnitude = np.zeros(len(r))
+    magnitude[apart] = kernel(r[apart]) / r[apart]
+    forces = np.zeros((num_tips, 2))
+    np.add.at(forces, i, (weights * magnitude)[:, None] * d)
+    return forces
+
+#every pair (i, j), i != j, of tips in the same or neighbouring cells of width at
+#least cutoff, so containing every pair closer than cutoff
+def neighbour_pairs(positions, cutoff, domain = None):
+    n = len(positions)
+    periodic = domain != None and domain.periodic
+    if periodic:
+        size = domain.sizes(2)
+        num_cells = np.floor(size / cutoff).astype(int)
+        #with under 3 cells across, neighbouring cells would repeat
+        if np.any(num_cells < 3):
+            i, j = np.nonzero(~np.eye(n, dtype = bool))
+            return i, j
+        cells = np.floor((positions - domain.lower) / (size / num_cells)).astype(int) % num_cells
+    else:
+        cells = np.floor((positions - positions.min(axis = 0)) / cutoff).astype(int)
+        num_cells = cells.max(axis = 0) + 1
+    keys = cells[:, 0] * num_cells[1] + cells[:, 1]
+    order = np.argsort(keys, kind = "stable")
+    sorted_keys = keys[order]
+
+    pairs_i, pairs_j = [], []
+    for dx in [-1, 0, 1]:
+        for dy in [-1, 0, 1]:
+            neighbour = cells + [dx, dy]
+            if periodic:
+                neighbour %= num_cells
+                valid = np.ones(n, dtype = bool)
+            else:
+                valid = np.all((neighbour >= 0) & (neighbour < num_cells), axis = 1)
+            tips = np.flatnonzero(valid)
+            neighbour_keys = neighbour[tips, 0] * num_cells[1] + neighbour[tips, 1]
+            start = np.searchsorted(sorted_keys, neighbour_keys, "left")
+            count = np.searchsorted(sorted_keys, neighbour_keys, "right") - start
+            i = np.repeat(tips, count)
+            offsets = np.arange(len(i)) - np.repeat(np.cumsum(count) - count, count)
+            pairs_i.append(i)
+            pairs_j.append(order[np.repeat(start, count) + offsets])
+    i, j = np.concatenate(pairs_i), np.concatenate(pairs_j)
+    return i[i != j], j[i != j]
+
+#quadtree of the tips, as arrays over its nodes: centre of mass, number of tips,
+#width, middle of the node's square, the 4 children (-1 for none) and, for
+#leaves, the slice of order holding their tips.
+#The tree is built a level at a time rather than node by node: the tips of every
+#node still being split are kept grouped by node, and a level's nodes are all
+#summarised and split at once, so it takes one pass of array operations per level
+class QuadTree:
+    def __init__(self, positions, leaf_size = 8):
+        self.positions = positions
+        self.leaf_size = leaf_size
+        low, high = positions.min(axis = 0), positions.max(axis = 0)
+        width = max(float(np.max(high - low)), 1e-9) * (1 + 1e-9)
+        levels = self.__build(low, width)
+        self.centre, self.mass, self.width, self.middle, self.children, self.leaf, self.order = \
+            [np.concatenate(column) for column in zip(*levels)]
+
+    #builds the tree level by level from the root square with lower corner low, returning
+    #the (centre, mass, width, middle, children, leaf, leaf tips) arrays of each level
+    def __build(self, low, width):
+        positions = self.positions
+        #the tips of the level's nodes, grouped by node, and the node of each within the level
+        ids, node = np.arange(len(positions)), np.zeros(len(positions), dtype = int)
+        lows = low[None, :]
+        levels, first, num_leaf_tips = [], 0, 0
+        while len(ids) > 0:
+            num_nodes = len(lows)
+            mass = np.bincount(node, minlength = num_nodes)
+            starts = np.cumsum(mass) - mass
+            points = positions[ids]
+            centre = np.add.reduceat(points, starts) / mass[:, None]
+            #tips at one point can't be split, so are kept in one leaf
+            coincident = np.all(np.maximum.reduceat(points, starts) == np.minimum.reduceat(points, starts), axis = 1)
+            is_leaf = (mass <= self.leaf_size) | coincident
+
+            leaf = np.zeros((num_nodes, 2), dtype = int)
+            leaf[is_leaf, 0] = num_leaf_tips + np.cumsum(mass[is_leaf]) - mass[is_leaf]
+            leaf[is_leaf, 1] = mass[is_leaf]
+            in_leaf = is_leaf[node]
+            leaf_tips = ids[in_leaf]
+            num_leaf_tips += len(leaf_tips)
+
+            #the rest are split into quadrants, each non empty one a node of the next level
+            half = width / 2
+            ids, node = ids[~in_leaf], node[~in_leaf]
+            key = 4 * node + ((positions[ids] - lows[node]) >= half).astype(int) @ [2, 1]
+            order = np.argsort(key, kind = "stable")
+            ids = ids[order]
+            child_keys, node = np.unique(key[order], return_inverse = True)
+            children = np.full((num_nodes, 4), -1, dtype = int)
+            children[child_keys // 4, child_keys % 4] = first + num_nodes + np.arange(len(child_keys))
+
+            levels.append((centre, mass.astype(float), np.full(num_nodes, width), lows + width / 2,
+                           children, leaf, leaf_tips))
+            first += num_nodes
+            quadrants = np.stack([child_keys % 4 // 2, child_keys % 2], axis = 1)
+            lows = lows[child_keys // 4] + half * quadrants
+            width = half
+        return levels
+
+    #forces of the kernel on every tip, opening nodes whose width is at least
+    #theta times their distance from the tip. Nodes whose square holds the tip are
+    #always opened, so no tip is pushed by a centre of mass that includes itself.
+    #In a periodic domain nodes are also opened unless their square lies within
+    #half the box of the tip, where every tip in them is its own nearest image
+    def forces(self, kernel, theta = 0.5, domain = None):
+        positions = self.positions
+        n = len(positions)
+        periodic = domain != None and domain.periodic
+        separation = domain.separation if periodic else (lambda diff: diff)
+        forces = np.zeros((n, 2))
+        tips, nodes = np.arange(n), np.zeros(n, dtype = int)
+        while len(tips) > 0:
+            d = separation(self.centre[nodes] - positions[tips])
+            far = self.width[nodes] < theta * np.linalg.norm(d, axis = 1)
+            offset = np.abs(separation(self.middle[nodes] - positions[tips]))
+            far &= np.any(offset > self.width[nodes, None] / 2, axis = 1)
+            if periodic:
+                reach = offset + self.width[nodes, None] / 2
+                far &= np.all(reach < domain.sizes(2) / 2, axis = 1)
+            forces += pair_forces(kernel, tips[far], d[far], n, self.mass[nodes[far]])
+            tips, nodes = tips[~far], nodes[~far]
+
+            #leaves are summed exactly, tip by tip
+            is_leaf = self.leaf[nodes, 1] > 0
+            start, count = self.leaf[nodes[is_leaf], 0], self.leaf[nodes[is_leaf], 1]
+            i = np.repeat(tips[is_leaf], count)
+            offsets = np.arange(len(i)) - np.repeat(np.cumsum(count) - count, count)
+            j = self.order[np.repeat(start, count) + offsets]
+            forces += pair_forces(kernel, i[i != j], separation(positions[j] - positions[i])[i != j], n)
+
+            #the rest are opened
+            tips, nodes = tips[~is_leaf], nodes[~is_leaf]
+            children = self.children[nodes]
+            tips, nodes = np.repeat(tips, 4)[children.ravel() >= 0], children.ravel()[children.ravel() >= 0]
+        return forces
+
+"""
+3: Interactions between tips
+"""
+class Interaction:
+    def __init__(self, short = None, cutoff = None, long = None, theta = 0.5, leaf_size = 8):
+        if short != None and (cutoff == None or cutoff <= 0):
+            raise ValueError("A short range kernel needs a positive cutoff")
+        if not 0 < theta < 1:
+            raise ValueError(f"theta must be between 0 and 1, not {theta}")
+        self.short = short
+        self.cutoff = cutoff
+        self.long = long
+        self.theta = theta
+        self.leaf_size = leaf_size
+
+    #total force on each of the tips at positions (n, 2), optionally in a domain
+    def forces(self, positions, domain = None):
+        n = len(positions)
+        forces = np.zeros((n, 2))
+        if n < 2:
+            return forces
+        separation = (lambda diff: diff) if domain == None else domain.separation
+        if self.short != None:
+            i, j = neighbour_pairs(positions, self.cutoff, domain)
+            d = separation(positions[j] - positions[i])
+            close = np.einsum('ij,ij->i', d, d) < self.cutoff**2
+            forces += pair_forces(self.short, i[close], d[close], n)
+        if self.long != None:
+            forces += QuadTree(positions, self.leaf_size).forces(self.long, self.theta, domain)
+        return forces
+
+    #the angle of the force on each tip and its size, for turning them like guidance
+    def guidance(self, positions, domain = None):
+        forces = self.forces(positions, domain)
+        return np.arctan2(forces[:, 1], forces[:, 0]), np.linalg.norm(forces, axis = 1)
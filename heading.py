@@ -0,0 +1,160 @@
+"""
+Heading distributions of branching random walks from their master equation
+
+Ignoring annihilation, the heading of a BARW walker evolves on its own: each step
+turns it by the guidance drift -k s sin(theta - guidance angle) plus a draw from
+angle_dist, and after a step it branches with probability pb into two children,
+turned either side of it by |branch_angle_dist|. On a circle discretised into
+num_bins bins these are linear operators on the density of walkers over
+headings, the step S and the branching A = (1 - pb) I + pb B, where B makes the
+two children. The headings recorded at the points of the walk then evolve by
+r_t+1 = S A r_t, so their stationary distribution is the leading eigenvector of
+S A, and the transient distributions are its powers applied to the first step.
+
+This is the approximation ignoring annihilation, so it is exact for get_brw
+but not for the annihilating engines of barw.py. No walker is ever removed, so
+the exclusion windows that keep a young walker from annihilating on its relatives
+don't enter, and a child's branch angle only turns its heading, with nothing for
+the two children starting at the same point. For annihilating walks it holds
+best while annihilation is rare.
+
+The turning distributions are turned into bin probabilities exactly, from their
+cumulative distribution functions (uniform, normal, cauchy, exponential) or by
+sharing point masses (fixed, pmf) between the two nearest bins. Guidance must be
+constant, and branching either a probability per step or an exponential waiting
+time, which gives geometric waits of ceil(time) steps, ie a fixed probability
+"""
+
+import math as maths
+import numpy as np
+import scipy.special as special
+
+from distributions import (KERNEL_FIXED, KERNEL_UNIFORM, KERNEL_EXPONENTIAL, KERNEL_NORMAL,
+                           KERNEL_CAUCHY, KERNEL_PMF)
+
+"""
+1: Turning distributions as bin probabilities
+"""
+#point masses (values, probabilities) of a discrete distribution, or None
+def point_masses(dist):
+    code, parameters = getattr(dist, "kernel", (None, None))
+    if code == KERNEL_FIXED:
+        return parameters[:1], np.ones(1)
+    if code == KERNEL_PMF:
+        num_values = (len(parameters) + 1) // 2
+        cumulative = np.concatenate([[0], parameters[num_values:], [1]])
+        return parameters[:num_values], np.diff(cumulative)
+    return None
+
+#cumulative distribution function and range of turns to fold, of a continuous distribution
+def continuous_cdf(dist):
+    code, parameters = getattr(dist, "kernel", (None, None))
+    if code == KERNEL_UNIFORM:
+        start, end = parameters
+        return (lambda x: np.clip((x - start) / (end - start), 0, 1)), max(abs(start), abs(end))
+    if code == KERNEL_NORMAL:
+        mean, deviation = parameters
+        return (lambda x: 0.5 * (1 + special.erf((x - mean) / (deviation * maths.sqrt(2))))), abs(mean) + 12 * deviation
+    if code == KERNEL_CAUCHY:
+        location, spread = parameters
+        #the tails beyond a few hundred turns hold a negligible share of the mass
+        return (lambda x: 0.5 + np.arctan((x - location) / spread) / maths.pi), abs(location) + 1000 * maths.pi
+    if code == KERNEL_EXPONENTIAL:
+        rate = parameters[0]
+        return (lambda x: np.where(x > 0, 1 - np.exp(-rate * np.maximum(x, 0)), 0)), 40 / rate
+    raise ValueError("Heading distributions need built in distributions (fixed, uniform, normal, cauchy, "
+                     "exponential or numeric pmf)")
+
+#probability of a turn landing in each bin, for bins of width 2pi / num_bins
+#centred on multiples of the width. absolute = True gives the distribution of |turn|
+def turn_bins(dist, num_bins, absolute = False):
+    width = 2*maths.pi / num_bins
+    masses = point_masses(dist)
+    if masses is not None:
+        values, probabilities = masses
+        if absolute:
+            values = np.abs(values)
+        #each point mass is shared linearly between its two nearest bins
+        position = values / width
+        lower = np.floor(position)
+        upper_share = position - lower
+        bins = np.zeros(num_bins)
+        np.add.at(bins, lower.astype(int) % num_bins, probabilities * (1 - upper_share))
+        np.add.at(bins, (lower.astype(int) + 1) % num_bins, probabilities * upper_share)
+        return bins
+
+    cdf, reach = continuous_cdf(dist)
+    if absolute:
+        signed = cdf
+        cdf = lambda x: np.where(x > 0, signed(np.maximum(x, 0)) - signed(-np.maximum(x, 0)), 0)
+    #bin edges covering whole turns either side of the range, folded onto one turn
+    turns = maths.ceil(reach / (2*maths.pi)) + 1
+    edges = width * (np.arange(-turns * num_bins, turns * num_bins + 1) - 0.5)
+    bins = np.diff(cdf(edges)).reshape(-1, num_bins).sum(axis = 0)
+    return bins / bins.sum()
+
+#matrix taking a density over bins to the density after turning by the bin probabilities
+def circulant(bins):
+    num_bins = len(bins)
+    offsets = (np.arange(num_bins)[:, None] - np.arange(num_bins)[None, :]) % num_bins
+    return bins[offsets]
+
+"""
+2: Step and branching operators, and their stationary and transient distributions
+"""
+#the step and branching operators of a BranchingRandomWalk, on num_bins headings.
+#guidance_scale is the guidance strength scaler of barw.py
+def heading_operators(simulation, num_bins, guidance_scale):
+    angle = getattr(simulation.guidance_angle, "value", None)
+    strength = getattr(simulation.guidance_strength, "value", None)
+    if angle == None or strength == None:
+        raise ValueError("Heading distributions need constant guidance_angle and guidance_strength")
+
+    if simulation.branch_prob != None:
+        branch_prob = simulation.branch_prob
+    else:
+        code, parameters = getattr(simulation.branch_waiting_dist, "kernel", (None, None))
+        if code != KERNEL_EXPONENTIAL:
+            raise ValueError("Heading distributions need branch_prob to be a probability or exponential(...)")
+        branch_prob = 1 - maths.exp(-parameters[0])
+
+    width = 2*maths.pi / num_bins
+    headings = width * np.arange(num_bins)
+    #the drift moves each bin deterministically, split between the two nearest bins
+    drifted = (headings - guidance_scale * strength * np.sin(headings - angle)) / width
+    lower = np.floor(drifted)
+    upper_share = drifted - lower
+    drift = np.zeros((num_bins, num_bins))
+    columns = np.arange(num_bins)
+    np.add.at(drift, (lower.astype(int) % num_bins, columns), 1 - upper_share)
+    np.add.at(drift, ((lower.astype(int) + 1) % num_bins, columns), upper_share)
+    step = circulant(turn_bins(simulation.angle_dist, num_bins)) @ drift
+
+    children = turn_bins(simulation.branch_angle_dist, num_bins, absolute = True)
+    branch = circulant(children) + circulant(np.roll(children[::-1], 1))
+    branching = (1 - branch_prob) * np.eye(num_bins) + branch_prob * branch
+    return headings, step, branching
+
+#stationary density of the headings of the points of a BARW, at the num_bins bin
+#centres, normalised as a probability density on [0, 2pi)
+def stationary_heading(simulation, guidance_scale, num_bins = 360):
+    headings, step, branching = heading_operators(simulation, num_bins, guidance_scale)
+    values, vectors = np.linalg.eig(step @ branching)
+    leading = np.abs(vectors[:, np.argmax(values.real)].real)
+    return headings, leading / (leading.sum() * 2*maths.pi / num_bins)
+
+#densities of the headings of the points laid down in each of the first num_steps
+#iterations, from a single walker starting at initial_angle, as a (num_steps, num_bins)
+#array, plus the expected number of points laid down in each iteration
+def transient_heading(simulation, num_steps, guidance_scale, initial_angle = 0, num_bins = 360):
+    headings, step, branching = heading_operators(simulation, num_bins, guidance_scale)
+    start = np.zeros(num_bins)
+    start[round(initial_angle / (2*maths.pi / num_bins)) % num_bins] = 1
+    recorded = step @ start
+    densities = np.zeros((num_steps, num_bins))
+    counts = np.zeros(num_steps)
+    for t in range(num_steps):
+        counts[t] = recorded.sum()
+        densities[t] = recorded / (counts[t] * 2*maths.pi / num_bins)
+        recorded = step @ (branching @ recorded)
+    return headings, densities, counts
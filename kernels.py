@@ -0,0 +1,324 @@
+"""
+Optional compiled backend for the sequential BARW engines
+
+The sequential engines move one walker at a time, so every walker sees the
+points laid down by the walkers that moved before it in the same iteration.
+This does not vectorise, so instead the whole step / annihilate / branch loop is
+compiled with Numba here, working on flat arrays, and the result is loaded back
+into a WalkerState to give the usual walker_dict.
+
+The kernel only knows the built in distributions (fixed, uniform, exponential,
+normal, cauchy and numeric pmfs), through their .kernel attribute, constant
+guidance fields made by aux.constant, and searching by brute force or a grid.
+supports(simulation, search) says whether a simulation can be run by the kernel.
+When Numba is not installed, or the simulation is not supported,
+BranchingRandomWalk falls back to its pure python / numpy engines, so
+backend = "numba" is always safe to ask for.
+
+Random numbers come from the simulation's numpy Generator, so seeded runs are
+reproducible, but they are drawn in a different order from the python engines
+and so give different (equally distributed) walks for the same seed
+"""
+import math as maths
+import numpy as np
+
+import aux
+from distributions import KERNEL_FIXED, KERNEL_UNIFORM, KERNEL_EXPONENTIAL, KERNEL_NORMAL, KERNEL_CAUCHY
+from storage import WalkerState
+
+try:
+    import numba
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+#compiles f when numba is installed, otherwise leaves it as plain (unused) python
+def jit(f):
+    if AVAILABLE:
+        return numba.njit(cache = True)(f)
+    return f
+
+#columns of the flat walker and point arrays used inside the kernel
+X, Y, ANGLE, START_X, START_Y, START_ANGLE = range(6)
+ITERATION, PARENT, SIBLING, BRANCH_TIME, ALIVE = range(5)
+WALKER, POINT_ITERATION, NEXT = range(3)
+
+#number of buckets in the hashed grid, a power of 2
+GRID_BUCKETS = 1 << 16
+
+"""
+1: Compiled helpers
+"""
+#one sample of a built in distribution, given by its kernel code and parameters
+@jit
+def draw(code, parameters, rng):
+    if code == KERNEL_FIXED:
+        return parameters[0]
+    if code == KERNEL_UNIFORM:
+        return parameters[0] + (parameters[1] - parameters[0]) * rng.random()
+    if code == KERNEL_EXPONENTIAL:
+        return - np.log(1 - rng.random()) / parameters[0]
+    if code == KERNEL_NORMAL:
+        return rng.normal(parameters[0], parameters[1])
+    if code == KERNEL_CAUCHY:
+        return parameters[1] * np.tan(np.pi * (rng.random() - 0.5)) + parameters[0]
+    #pmf, parameters are the m values followed by the m-1 inner cumulative bounds
+    m = (len(parameters) + 1) // 2
+    return parameters[np.searchsorted(parameters[m:], rng.random())]
+
+#copy of a 2d array with double the rows, keeping the first size rows
+@jit
+def grown(array, size):
+    new_array = np.empty((2 * array.shape[0], array.shape[1]), dtype = array.dtype)
+    new_array[:size] = array[:size]
+    return new_array
+
+#bucket of the hashed grid holding cell (cx, cy). Different cells can share a
+#bucket, which only adds candidates, as every candidate is distance tested
+@jit
+def bucket(cx, cy):
+    return ((cx * 73856093) ^ (cy * 19349663)) & (GRID_BUCKETS - 1)
+
+"""
+2: The sequential BARW kernel
+
+Follows __get_barw_prob (by_time False), __get_barw_dist (by_time True) and
+get_multi_barw (by_time True, inclusive True, where walkers also step on the
+iteration they branch). Returns the filled walker and point arrays
+"""
+@jit
+def barw_kernel(num_steps, radius, somas, soma_angles, soma_times, by_time, inclusive,
+                branch_prob, guidance, history, angle_dist, step_dist, branch_dist,
+                waiting_dist, use_grid, rng):
+    guidance_angle, guidance_strength = guidance[0], guidance[1]
+    angle_code, angle_parameters = angle_dist
+    step_code, step_parameters = step_dist
+    branch_code, branch_parameters = branch_dist
+    waiting_code, waiting_parameters = waiting_dist
+    radius_squared = radius * radius
+    cell_size = radius * (1 + 1e-9)
+    two_pi = 2 * maths.pi
+
+    num_somas = len(somas)
+    walker_float = np.empty((max(64, 2 * num_somas), 6))
+    walker_int = np.empty((max(64, 2 * num_somas), 5), dtype = np.int64)
+    lineage = np.empty((max(64, 2 * num_somas), 8), dtype = np.int64)
+    point_float = np.empty((1024, 3))
+    point_int = np.empty((1024, 3), dtype = np.int64)
+    heads = np.full(GRID_BUCKETS, -1, dtype = np.int64)
+    num_walkers = 0
+    num_points = 0
+
+    #the somas log their starting points, children start on their parent's tip
+    active = []
+    for s in range(num_somas):
+        angle = soma_angles[s] % two_pi
+        walker_float[s] = (somas[s, 0], somas[s, 1], angle, somas[s, 0], somas[s, 1], angle)
+        walker_int[s] = (0, -1, -1, soma_times[s], 1)
+        lineage[s] = (-1, -1, -1, -1, 0, 0, 0, 0)
+        point_float[num_points] = (somas[s, 0], somas[s, 1], angle)
+        point_int[num_points] = (s, 0, -1)
+        if use_grid:
+            b = bucket(maths.floor(somas[s, 0] / cell_size), maths.floor(somas[s, 1] / cell_size))
+            point_int[num_points, NEXT] = heads[b]
+            heads[b] = num_points
+        num_points += 1
+        active.append(s)
+    num_walkers = num_somas
+
+    iteration = 1
+    while iteration < num_steps:
+        new_branches = []
+        still_active = []
+        for i in active:
+            x, y = walker_float[i, X], walker_float[i, Y]
+            walker_iter = walker_int[i, ITERATION]
+            young = walker_iter < history + 1
+
+            #annihilation test against every stored point, or those in the 3x3 cells around the tip
+            annihilated = False
+            cx, cy = maths.floor(x / cell_size), maths.floor(y / cell_size)
+            for cell in range(9 if use_grid else 1):
+                if use_grid:
+                    j = heads[bucket(cx + cell // 3 - 1, cy + cell % 3 - 1)]
+                else:
+                    j = 0
+                while (j >= 0) if use_grid else (j < num_points):
+                    dx, dy = point_float[j, X] - x, point_float[j, Y] - y
+                    distance_squared = dx * dx + dy * dy
+                    point_walker = point_int[j, WALKER]
+                    point_iter = point_int[j, POINT_ITERATION]
+                    j = point_int[j, NEXT] if use_grid else j + 1
+
+                    if distance_squared >= radius_squared or distance_squared < 1e-9:
+                        continue
+                    #ignore the walker's own recent past
+                    if point_walker == i and point_iter >= walker_iter - history:
+                        continue
+                    #ignore the ends of closely related branches while young
+                    ignored = False
+                    if young:
+                        for w in range(4):
+                            if lineage[i, w] == point_walker:
+                                if w < 2 and point_iter >= lineage[i, 4 + w] + walker_iter:
+                                    ignored = True
+                                if w >= 2 and point_iter <= lineage[i, 4 + w]:
+                                    ignored = True
+                    if not ignored:
+                        annihilated = True
+                        break
+                if annihilated:
+                    break
+
+            if annihilated:
+                walker_int[i, ALIVE] = 0
+                continue
+
+            if by_time:
+                if inclusive:
+                    moves = walker_iter <= walker_int[i, BRANCH_TIME]
+                else:
+                    moves = walker_iter < walker_int[i, BRANCH_TIME]
+            else:
+                moves = True
+
+            #rotate and move the tip, logging the new point
+            if moves:
+                angle = walker_float[i, ANGLE]
+                turn = - guidance_strength * maths.sin(angle - guidance_angle)
+                turn += draw(angle_code, angle_parameters, rng)
+                angle = (angle + turn) % two_pi
+                distance = draw(step_code, step_parameters, rng)
+                x = distance * maths.cos(angle) + x
+                y = distance * maths.sin(angle) + y
+                walker_iter += 1
+                walker_float[i, X], walker_float[i, Y], walker_float[i, ANGLE] = x, y, angle
+                walker_int[i, ITERATION] = walker_iter
+
+                if num_points == len(point_int):
+                    point_float = grown(point_float, num_points)
+                    point_int = grown(point_int, num_points)
+                point_float[num_points] = (x, y, angle)
+                point_int[num_points] = (i, walker_iter, -1)
+                if use_grid:
+                    b = bucket(maths.floor(x / cell_size), maths.floor(y / cell_size))
+                    point_int[num_points, NEXT] = heads[b]
+                    heads[b] = num_points
+                num_points += 1
+
+            if by_time:
+                branches = walker_iter >= walker_int[i, BRANCH_TIME]
+            else:
+                branches = rng.random() <= branch_prob
+            if not branches:
+                still_active.append(i)
+                continue
+            walker_int[i, ALIVE] = 0
+            new_branches.append(i)
+
+        #two children per branching walker, with consecutive ids
+        for parent in new_branches:
+            if num_walkers + 2 > len(walker_int):
+                walker_float = grown(walker_float, num_walkers)
+                walker_int = grown(walker_int, num_walkers)
+                lineage = grown(lineage, num_walkers)
+            angle1 = abs(draw(branch_code, branch_parameters, rng))
+            angle2 = abs(draw(branch_code, branch_parameters, rng))
+            time1 = time2 = -1
+            if by_time:
+                time1 = maths.ceil(draw(waiting_code, waiting_parameters, rng))
+                time2 = maths.ceil(draw(waiting_code, waiting_parameters, rng))
+
+            #exclusion windows, as in aux.exclusion_windows
+            p_len = walker_int[parent, ITERATION] + 1
+            grandparent = walker_int[parent, PARENT]
+            gp_len = 0
+            grandparent_window = -1
+            uncle_window = -1
+            if grandparent >= 0:
+                gp_len = walker_int[grandparent, ITERATION] + 1
+                if p_len < history:
+                    grandparent_window = grandparent
+                    uncle_window = walker_int[parent, SIBLING]
+
+            x, y, angle = walker_float[parent, X], walker_float[parent, Y], walker_float[parent, ANGLE]
+            for c in range(2):
+                child = num_walkers + c
+                child_angle = (angle + angle1 if c == 0 else angle - angle2) % two_pi
+                walker_float[child] = (x, y, child_angle, x, y, child_angle)
+                walker_int[child] = (0, parent, num_walkers + 1 - c, time1 if c == 0 else time2, 1)
+                lineage[child] = (parent, grandparent_window, num_walkers + 1 - c, uncle_window,
+                                  p_len - history, gp_len - history + p_len, history, history)
+                still_active.append(child)
+            num_walkers += 2
+
+        active = still_active
+        iteration += 1
+
+    return (walker_float[:num_walkers], walker_int[:num_walkers],
+            point_float[:num_points], point_int[:num_points])
+
+"""
+3: Running a simulation through the kernel
+"""
+#(code, parameters) of a distribution for the kernel, or None if it has none
+def kernel_spec(dist):
+    return getattr(dist, "kernel", None)
+
+#whether the kernel can run the sequential engines of a BranchingRandomWalk.
+#The kernel only runs in unbounded space without obstacles
+def supports(simulation, search = "brute"):
+    if not AVAILABLE or search not in ["brute", "grid"]:
+        return False
+    if getattr(simulation, "domain", None) != None or getattr(simulation, "obstacles", None) != None:
+        return False
+    dists = [simulation.angle_dist, simulation.step_dist, simulation.branch_angle_dist]
+    if simulation.branch_waiting_dist != None:
+        dists.append(simulation.branch_waiting_dist)
+    if any(kernel_spec(dist) == None for dist in dists):
+        return False
+    return hasattr(simulation.guidance_angle, "value") and hasattr(simulation.guidance_strength, "value")
+
+#runs the sequential BARW of simulation from the given somas through the kernel,
+#returning the walker_dict. guidance_scale is the guidance strength scaler of barw.py
+def run_barw(simulation, num_steps, radius, somas, soma_angles, search, guidance_scale, inclusive = False):
+    if search not in ["brute", "grid"]:
+        raise ValueError(f"The kernel has no '{search}' search, use 'brute' or 'grid'")
+    num_somas = len(somas)
+    by_time = simulation.branch_prob == None
+
+    no_dist = (KERNEL_FIXED, np.zeros(1))
+    waiting_dist = no_dist
+    soma_times = np.full(num_somas, -1, dtype = np.int64)
+    if by_time:
+        waiting_dist = kernel_spec(simulation.branch_waiting_dist)
+        soma_times[:] = [maths.ceil(simulation.draw_waiting()) for _ in range(num_somas)]
+    guidance = np.array([simulation.guidance_angle.value,
+                         guidance_scale * simulation.guidance_strength.value], dtype = float)
+
+    walker_float, walker_int, point_float, point_int = barw_kernel(
+        num_steps, float(radius),
+        np.array(somas, dtype = float).reshape(num_somas, 2),
+        np.array(soma_angles, dtype = float),
+        soma_times, by_time, inclusive,
+        float(simulation.branch_prob) if not by_time else 0.0,
+        guidance, aux.k,
+        kernel_spec(simulation.angle_dist),
+        kernel_spec(simulation.step_dist),
+        kernel_spec(simulation.branch_angle_dist),
+        waiting_dist, search == "grid", simulation.rng)
+
+    #load the flat arrays into a WalkerState to rebuild the walker_dict
+    size = len(walker_int)
+    state = WalkerState(branch_times = by_time, capacity = size)
+    state.size = size
+    state.x[:], state.y[:], state.angle[:] = walker_float[:, X], walker_float[:, Y], walker_float[:, ANGLE]
+    state.start_x[:], state.start_y[:] = walker_float[:, START_X], walker_float[:, START_Y]
+    state.start_angle[:] = walker_float[:, START_ANGLE]
+    state.iteration[:], state.parent[:] = walker_int[:, ITERATION], walker_int[:, PARENT]
+    state.sibling[:], state.branch_time[:] = walker_int[:, SIBLING], walker_int[:, BRANCH_TIME]
+    state.alive[:] = walker_int[:, ALIVE] == 1
+    state.sample[:] = 0
+    state.points.extend(point_float[:, :2], point_int[:, WALKER], point_int[:, POINT_ITERATION],
+                        point_float[:, 2])
+    return state.to_dict()
@@ -0,0 +1,242 @@
+"""
+Branching annihilating random walks on a lattice
+
+Walkers live on the integer sites of a square or hexagonal lattice, and each
+step moves a walker to a neighbouring site, turning it by a whole number of
+lattice directions drawn from turn_dist. Occupancy is kept in a hash map from
+sites to every (walker, iteration) that reached them, so an annihilation check
+is a constant number of lookups, one per site within the radius, however long
+the simulation runs. The walkers of each site are needed to apply the same own
+past and relatives exclusions as the continuous simulations, where a site counts
+when any of its visits isn't excluded, as every stored point does there.
+
+Sites are given in lattice coordinates, (i, j) on the square lattice and axial
+(q, r) on the hexagonal one, where direction d points at angle d * 2pi / n for
+n directions. The output is the usual walker_dict, with Cartesian positions, so
+it can be passed straight to WalkData
+"""
+
+import math as maths
+import numpy as np
+
+import aux
+from distributions import exponential, fixed, pmf, uniform, Seeded
+from storage import WalkerState
+
+"""
+1: Lattice geometries
+"""
+#steps to the neighbouring sites in direction order, and the Cartesian basis vectors
+LATTICES = {
+    "square": ([(1, 0), (0, 1), (-1, 0), (0, -1)],
+               ((1, 0), (0, 1))),
+    "hex": ([(1, 0), (0, 1), (-1, 1), (-1, 0), (0, -1), (1, -1)],
+            ((1, 0), (0.5, maths.sqrt(3) / 2))),
+}
+
+def lattice_geometry(lattice):
+    if lattice not in LATTICES:
+        raise ValueError(f"Unknown lattice '{lattice}', use 'square' or 'hex'")
+    return LATTICES[lattice]
+
+#offsets of every site closer than radius lattice spacings to a site, including the
+#site itself. With radius 1 that is only the site itself, so walkers annihilate on
+#stepping onto a site that was already reached
+def neighbourhood(lattice, radius):
+    (ax, ay), (bx, by) = lattice_geometry(lattice)[1]
+    n = maths.ceil(2 * radius) + 1
+    offsets = []
+    for i in range(-n, n + 1):
+        for j in range(-n, n + 1):
+            x, y = i * ax + j * bx, i * ay + j * by
+            if x*x + y*y < radius * radius - 1e-9:
+                offsets.append((i, j))
+    return offsets
+
+"""
+2: Lattice BARW
+"""
+#the tips of one run: the site and direction of every walker, its exclusion
+#windows, and the (walker, iteration) of every visit to each reached site
+class LatticeTips:
+    def __init__(self):
+        self.sites = []
+        self.headings = []
+        self.windows = []
+        self.occupied = {}
+
+    #records that walker i reached site at iteration
+    def visit(self, site, i, iteration):
+        self.occupied.setdefault(site, []).append((i, iteration))
+
+class LatticeBranchingRandomWalk(Seeded):
+    #distributions drawn from, and the names of their block buffered copies (see Seeded)
+    draws = {"turn_dist": "draw_turn", "branch_turn_dist": "draw_branch_turn", "branch_waiting_dist": "draw_waiting",
+             "initial_pos_dist": "draw_initial_pos", "initial_direction_dist": "draw_initial_direction"}
+
+    #turn_dist and branch_turn_dist give whole numbers of directions, turn_dist
+    #defaults to going straight on with probability 2/3, and otherwise turning one
+    #direction either way. Children turn |branch turn| directions either side of
+    #their parent. branch_prob is a probability per step, or a distribution of
+    #waiting times, as for BranchingRandomWalk. initial_pos_dist gives Cartesian
+    #positions, rounded to the nearest site, and initial_direction_dist defaults to
+    #a uniformly random direction
+    def __init__(self,
+                 lattice = "square",
+                 turn_dist = pmf({-1:1, 0:4, 1:1}),
+                 branch_prob = exponential(1/15),
+                 branch_turn_dist = fixed(1),
+                 initial_pos_dist = uniform(-5,5),
+                 initial_direction_dist = None,
+                 seed = None):
+
+        self.lattice = lattice
+        self.directions, self.basis = lattice_geometry(lattice)
+        self.num_directions = len(self.directions)
+        self.dimension = 2
+        self.turn_dist = turn_dist
+
+        if type(branch_prob) in [float, int]:
+            self.branch_prob = branch_prob
+            self.branch_waiting_dist = None
+        else:
+            self.branch_waiting_dist = branch_prob
+            self.branch_prob = None
+
+        self.branch_turn_dist = branch_turn_dist
+        self.initial_pos_dist = initial_pos_dist
+        if initial_direction_dist == None:
+            initial_direction_dist = pmf({d:1 for d in range(self.num_directions)})
+        self.initial_direction_dist = initial_direction_dist
+
+        self.reseed(seed)
+
+    #Cartesian position of a site
+    def position(self, site):
+        (ax, ay), (bx, by) = self.basis
+        return (site[0] * ax + site[1] * bx, site[0] * ay + site[1] * by)
+
+    #nearest site to a Cartesian position
+    def nearest_site(self, position):
+        (ax, ay), (bx, by) = self.basis
+        j = round(position[1] / by)
+        i = round((position[0] - j * bx) / ax)
+        #the hexagonal lattice's nearest site can be the next one along a diagonal
+        candidates = [(i + di, j + dj) for di in (-1, 0, 1) for dj in (-1, 0, 1)]
+        return min(candidates, key = lambda site: maths.dist(self.position(site), position))
+
+    #performs a lattice BARW from initial_site facing initial_direction, returning the
+    #walker_dict. Walkers are annihilated when any site closer than radius lattice
+    #spacings to their tip was reached before, ignoring their own recent past and
+    #the ends of closely related branches as in BranchingRandomWalk
+    def get_barw(self, num_steps, radius = 1, initial_site = (0,0), initial_direction = 0):
+        return self.__run(num_steps, radius, [tuple(initial_site)], [initial_direction])
+
+    #num_walkers lattice BARWs from initial_pos_dist / initial_direction_dist, all annihilating together
+    def get_multi_barw(self, num_steps, num_walkers, radius = 1):
+        sites, directions = [], []
+        for _ in range(num_walkers):
+            x = self.draw_initial_pos()
+            position = x if type(x) == tuple else (x, self.draw_initial_pos())
+            sites.append(self.nearest_site(position))
+            directions.append(int(self.draw_initial_direction()))
+        return self.__run(num_steps, radius, sites, directions)
+
+    #the sequential engine, moving walkers one at a time like BranchingRandomWalk.
+    #tips (see LatticeTips) holds the lattice state of this run alongside the WalkerState
+    def __run(self, num_steps, radius, somas, soma_directions):
+        by_time = self.branch_prob == None
+        state = WalkerState(branch_times = by_time)
+        tips = LatticeTips()
+        offsets = neighbourhood(self.lattice, radius)
+
+        for site, direction in zip(somas, soma_directions):
+            i = self.__add_branch(state, tips, site, direction % self.num_directions)
+            tips.visit(site, i, 0)
+        active = list(range(len(somas)))
+
+        iteration = 1
+        while iteration < num_steps:
+            new_branches = []
+            still_active = []
+            for i in active:
+                #annihilate walkers that come too close to an existing duct
+                if self.__annihilated(i, state, tips, offsets):
+                    state.alive[i] = False
+                    continue
+
+                if by_time:
+                    if state.iteration[i] < state.branch_time[i]:
+                        self.__step(i, state, tips)
+                    if state.iteration[i] < state.branch_time[i]:
+                        still_active.append(i)
+                        continue
+                else:
+                    self.__step(i, state, tips)
+                    if self.draw_uniform() > self.branch_prob:
+                        still_active.append(i)
+                        continue
+
+                state.alive[i] = False
+                new_branches.append(i)
+
+            #after one full loop, create all new branched particles together
+            for parent_id in new_branches:
+                still_active.extend(self.__branch(parent_id, state, tips))
+            active = still_active
+            iteration += 1
+
+        return state.to_dict()
+
+    def __add_branch(self, state, tips, site, direction, parent = -1, sibling = -1):
+        branch_time = -1
+        if self.branch_prob == None:
+            branch_time = maths.ceil(self.draw_waiting())
+        i = state.add_branch(self.position(site), direction * 2*maths.pi / self.num_directions,
+                             parent, sibling, branch_time)
+        tips.sites.append(site)
+        tips.headings.append(direction)
+        #the walker's 4 exclusion windows, as (branch id, bound, is a parent window)
+        tips.windows.append([(w, b, j < 2) for j, (w, b) in enumerate(zip(state.lineage_id[i].tolist(),
+                                                                          state.lineage_bound[i].tolist()))
+                             if w >= 0])
+        return i
+
+    #turns walker i and moves it to the neighbouring site it then faces
+    def __step(self, i, state, tips):
+        direction = (tips.headings[i] + int(self.draw_turn())) % self.num_directions
+        di, dj = self.directions[direction]
+        site = (tips.sites[i][0] + di, tips.sites[i][1] + dj)
+        tips.sites[i] = site
+        tips.headings[i] = direction
+        state.advance(i, *self.position(site), direction * 2*maths.pi / self.num_directions)
+        tips.visit(site, i, state.iteration.item(i))
+
+    #creates the two children of walker parent_id on its site, returning their ids
+    def __branch(self, parent_id, state, tips):
+        size = state.size
+        site, direction = tips.sites[parent_id], tips.headings[parent_id]
+        turn1 = abs(int(self.draw_branch_turn()))
+        turn2 = abs(int(self.draw_branch_turn()))
+        self.__add_branch(state, tips, site, (direction + turn1) % self.num_directions, parent_id, size + 1)
+        self.__add_branch(state, tips, site, (direction - turn2) % self.num_directions, parent_id, size)
+        return [size, size + 1]
+
+    #whether any site within the radius of walker i's tip had a visit it can
+    #annihilate on, with the exclusions of BranchingRandomWalk's pair mask
+    def __annihilated(self, i, state, tips, offsets):
+        history = aux.k
+        walker_iter = state.iteration.item(i)
+        young = walker_iter < history + 1
+        site_i, site_j = tips.sites[i]
+        occupied = tips.occupied
+        windows = tips.windows[i]
+        for di, dj in offsets:
+            for walker, point_iter in occupied.get((site_i + di, site_j + dj), ()):
+                if walker == i and point_iter >= walker_iter - history:
+                    continue
+                if young and any(walker == w and (point_iter >= bound + walker_iter if parent_window else point_iter <= bound)
+                                 for w, bound, parent_window in windows):
+                    continue
+                return True
+        return False
@@ -0,0 +1,170 @@
+"""
+Obstacles from image masks
+
+Walkers can arrest on, or be kept out of, regions such as tissue boundaries
+given by a mask, a numpy array or an image file (.npy, or a PNG read by
+matplotlib), laid over an extent as an image: row 0 is the top (largest y) and
+column 0 the left (smallest x). Pixels that are non zero (for images, brighter
+than threshold) are obstacles, or the others with invert = True.
+
+Rather than testing walkers against the shapes of the obstacles, the signed
+distance from every pixel to the nearest obstacle boundary (positive outside
+obstacles, negative inside) and its gradient, the normal pointing away from the
+obstacles, are computed once by a Euclidean distance transform. They are cached
+on disk as .npy files named by a hash of the mask and extent, so later runs and
+other processes with the same mask skip the transform and map the same files.
+Lookups are then bilinear interpolations of the grids (see raster.py), for one
+walker or arrays of them.
+
+A walker whose step ends less than margin from an obstacle either
+    "reflect"  is reflected back out off the boundary, with its heading mirrored
+               in it, staying where it was if the reflection is still too close
+    "arrest"   stops there, like leaving an absorbing domain, without logging
+               the step
+Steps are only tested at their ends, so obstacles should be thicker than the
+steps. With avoidance > 0, walkers within avoidance_range of the margin also
+turn away from obstacles like guidance, with strength avoidance at the margin
+falling linearly to 0 at avoidance_range.
+
+In a periodic domain, given as the extent, the transform wraps round the box.
+Outside a non periodic extent lookups take the values at its edge, so the extent
+should cover the walks. The simulations take Obstacles as obstacles = ..., in two
+dimensions
+"""
+import hashlib
+import math as maths
+import os
+import tempfile
+import numpy as np
+import scipy.ndimage as ndimage
+
+import raster
+
+BOUNDARIES = ["reflect", "arrest"]
+
+"""
+1: Masks and their distance transforms
+"""
+#a mask of obstacle pixels from an array, a .npy file or an image file
+def load_mask(source, threshold = 0.5, invert = False):
+    if isinstance(source, (str, os.PathLike)):
+        if str(source).endswith(".npy"):
+            source = np.load(source)
+        else:
+            import matplotlib.image
+            image = matplotlib.image.imread(source)
+            #greyscale from the colour channels, ignoring any alpha channel
+            source = image[..., :3].mean(axis = -1) if image.ndim == 3 else image
+            source = source > threshold
+    mask = np.asarray(source) != 0
+    if mask.ndim != 2:
+        raise ValueError(f"An obstacle mask is a 2D array or image, not an array of shape {mask.shape}")
+    return ~mask if invert else mask
+
+#the persistent directory the distance transforms are cached in
+def cache_directory():
+    directory = os.path.join(tempfile.gettempdir(), "randomwalk-obstacles")
+    os.makedirs(directory, exist_ok = True)
+    return directory
+
+#signed distance from each pixel centre of a grid of obstacle pixels (indexed
+#[x, y]) to the nearest obstacle boundary, half way between pixels, as (nx, ny, 1),
+#and its gradient as (nx, ny, 2). Periodic grids are transformed tiled 3 x 3
+def distance_transform(grid, spacing, periodic = False):
+    if not np.any(grid):
+        raise ValueError("An obstacle mask needs at least one obstacle pixel")
+    if np.all(grid):
+        raise ValueError("An obstacle mask can't be all obstacle")
+    tiled = np.tile(grid, (3, 3)) if periodic else grid
+    outside = ndimage.distance_transform_edt(~tiled, sampling = spacing)
+    inside = ndimage.distance_transform_edt(tiled, sampling = spacing)
+    distance = np.where(tiled, -inside, outside) - np.where(tiled, -1, 1) * spacing.min() / 2
+    if periodic:
+        nx, ny = grid.shape
+        distance = distance[nx:2 * nx, ny:2 * ny]
+        gradient = [(np.roll(distance, -1, axis) - np.roll(distance, 1, axis)) / (2 * spacing[axis])
+                    for axis in [0, 1]]
+    else:
+        gradient = np.gradient(distance, *spacing)
+    return distance[..., None], np.stack(gradient, axis = -1)
+
+"""
+2: Obstacles for the simulations
+"""
+class Obstacles:
+    def __init__(self, mask, extent, boundary = "reflect", margin = 0, avoidance = 0, avoidance_range = 1,
+                 threshold = 0.5, invert = False, directory = None):
+        if boundary not in BOUNDARIES:
+            raise ValueError(f"Unknown boundary '{boundary}', use 'reflect' or 'arrest'")
+        self.boundary = boundary
+        self.margin = margin
+        self.avoidance = avoidance
+        self.avoidance_range = avoidance_range
+
+        #the image is turned into a grid indexed [x, y], with nodes at the pixel centres
+        grid = load_mask(mask, threshold, invert)[::-1].T
+        bounds, periodic = raster.extent_bounds(extent)
+        spacing = np.array([(high - low) / n for (low, high), n in zip(bounds, grid.shape)])
+        lower = np.array([low for low, high in bounds]) + spacing / 2
+
+        key = hashlib.sha1(np.packbits(grid).tobytes() + repr((grid.shape, bounds, periodic)).encode()).hexdigest()
+        directory = cache_directory() if directory == None else directory
+        distance_path = os.path.join(directory, f"obstacles-{key}-distance.npy")
+        normal_path = os.path.join(directory, f"obstacles-{key}-normal.npy")
+        if not (os.path.exists(distance_path) and os.path.exists(normal_path)):
+            distance, normal = distance_transform(grid, spacing, periodic)
+            #written under another name first, so other processes never map half a file
+            for path, values in [(distance_path, distance), (normal_path, normal)]:
+                partial = f"{path[:-4]}-{os.getpid()}.npy"
+                np.save(partial, values)
+                os.replace(partial, path)
+
+        #signed distance, and the angle of the normal pointing away from the obstacles
+        self.distance = raster.RasterField(distance_path, lower, spacing, False, periodic)
+        self.normal = raster.RasterField(normal_path, lower, spacing, True, periodic)
+
+    #moves a walker that has just stepped from (x0, y0) to (x, y) facing angle out
+    #of the obstacles, returning the new (x, y, angle), or None if it was arrested
+    def move(self, x0, y0, x, y, angle):
+        distance = self.distance(x, y)
+        if distance >= self.margin:
+            return x, y, angle
+        if self.boundary == "arrest":
+            return None
+        normal = self.normal(x, y)
+        depth = self.margin - distance
+        x, y = x + 2 * depth * maths.cos(normal), y + 2 * depth * maths.sin(normal)
+        #the heading loses and regains its component along the normal
+        angle = (2 * normal + maths.pi - angle) % (2*maths.pi)
+        if self.distance(x, y) < self.margin:
+            x, y = x0, y0
+        return x, y, angle
+
+    #vectorised move, for the steps from starts (n, 2) to positions (n, 2) facing
+    #angles (n,). Returns the new positions and angles, and a boolean array of
+    #which walkers weren't arrested
+    def move_many(self, starts, positions, angles):
+        distance = self.distance(positions[:, 0], positions[:, 1])
+        hit = distance < self.margin
+        if self.boundary == "arrest":
+            return positions, angles, ~hit
+        free = np.ones(len(positions), dtype = bool)
+        if not np.any(hit):
+            return positions, angles, free
+        positions, angles = positions.copy(), angles.copy()
+        normal = self.normal(positions[hit, 0], positions[hit, 1])
+        depth = self.margin - distance[hit]
+        reflected = positions[hit] + 2 * depth[:, None] * np.column_stack([np.cos(normal), np.sin(normal)])
+        stuck = self.distance(reflected[:, 0], reflected[:, 1]) < self.margin
+        reflected[stuck] = starts[hit][stuck]
+        positions[hit] = reflected
+        angles[hit] = np.mod(2 * normal + maths.pi - angles[hit], 2*maths.pi)
+        return positions, angles, free
+
+    #the angle away from the obstacles and the strength of the turn away from them,
+    #at single positions or arrays of them
+    def steering(self, x, y):
+        closeness = 1 - (self.distance(x, y) - self.margin) / self.avoidance_range
+        if np.ndim(closeness) == 0:
+            return self.normal(x, y), self.avoidance * min(max(closeness, 0.0), 1.0)
+        return self.normal(x, y), self.avoidance * np.clip(closeness, 0, 1)
@@ -0,0 +1,106 @@
+"""
+Exact position distributions of lattice random walks
+
+A RandomWalk whose turning angles come from a pmf over multiples of pi/2, with a
+fixed step length and no guidance, is a walk on the square lattice whose next
+step only depends on its heading. The joint probability P_n[h, x, y] of heading h
+at site (x, y) after n steps then evolves by
+
+    P_n+1[h'] = shift by step h' of  sum_h T[h', h] P_n[h]
+
+where T[h', h] is the probability of turning from heading h to h'. Rather than
+estimating the distribution from thousands of sampled walks, it can be computed
+exactly. In Fourier space the shift becomes a phase, so every wavevector evolves
+by its own 4x4 matrix M(k) = diag(phase(k)) T, and n steps are the matrix power
+M(k)^n, followed by one inverse FFT. The mean squared displacement only needs
+the mass, first and second moments of each heading, which follow the same
+recursion and give the whole MSD curve in a few milliseconds
+"""
+
+import math as maths
+import numpy as np
+
+from distributions import KERNEL_FIXED
+
+"""
+1: Checking a simulation describes a lattice walk
+"""
+#unit steps for headings 0, pi/2, pi and 3pi/2
+HEADINGS = np.array([[1, 0], [0, 1], [-1, 0], [0, -1]])
+
+#whole number of quarter turns in an angle, or None if it isn't one
+def quarter_turns(angle):
+    turns = angle / (maths.pi / 2)
+    if abs(turns - round(turns)) > 1e-9:
+        return None
+    return round(turns) % 4
+
+#the turning matrix T[h', h] and step length of a RandomWalk, raising a ValueError
+#when its walk isn't a lattice walk
+def lattice_spec(simulation):
+    turns = getattr(simulation.angle_dist, "prob_dict", None)
+    if turns == None:
+        raise ValueError("Exact propagation needs angle_dist to be a pmf")
+    step = getattr(simulation.step_dist, "kernel", None)
+    if step == None or step[0] != KERNEL_FIXED:
+        raise ValueError("Exact propagation needs step_dist to be fixed(...)")
+    if getattr(simulation.guidance_strength, "value", None) != 0:
+        raise ValueError("Exact propagation needs guidance_strength = 0")
+
+    transfer = np.zeros((4, 4))
+    for angle, probability in turns.items():
+        turn = quarter_turns(angle)
+        if turn == None:
+            raise ValueError(f"Exact propagation needs turning angles that are multiples of pi/2, not {angle}")
+        for h in range(4):
+            transfer[(h + turn) % 4, h] += probability
+    return transfer, float(step[1][0])
+
+def initial_heading(initial_angle):
+    heading = quarter_turns(initial_angle)
+    if heading == None:
+        raise ValueError(f"Exact propagation needs an initial angle that is a multiple of pi/2, not {initial_angle}")
+    return heading
+
+"""
+2: Exact distributions and mean squared displacements
+"""
+#probability of the walk being at each site after num_steps steps from the origin,
+#as a (2 num_steps + 1) square grid, with the site coordinates of its rows / columns
+#(multiplied by the step length). grid[i, j] is the probability of (coords[i], coords[j])
+def exact_distribution(simulation, num_steps, initial_angle = 0):
+    transfer, step = lattice_spec(simulation)
+    heading = initial_heading(initial_angle)
+    size = 2 * num_steps + 1
+
+    #phase of a step in each heading at every wavevector, for a grid big enough
+    #that no walk wraps round
+    k = 2*maths.pi * np.fft.fftfreq(size)
+    kx, ky = np.meshgrid(k, k, indexing = "ij")
+    phase = np.exp(-1j * (kx[..., None] * HEADINGS[:, 0] + ky[..., None] * HEADINGS[:, 1]))
+    step_matrix = phase[..., :, None] * transfer
+
+    #the transform of a point mass at the origin is 1 everywhere
+    evolved = np.linalg.matrix_power(step_matrix, num_steps)[..., :, heading]
+    grid = np.fft.ifft2(evolved.sum(axis = -1)).real
+    grid = np.fft.fftshift(np.clip(grid, 0, None))
+    coords = step * np.arange(-num_steps, num_steps + 1)
+    return grid, coords
+
+#exact mean squared distance from the start after 0, 1, ..., num_steps steps,
+#from the mass, first and second moments of each heading
+def exact_msd(simulation, num_steps, initial_angle = 0):
+    transfer, step = lattice_spec(simulation)
+    mass = np.zeros(4)
+    mass[initial_heading(initial_angle)] = 1
+    first = np.zeros((4, 2))
+    second = np.zeros(4)
+
+    msd = np.zeros(num_steps + 1)
+    for n in range(1, num_steps + 1):
+        mass, turned_first, second = transfer @ mass, transfer @ first, transfer @ second
+        #after turning, every walk with heading h moves by HEADINGS[h]
+        second = second + 2 * np.einsum('ij,ij->i', turned_first, HEADINGS) + mass
+        first = turned_first + mass[:, None] * HEADINGS
+        msd[n] = second.sum()
+    return step * step * msd
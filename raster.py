@@ -0,0 +1,203 @@
+"""
+Rasterised guidance fields
+
+Guidance fields are python functions of (x, y), called for every walker on every
+step. Fields such as aux.swirl do numpy work on every call, which is slow for the
+single positions of the sequential engines. rasterised(field, extent) samples a
+field once on a grid of nodes covering extent, and returns a field which
+interpolates the grid bilinearly, for single positions or whole arrays of them.
+
+Angle fields are sampled as the cos and sin of the angle, which are interpolated
+separately and turned back into an angle, so the jump between 2pi and 0 (eg the
+branch cut of swirl) isn't smeared across a cell. Positions outside the extent
+take the value at the nearest edge, or wrap round when the extent is a periodic
+Domain.
+
+Grids are cached by the identity of the field and the extent, resolution and
+kind of grid, so asking again (eg once per replicate of an ensemble) reuses the
+grid. Each grid is written to a .npy file and opened as a read only memory map.
+Pool workers forked by aux.run_ensemble then share its pages, and a pickled
+rasterised field only carries the path of its file, so spawned workers map the
+same file rather than copying the grid. Files go to a temporary directory removed
+when the process that made it exits, unless a directory is given
+"""
+import atexit
+import math as maths
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from aux import evaluate_field
+
+"""
+1: Interpolating a grid of samples
+"""
+class RasterField:
+    #the grid in the .npy file at path holds samples at the nodes lower + (i, j) * spacing,
+    #shape (nx, ny, 1) for values and (nx, ny, 2) for the cos and sin of angles.
+    #periodic grids wrap round after the last node
+    def __init__(self, path, lower, spacing, angle = False, periodic = False):
+        self.path = path
+        self.lower = (float(lower[0]), float(lower[1]))
+        self.spacing = (float(spacing[0]), float(spacing[1]))
+        self.angle = angle
+        self.periodic = periodic
+        self.__map()
+        self.shape = self.grid.shape[:2]
+
+    #the grid as a read only memory map, and a flat memoryview of it, whose items
+    #are python floats and are quicker to index than numpy arrays
+    def __map(self):
+        self.grid = np.load(self.path, mmap_mode = "r")
+        self.values = memoryview(self.grid.reshape(-1))
+
+    #pickles carry the path, and the grid is mapped again when unpickled
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["grid"], state["values"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__map()
+
+    def __call__(self, x, y):
+        if isinstance(x, (float, int)) and isinstance(y, (float, int)):
+            return self.__point(x, y)
+        return self.__array(np.asarray(x, dtype = float), np.asarray(y, dtype = float))
+
+    #node to the lower left of a position along one axis, and the fraction of the
+    #way to the next node. Non periodic positions are clamped onto the grid
+    def __cell(self, u, n):
+        if self.periodic:
+            u = u % n
+            i = int(u)
+            i = i if i < n else n - 1
+            return i, (i + 1) % n, u - i
+        if u <= 0:
+            return 0, 1, 0.0
+        i = int(u)
+        if i >= n - 1:
+            return n - 2, n - 1, 1.0
+        return i, i + 1, u - i
+
+    #scalar maths on python floats, much quicker than numpy for one position
+    def __point(self, x, y):
+        (nx, ny), values = self.shape, self.values
+        i0, i1, s = self.__cell((x - self.lower[0]) / self.spacing[0], nx)
+        j0, j1, t = self.__cell((y - self.lower[1]) / self.spacing[1], ny)
+        w00, w10, w01, w11 = (1 - s) * (1 - t), s * (1 - t), (1 - s) * t, s * t
+        if not self.angle:
+            return (w00 * values[i0 * ny + j0] + w10 * values[i1 * ny + j0] +
+                    w01 * values[i0 * ny + j1] + w11 * values[i1 * ny + j1])
+        #cos and sin are next to each other in the flat grid
+        k00, k10, k01, k11 = 2 * (i0 * ny + j0), 2 * (i1 * ny + j0), 2 * (i0 * ny + j1), 2 * (i1 * ny + j1)
+        cos = w00 * values[k00] + w10 * values[k10] + w01 * values[k01] + w11 * values[k11]
+        sin = w00 * values[k00 + 1] + w10 * values[k10 + 1] + w01 * values[k01 + 1] + w11 * values[k11 + 1]
+        return maths.atan2(sin, cos) % (2*maths.pi)
+
+    def __array(self, x, y):
+        values = bilinear(self.grid, self.lower, self.spacing, x, y, self.periodic)
+        if not self.angle:
+            return values[..., 0]
+        return np.mod(np.arctan2(values[..., 1], values[..., 0]), 2*maths.pi)
+
+#node below each of an array of positions along one axis of n nodes, the node
+#above, and the fraction of the way between them
+def cells(u, n, periodic = False):
+    if periodic:
+        u = np.mod(u, n)
+        i = np.minimum(u.astype(int), n - 1)
+        return i, (i + 1) % n, u - i
+    u = np.clip(u, 0, n - 1)
+    i = np.minimum(u.astype(int), n - 2)
+    return i, i + 1, u - i
+
+#bilinear interpolation of a grid (nx, ny, ...) of samples at the nodes lower +
+#(i, j) * spacing, at arrays of positions x, y, giving an array (len(x), ...)
+def bilinear(grid, lower, spacing, x, y, periodic = False):
+    i0, i1, s = cells((x - lower[0]) / spacing[0], grid.shape[0], periodic)
+    j0, j1, t = cells((y - lower[1]) / spacing[1], grid.shape[1], periodic)
+    s, t = s.reshape(s.shape + (1,) * (grid.ndim - 2)), t.reshape(t.shape + (1,) * (grid.ndim - 2))
+    return ((1 - s) * (1 - t) * grid[i0, j0] + s * (1 - t) * grid[i1, j0] +
+            (1 - s) * t * grid[i0, j1] + s * t * grid[i1, j1])
+
+"""
+2: Sampling and caching grids
+"""
+#(field, rasterised field) for every key of rasterised, keeping the fields alive
+#so that their ids can't be reused by other fields
+_rasters = {}
+_directory = None
+_saved = 0
+
+#the temporary directory the grids are written to, removed at exit by the
+#process that made it (not by forked workers)
+def cache_directory():
+    global _directory
+    if _directory == None:
+        _directory = tempfile.mkdtemp(prefix = "randomwalk-fields-")
+        owner = os.getpid()
+        atexit.register(lambda: os.getpid() == owner and shutil.rmtree(_directory, ignore_errors = True))
+    return _directory
+
+#((x_min, x_max), (y_min, y_max)) of an extent, which is either a Domain, using
+#its box, or already those bounds, and whether it is periodic
+def extent_bounds(extent):
+    periodic = getattr(extent, "periodic", False)
+    if hasattr(extent, "sizes"):
+        size = extent.sizes(2)
+        extent = ((-size[0] / 2, size[0] / 2), (-size[1] / 2, size[1] / 2))
+    bounds = tuple((float(low), float(high)) for low, high in extent)
+    if len(bounds) != 2 or any(high <= low for low, high in bounds):
+        raise ValueError(f"The extent must be a Domain or ((x_min, x_max), (y_min, y_max)), not {extent}")
+    return bounds, periodic
+
+#coordinates of the nodes along each axis of a grid over bounds, about resolution
+#apart. Periodic grids have whole cells across the box, others a node on every edge
+def grid_axes(bounds, resolution, periodic = False):
+    if resolution <= 0:
+        raise ValueError(f"The resolution must be positive, not {resolution}")
+    axes = []
+    for low, high in bounds:
+        if periodic:
+            n = max(maths.ceil((high - low) / resolution), 2)
+            axes.append(low + (high - low) * np.arange(n) / n)
+        else:
+            n = max(maths.ceil((high - low) / resolution), 1) + 1
+            axes.append(np.linspace(low, high, n))
+    return axes
+
+#the field sampled every resolution over extent, as a RasterField. extent is a
+#Domain (using its box, and wrapping round if it is periodic) or ((x_min, x_max),
+#(y_min, y_max)). angle = True for fields of angles. Constant and already
+#rasterised fields are returned unchanged. directory optionally keeps the grid
+#files somewhere other than the temporary cache directory
+def rasterised(field, extent, resolution = 0.1, angle = False, directory = None):
+    if hasattr(field, "value") or isinstance(field, RasterField):
+        return field
+    bounds, periodic = extent_bounds(extent)
+    key = (id(field), bounds, float(resolution), angle, periodic, directory)
+    if key in _rasters:
+        return _rasters[key][1]
+
+    axes = grid_axes(bounds, resolution, periodic)
+    x, y = np.meshgrid(*axes, indexing = "ij")
+    values = evaluate_field(field, x.ravel(), y.ravel()).reshape(x.shape)
+    grid = np.stack([np.cos(values), np.sin(values)], axis = -1) if angle else values[..., None]
+    spacing = [axis[1] - axis[0] for axis in axes]
+    raster = saved_grid(grid, (axes[0][0], axes[1][0]), spacing, angle, periodic, directory)
+    _rasters[key] = (field, raster)
+    return raster
+
+#a RasterField for a grid of samples made elsewhere, shaped as in RasterField.
+#angle grids may hold any vector along each angle, not just its cos and sin
+def saved_grid(grid, lower, spacing, angle = False, periodic = False, directory = None):
+    if directory == None:
+        directory = cache_directory()
+    global _saved
+    _saved += 1
+    path = os.path.join(directory, f"field-{os.getpid()}-{_saved}.npy")
+    np.save(path, np.ascontiguousarray(grid, dtype = float))
+    return RasterField(path, lower, spacing, angle, periodic)
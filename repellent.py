@@ -0,0 +1,150 @@
+"""
+Self avoidance through a secreted repellent
+
+Pairwise annihilation compares every tip with the points of the walk near it,
+so its cost grows with the history. Many models instead mean that tips avoid the
+existing ducts through a diffusible signal. A Repellent is a grid over an extent
+onto which every step of a walk deposits secretion * (step length) of repellent
+spread along the step, so a duct secretes a fixed amount per unit length. The
+ducts keep secreting, and the repellent diffuses with coefficient diffusion and
+decays, with decay_length the distance it spreads before decaying (as in
+attractant.py). Every `every` iterations the grid is smoothed by one of two
+methods:
+
+    "fft"      the steady state of everything deposited so far, solved exactly
+               by FFT (see attractant.steady_state), padding non periodic grids
+    "stencil"  the concentration is advanced `every` units of time (one per
+               iteration) by explicit five point diffusion steps, so it lags
+               behind the ducts as the signal spreads out from them, with no flux
+               out of the edges of non periodic grids. Stable steps are at most
+               spacing^2 / (4 diffusion) long, so this suits coarse grids or slow
+               diffusion
+
+Tips turn down the gradient of the concentration c, adding the drift
+-k * strength * sin(angle - angle down the gradient) to their turn, with strength
+gain * decay_length |grad c| / (c + threshold) as for chemoattractants. Tips stop,
+in place of being annihilated, when c at the point lookahead (by default one
+decay length) ahead of them is above arrest times the concentration along a long
+straight duct, secretion * decay_length / 2. A tip is always near the end of its
+own duct and, just after branching, near its parent and sibling, but these lie
+behind it, so looking ahead only picks up the ducts it is heading into. Each
+iteration then costs two lookups and a deposit per tip, and the smoothing costs
+the size of the grid rather than the number of points laid down.
+
+The extent should cover the walks, eg the box of the simulation's domain.
+Repellent isn't deposited outside a non periodic extent, and tips outside it
+sense the edge of the grid
+"""
+import math as maths
+import numpy as np
+
+import raster
+from attractant import deposit, steady_state
+
+METHODS = ["fft", "stencil"]
+
+class Repellent:
+    def __init__(self, extent, resolution = 0.25, decay_length = 2, gain = 1, threshold = 0, arrest = 0.5,
+                 lookahead = None, secretion = 1, method = "fft", every = 1, diffusion = 1):
+        if method not in METHODS:
+            raise ValueError(f"Unknown method '{method}', use 'fft' or 'stencil'")
+        if decay_length <= 0 or diffusion <= 0 or every < 1:
+            raise ValueError("A repellent needs a positive decay_length and diffusion, and every >= 1")
+        bounds, self.periodic = raster.extent_bounds(extent)
+        axes = raster.grid_axes(bounds, resolution, self.periodic)
+        self.lower = np.array([axes[0][0], axes[1][0]])
+        self.spacing = np.array([axes[0][1] - axes[0][0], axes[1][1] - axes[1][0]])
+        self.shape = (len(axes[0]), len(axes[1]))
+        self.decay_length = decay_length
+        self.gain = gain
+        self.threshold = threshold
+        self.secretion = secretion
+        self.level = arrest * secretion * decay_length / 2
+        self.lookahead = decay_length if lookahead == None else lookahead
+        self.method = method
+        self.every = every
+        self.diffusion = diffusion
+        self.reset()
+
+    #clears the grid, for starting a new simulation
+    def reset(self):
+        self.deposited = np.zeros(self.shape)
+        self.pending = np.zeros(self.shape)
+        #concentration and the two components of its gradient, looked up together
+        self.fields = np.zeros(self.shape + (3,))
+        self.iteration = 0
+
+    #deposits repellent along the steps from starts to ends (n, 2), spread over
+    #pieces of the steps at most one grid spacing long, as a point deposit would
+    #make a spike that tips sitting on it would stop on
+    def deposit(self, starts, ends):
+        steps = ends - starts
+        lengths = np.linalg.norm(steps, axis = 1)
+        pieces = np.maximum(np.ceil(lengths / self.spacing.min()), 1).astype(int)
+        step_ids = np.repeat(np.arange(len(steps)), pieces)
+        first = np.cumsum(pieces) - pieces
+        fractions = (np.arange(len(step_ids)) - first[step_ids] + 0.5) / pieces[step_ids]
+        points = starts[step_ids] + fractions[:, None] * steps[step_ids]
+        weights = self.secretion * (lengths / pieces)[step_ids]
+        self.pending += deposit(points, weights, self.lower, self.spacing, self.shape, self.periodic)
+
+    #counts an iteration, smoothing the grid every `every` iterations
+    def step(self):
+        if self.iteration % self.every == 0:
+            self.update()
+        self.iteration += 1
+
+    #adds the pending deposits to the ducts' secretion and smooths the concentration
+    def update(self):
+        self.deposited += self.pending
+        self.pending[:] = 0
+        if self.method == "fft":
+            concentration = self.__steady_state()
+        else:
+            concentration = self.__diffused(self.fields[..., 0], self.every)
+        self.fields = np.stack([concentration, *self.__gradient(concentration)], axis = -1)
+
+    def __steady_state(self):
+        if self.periodic:
+            return steady_state(self.deposited, self.spacing, self.decay_length)[0]
+        pad = np.ceil(4 * self.decay_length / self.spacing).astype(int)
+        padded = np.pad(self.deposited, ((pad[0], pad[0]), (pad[1], pad[1])))
+        concentration = steady_state(padded, self.spacing, self.decay_length)[0]
+        return concentration[pad[0]:pad[0] + self.shape[0], pad[1]:pad[1] + self.shape[1]]
+
+    #concentration advanced by time dc/dt = diffusion (lap c - c / decay_length^2 + sources),
+    #in as many explicit steps as keep it stable
+    def __diffused(self, concentration, time):
+        inverse_squares = 1 / self.spacing**2
+        rate = self.diffusion * (2 * inverse_squares.sum() + 1 / self.decay_length**2)
+        num_steps = maths.ceil(time * rate / 0.9)
+        dt = self.diffusion * time / num_steps
+        for _ in range(num_steps):
+            if self.periodic:
+                padded = np.pad(concentration, 1, mode = "wrap")
+            else:
+                padded = np.pad(concentration, 1, mode = "edge")
+            laplacian = ((padded[2:, 1:-1] - 2 * concentration + padded[:-2, 1:-1]) * inverse_squares[0] +
+                         (padded[1:-1, 2:] - 2 * concentration + padded[1:-1, :-2]) * inverse_squares[1])
+            concentration = concentration + dt * (laplacian - concentration / self.decay_length**2 + self.deposited)
+        return concentration
+
+    def __gradient(self, concentration):
+        if self.periodic:
+            return [(np.roll(concentration, -1, axis) - np.roll(concentration, 1, axis)) / (2 * self.spacing[axis])
+                    for axis in [0, 1]]
+        return np.gradient(concentration, *self.spacing)
+
+    #which tips at arrays of positions and angles sense too much repellent lookahead ahead of them
+    def arrested(self, x, y, angles):
+        ahead_x, ahead_y = x + self.lookahead * np.cos(angles), y + self.lookahead * np.sin(angles)
+        return raster.bilinear(self.fields[..., 0], self.lower, self.spacing, ahead_x, ahead_y, self.periodic) > self.level
+
+    #the angle down the gradient and the guidance strength of the repellent at arrays of positions
+    def avoidance(self, x, y):
+        c, gx, gy = raster.bilinear(self.fields, self.lower, self.spacing, x, y, self.periodic).T
+        gradient = np.hypot(gx, gy)
+        sensed = c + self.threshold
+        strength = self.gain * self.decay_length * np.divide(gradient, sensed, out = np.zeros_like(c),
+                                                             where = sensed > 0)
+        return np.arctan2(-gy, -gx), strength
@@ -1,5 +1,5 @@
 """
-Code for discrete random walks, in 1 and 2 dimensions
+Code for discrete random walks, in 2 and 3 dimensions
 
 Originally this was used as foundations for more complicated branching algorithms
 Should still be a useful testing ground to implement preliminary versions of
@@ -14,132 +14,246 @@ import math as maths
 import matplotlib.pyplot as plt
 import numpy as np
 
-from aux import Particle, mask_past, combine_masks, constant
-from distributions import pmf, uniform
+from aux import Particle, mask_past, combine_masks, segment_distance_squared
+from distributions import pmf, fixed, uniform, sample_array
+from storage import WalkerState, WalkerState3D
+from saw import pivot_samples
+import propagator
+import sphere
+from simulation import Simulation
 
 """
 some constants:
 """
 k = 0.1 #global guidance strength scaler
      
-class RandomWalk:
+class RandomWalk(Simulation):
+    #distributions drawn from, and the names of their block buffered copies (see distributions.Seeded)
+    draws = {"angle_dist": "draw_angle", "step_dist": "draw_step", "initial_pos_dist": "draw_initial_pos",
+             "initial_angle_dist": "draw_initial_angle"}
+
     def __init__(self, 
                  dimension = 2, 
-                 step_dist = lambda: 1, 
+                 step_dist = fixed(1), 
                  angle_dist = pmf({maths.pi * i/2:1 for i in range(4)}),
                  initial_pos_dist = uniform(-5,5),
                  initial_angle_dist = uniform(0, 2*maths.pi),
                  guidance_strength = 0,
-                 guidance_angle = 0):
+                 guidance_angle = 0,
+                 domain = None,
+                 obstacles = None,
+                 seed = None):
         
-        self.dimension = dimension
+        self._set_space(dimension, domain, obstacles)
         self.step_dist = step_dist
         self.angle_dist = angle_dist
         self.initial_pos_dist = initial_pos_dist
         self.initial_angle_dist = initial_angle_dist
         
-        if type(guidance_angle) in [float, int]:
-            self.guidance_angle = constant(guidance_angle)
-        else:
-            self.guidance_angle = guidance_angle
-        if type(guidance_strength) in [float, int]:
-            self.guidance_strength = constant(guidance_strength)
-        else:
-            self.guidance_strength = guidance_strength
+        self._set_guidance(guidance_strength, guidance_angle)
+        
+        self.reseed(seed)
             
         self.particle = Particle((0,0), 0)
     
+    #the guidance strength scaler, read when used so that changes to k apply
+    def guidance_scale(self):
+        return k
     
-    def biased_angle_dist(self, walker):
-        angle_difference = walker.angle - self.guidance_angle(*walker.position)
-        unbiased_angle = self.angle_dist()
-        biased_angle = - k * self.guidance_strength(*walker.position) * maths.sin(angle_difference)
-        return biased_angle + unbiased_angle
+    #a starting position for the simulation, in three dimensions (x, y) is padded to
+    #(x, y, 0), and in a domain it is wrapped or reflected into the box. Walks
+    #can't start on obstacles
+    def __start(self, position):
+        if self.dimension == 3:
+            position = sphere.point(position)
+        if self.domain != None:
+            position = self.domain.start(position)
+        if self.obstacles != None and self.obstacles.distance(*map(float, position)) < self.obstacles.margin:
+            raise ValueError(f"Walks must start outside the obstacles, not at {tuple(position)}")
+        return position
 
 
+    #with dimension = 3 the walk turns on the sphere (see sphere.py), initial_pos may be
+    #(x, y) or (x, y, z) and initial_angle an azimuth in the xy plane or a heading vector
+    #a walk stepping out of an absorbing domain or arresting on an obstacle stops there,
+    #and is marked dead
     def get_rw(self, num_steps, initial_pos = (0,0), initial_angle = 0):
-        walker_dict = {0: {
-                        "walker" : Particle(initial_pos, initial_angle),
-                        "dead" : False,
-                        "positions" : [initial_pos],
-                        "angles" : [initial_angle],
-                        "parent" : None
-                        }}
-        w = walker_dict[0]["walker"]
+        if self.dimension == 3:
+            return self.__get_rw_3d(num_steps, 1, initial_pos, initial_angle)[0]
+        state = WalkerState(branching = False)
+        state.add_branch(self.__start(initial_pos), initial_angle)
         
         for _ in range(num_steps):
-            angle = self.biased_angle_dist(w)
-            w.rotate(angle)
-            w.move(self.step_dist())
-            walker_dict[0]["positions"].append(w.position)
-            walker_dict[0]["angles"].append(w.angle)
+            if self._step(0, state) == None:
+                state.alive[0] = False
+                break
                     
-        return walker_dict
+        return state.to_dict()
+    
+    #runs num_samples independent get_rw walks together, moving every sample's
+    #walker at once as numpy arrays, and returns a list of walker_dicts for WalkData.
+    #guidance_strength may be given as one value per sample, replacing the
+    #simulation's own, to sweep over it in a single run
+    def get_rw_ensemble(self, num_steps, num_samples, initial_pos = (0,0), initial_angle = 0,
+                        guidance_strength = None):
+        strength = None
+        if guidance_strength is not None:
+            strength = np.broadcast_to(np.asarray(guidance_strength, dtype = float), (num_samples,))
+        if self.dimension == 3:
+            return self.__get_rw_3d(num_steps, num_samples, initial_pos, initial_angle, strength)
+
+        state = WalkerState(branching = False, capacity = num_samples)
+        positions = np.tile(np.array(self.__start(initial_pos), dtype = float), (num_samples, 1))
+        ids = state.add_branches(positions, np.full(num_samples, float(initial_angle)),
+                                 -1, -1, samples = np.arange(num_samples))
+        
+        for _ in range(num_steps):
+            x, y, angle = state.x[ids], state.y[ids], state.angle[ids]
+            angle = np.mod(angle + self.biased_angle_array(angle, x, y, strength), 2*maths.pi)
+            step = sample_array(self.draw_step, len(ids))
+            starts = np.column_stack([x, y])
+            x, y = x + step * np.cos(angle), y + step * np.sin(angle)
+            if self.domain != None or self.obstacles != None:
+                positions, angle, inside = self._confine_many(starts, np.column_stack([x, y]), angle)
+                ids, strength = self.__absorb(ids, strength, inside, state)
+                x, y, angle = positions[inside, 0], positions[inside, 1], angle[inside]
+            state.advance_many(ids, x, y, angle)
+        
+        return state.to_dicts(num_samples)
+    
+    #get_rw_ensemble in three dimensions, every sample's heading being guided and
+    #turned on the sphere at once
+    def __get_rw_3d(self, num_steps, num_samples, initial_pos, initial_angle, strength = None):
+        state = WalkerState3D(branching = False, capacity = num_samples)
+        positions = np.tile(np.array(self.__start(initial_pos)), (num_samples, 1))
+        headings = np.tile(sphere.heading_vector(initial_angle), (num_samples, 1))
+        ids = state.add_branches(positions, headings, -1, -1, samples = np.arange(num_samples))
+        
+        for _ in range(num_steps):
+            headings = sphere.guided(headings, positions, self.guidance_angle, self.guidance_strength, k, strength)
+            headings = sphere.turned(headings, sample_array(self.draw_angle, len(ids)),
+                                     self.rng.uniform(0, 2*maths.pi, len(ids)))
+            positions = positions + sample_array(self.draw_step, len(ids))[:, None] * headings
+            if self.domain != None:
+                positions, headings, inside = self.domain.move_many(positions, headings)
+                ids, strength = self.__absorb(ids, strength, inside, state)
+                positions, headings = positions[inside], headings[inside]
+            state.advance_many(ids, positions, headings)
+        
+        return state.to_dicts(num_samples)
     
+    #retires the samples ids that stepped out of an absorbing domain or arrested on an
+    #obstacle, returning the ids and per sample guidance strengths of those still inside
+    def __absorb(self, ids, strength, inside, state):
+        state.alive[ids[~inside]] = False
+        if strength is not None:
+            strength = strength[inside]
+        return ids[inside], strength
     
-    def get_multi_arw(self, num_steps, num_walkers, radius):
-        walker_dict = {}
-        pos_np = np.zeros((num_walkers, 2))
-        index_np = np.zeros(num_walkers, dtype=int)
-        iteration_np = np.zeros(num_walkers, dtype=int)
+    #exact distribution of get_rw's final position after num_steps steps from the
+    #origin, for walks on the square lattice (see propagator.py), as a grid of
+    #probabilities and the coordinates of its rows and columns
+    def exact_distribution(self, num_steps, initial_angle = 0):
+        self._check_planar("exact_distribution")
+        self._check_unbounded("exact_distribution")
+        return propagator.exact_distribution(self, num_steps, initial_angle)
+
+    #exact mean squared distance of get_rw walks from their start after 0 ... num_steps
+    #steps, to compare with Analysis.graph_MSD (eg graph_MSD(exact = RW.exact_msd(150)))
+    def exact_msd(self, num_steps, initial_angle = 0):
+        self._check_planar("exact_msd")
+        self._check_unbounded("exact_msd")
+        return propagator.exact_msd(self, num_steps, initial_angle)
+
+    #self avoiding walks of num_steps steps on the square lattice, from the pivot
+    #algorithm of saw.py, returned as a list of num_samples walker_dicts for WalkData.
+    #Successive samples come from one Markov chain, burn_in and spacing attempted
+    #pivots apart (see saw.pivot_samples), using the simulation's Generator.
+    #The walk's own distributions play no part
+    def get_saw(self, num_steps, num_samples = 1, burn_in = None, spacing = 100):
+        self._check_planar("get_saw")
+        self._check_unbounded("get_saw")
+        walks = []
+        for chain in pivot_samples(num_steps, num_samples, self.rng, burn_in, spacing):
+            sites = chain.walk().astype(float)
+            steps = np.diff(sites, axis = 0)
+            angles = np.mod(np.arctan2(steps[:, 1], steps[:, 0]), 2*maths.pi)
+            state = WalkerState(branching = False)
+            state.add_branch((0, 0), angles[0])
+            state.advance_segments(np.array([0]), np.array([num_steps]), sites[1:, 0], sites[1:, 1], angles)
+            walks.append(state.to_dict())
+        return walks
+
+    #streams the squared end to end distance and radius of gyration of pivot algorithm
+    #self avoiding walks, as (end_to_end_squared, radius_of_gyration_squared) pairs,
+    #without building the walks. Statistics can then be gathered for walks far longer
+    #than get_saw could store, eg np.array(list(RW.saw_statistics(10**5, 1000)))
+    def saw_statistics(self, num_steps, num_samples, burn_in = None, spacing = 100):
+        self._check_planar("saw_statistics")
+        self._check_unbounded("saw_statistics")
+        for chain in pivot_samples(num_steps, num_samples, self.rng, burn_in, spacing):
+            yield chain.end_to_end_squared(), chain.radius_of_gyration_squared()
+
+
+    #collision "point" stops walkers whose tip comes within the radius of a visited
+    #point, "swept" those whose last step passes within the radius of an earlier
+    #step, so that long steps can't jump over other walks
+    def get_multi_arw(self, num_steps, num_walkers, radius, collision = "point"):
+        if collision not in ["point", "swept"]:
+            raise ValueError(f"Unknown collision '{collision}', use 'point' or 'swept'")
+        self._check_planar("get_multi_arw")
+        if collision == "swept" and self.domain != None and self.domain.periodic:
+            raise ValueError("Swept collisions can't be used in a periodic domain")
+        state = WalkerState(branching = False)
         
         for i in range(num_walkers):
-            x = self.initial_pos_dist()
+            x = self.draw_initial_pos()
             if type(x) == tuple:
                 x,y = x
             else:
-                y = self.initial_pos_dist()
+                y = self.draw_initial_pos()
             
-            theta = self.initial_angle_dist()
-            walker_dict[i] = {"walker" : Particle((x,y),theta),
-                              "dead" : False,
-                              "positions" : [(x,y)],
-                              "angles" : [theta],
-                              "parent" : None
-                              }
-            pos_np[i] = (x,y)
-            index_np[i] = i
-            iteration_np[i] = 0
+            theta = self.draw_initial_angle()
+            state.add_branch(self.__start((x,y)), theta)
             
         radius_squared = radius*radius
         iteration = 1
+        points = state.points
        
         while iteration < num_steps:
-            for i in list(walker_dict.keys()):
-                walker_i = walker_dict[i]
-                w = walker_i["walker"]
-                #skip inactive particles
-                if walker_i["dead"]:
-                    continue
-   
-                #calculate distance of all points from walker position
-                diff = pos_np - np.array(w.position)
-                distance_squared = np.einsum('ij,ij->i', diff, diff)
-                #distance_squared = (diff * diff).sum(axis=1)
+            for i in state.active():
+                if collision == "swept":
+                    #distance of every stored step from the walker's last step,
+                    #0 when they cross so nothing is ignored for being close
+                    start, end = state.segment(i)
+                    distance_squared = segment_distance_squared(start, end, points.segment_starts(slice(None)),
+                                                                points.positions)
+                    m_self = np.zeros(len(points), dtype = bool)
+                    #the step is checked with the own past window of its start point
+                    walker_iter = max(state.iteration[i] - 1, 0)
+                else:
+                    #calculate distance of all points from walker position
+                    diff = points.positions - np.array((state.x[i], state.y[i]))
+                    if self.domain != None:
+                        diff = self.domain.separation(diff)
+                    distance_squared = np.einsum('ij,ij->i', diff, diff)
+                    #distance_squared = (diff * diff).sum(axis=1)
+                    m_self = distance_squared < 1e-9
+                    walker_iter = state.iteration[i]
 
                 #create masks to ignore certain positions
                 #masks return true if they should be ignored
-                m_self = distance_squared < 1e-9
-                m_past = mask_past(index_np, iteration_np, i, w.iteration)
+                m_past = mask_past(points.index, points.iteration, i, walker_iter)
                 mask = m_self | m_past
                 #mask = combine_masks([m_self, m_past])
                 too_close = (distance_squared < radius_squared) & ~mask
                
                 if np.any(too_close):
-                    walker_i["dead"] = True
+                    state.alive[i] = False
                     continue
-                angle = self.biased_angle_dist(w)
-                w.rotate(angle)
-                w.move(self.step_dist())
-                w.iteration += 1
-                
-                walker_i["positions"].append(w.position)
-                walker_i["angles"].append(w.angle)
-                    
-                pos_np = np.vstack([pos_np, w.position])
-                index_np = np.hstack([index_np, i])
-                iteration_np = np.hstack([iteration_np, w.iteration])
+                if self._step(i, state) == None:
+                    state.alive[i] = False
                   
             iteration += 1
 
-        return walker_dict
\ No newline at end of file
+        return state.to_dict()
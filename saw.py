@@ -0,0 +1,166 @@
+"""
+Pivot algorithm for self avoiding walks on the square lattice
+
+Growing a self avoiding walk step by step, or rejecting random walks that
+intersect themselves, gets exponentially slower with the length of the walk.
+The pivot algorithm (Madras and Sokal) instead runs a Markov chain on walks of
+a fixed length: a pivot point is picked at random, one side of the walk is
+rotated or reflected about it by a random symmetry of the lattice, and the move
+is kept if the walk still avoids itself. Each accepted pivot changes the walk
+on a large scale, so global quantities such as the end to end distance
+decorrelate after only a few accepted pivots.
+
+Sites are hashed to single integers, and a numpy hash table (SiteTable) maps
+each site to the point of the walk on it, so the sites of a whole block of
+points are looked up at once. The shorter side of the walk is always the one
+moved, and its new sites are tested in blocks of doubling size working out from
+the pivot, as most failed pivots intersect close to it
+"""
+
+import numpy as np
+
+"""
+1: Lattice symmetries and site keys
+"""
+#the 7 rotations and reflections of the square lattice other than the identity
+SYMMETRIES = np.array([[[0, -1], [1, 0]],
+                       [[-1, 0], [0, -1]],
+                       [[0, 1], [-1, 0]],
+                       [[1, 0], [0, -1]],
+                       [[-1, 0], [0, 1]],
+                       [[0, 1], [1, 0]],
+                       [[0, -1], [-1, 0]]])
+
+#hashes integer sites (x, y), |x|, |y| < 2^31, to single integers
+def site_keys(sites):
+    return (sites[:, 0] << 32) + sites[:, 1]
+
+#open addressing hash table from sites to the points of a walk on them, probed
+#for whole arrays of sites at once with numpy. Slots hold point ids, and an id is
+#only a match when that point is still on the site looked up, so moving a point
+#just adds a slot for its new site. The table is rebuilt from the live sites
+#once it is half full
+class SiteTable:
+    def __init__(self, keys):
+        self.capacity = 1 << max(4, (8 * len(keys) - 1).bit_length())
+        self.mask = np.uint64(self.capacity - 1)
+        self.shift = np.uint64(64 - (self.capacity - 1).bit_length())
+        self.rebuild(keys)
+
+    def slots(self, keys):
+        hashed = keys.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        return (hashed >> self.shift).astype(np.int64)
+
+    def rebuild(self, keys):
+        self.table = np.full(self.capacity, -1, dtype = np.int64)
+        self.filled = 0
+        self.insert(keys, np.arange(len(keys)))
+
+    #adds slots for the points ids, now on the sites with the given keys
+    def insert(self, keys, ids):
+        slots = self.slots(keys)
+        while len(ids):
+            free = self.table[slots] == -1
+            #of several points wanting the same free slot, one takes it
+            self.table[slots[free]] = ids[free]
+            waiting = self.table[slots] != ids
+            ids, slots = ids[waiting], (slots[waiting] + 1) & int(self.mask)
+        self.filled += len(keys)
+
+    #the point on each site, given the current keys of every point, or -1
+    def lookup(self, keys, point_keys):
+        found = np.full(len(keys), -1, dtype = np.int64)
+        pending = np.arange(len(keys))
+        slots = self.slots(keys)
+        while len(pending):
+            ids = self.table[slots]
+            empty = ids == -1
+            match = ~empty & (point_keys[ids] == keys[pending])
+            found[pending[match]] = ids[match]
+            carry_on = ~empty & ~match
+            pending, slots = pending[carry_on], (slots[carry_on] + 1) & int(self.mask)
+        return found
+
+"""
+2: Pivot chain
+"""
+class PivotWalk:
+    #starts from a straight walk of num_steps steps, the pivots draw from rng
+    def __init__(self, num_steps, rng):
+        self.num_steps = num_steps
+        self.rng = rng
+        self.sites = np.zeros((num_steps + 1, 2), dtype = np.int64)
+        self.sites[:, 0] = np.arange(num_steps + 1)
+        self.keys = site_keys(self.sites)
+        self.occupied = SiteTable(self.keys)
+        self.attempts = 0
+        self.accepted = 0
+
+    #tries one pivot, returning whether it was accepted
+    def pivot(self):
+        n = self.num_steps
+        self.attempts += 1
+        pivot = int(self.rng.integers(1, n)) if n > 1 else 0
+        symmetry = SYMMETRIES[self.rng.integers(len(SYMMETRIES))]
+        #points to move, in order of distance from the pivot, and the fixed ones
+        if pivot <= n - pivot:
+            moving = np.arange(pivot - 1, -1, -1)
+            fixed_lo, fixed_hi = pivot, n
+        else:
+            moving = np.arange(pivot + 1, n + 1)
+            fixed_lo, fixed_hi = 0, pivot
+
+        centre = self.sites[pivot]
+        new_sites, new_keys = [], []
+        start, block = 0, 16
+        while start < len(moving):
+            rows = moving[start:start + block]
+            sites = (self.sites[rows] - centre) @ symmetry.T + centre
+            keys = site_keys(sites)
+            on_site = self.occupied.lookup(keys, self.keys)
+            if np.any((on_site >= fixed_lo) & (on_site <= fixed_hi)):
+                return False
+            new_sites.append(sites)
+            new_keys.append(keys)
+            start += block
+            block *= 2
+
+        new_keys = np.concatenate(new_keys)
+        self.sites[moving] = np.concatenate(new_sites)
+        self.keys[moving] = new_keys
+        if 2 * (self.occupied.filled + len(moving)) > self.occupied.capacity:
+            self.occupied.rebuild(self.keys)
+        else:
+            self.occupied.insert(new_keys, moving)
+        self.accepted += 1
+        return True
+
+    def run(self, num_attempts):
+        for _ in range(num_attempts):
+            self.pivot()
+
+    #squared distance between the ends of the walk
+    def end_to_end_squared(self):
+        diff = self.sites[-1] - self.sites[0]
+        return float(diff @ diff)
+
+    #mean squared distance of the walk's sites from their centre
+    def radius_of_gyration_squared(self):
+        centred = self.sites - self.sites.mean(axis = 0)
+        return float(np.einsum('ij,ij->', centred, centred) / len(centred))
+
+    #the walk's sites, translated to start at the origin
+    def walk(self):
+        return self.sites - self.sites[0]
+
+#yields num_samples walks of num_steps steps from a pivot chain, after burn_in
+#attempted pivots and then every spacing attempted pivots. The PivotWalk itself is
+#yielded, so only the statistics wanted need to be read from each sample.
+#Starting from a straight walk, global quantities take several times num_steps
+#attempts to settle, so burn_in defaults to 10 num_steps
+def pivot_samples(num_steps, num_samples, rng, burn_in = None, spacing = 100):
+    chain = PivotWalk(num_steps, rng)
+    chain.run(10 * num_steps if burn_in == None else burn_in)
+    for _ in range(num_samples):
+        yield chain
+        chain.run(spacing)
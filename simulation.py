@@ -0,0 +1,132 @@
+"""
+Code shared by the continuous random walk simulations
+
+BranchingRandomWalk (barw.py) and RandomWalk (rw.py) both turn and step their
+walkers the same way: the turn is drawn from angle_dist and biased towards the
+guidance field (and away from obstacles), the step is drawn from step_dist, and
+the moved walker is wrapped or reflected into the domain and kept out of the
+obstacles. A Simulation holds those parts, so both engines share one copy of
+them. Each engine gives the guidance strength scaler k of its own module through
+guidance_scale()
+"""
+import math as maths
+import numpy as np
+
+import raster
+from aux import constant, evaluate_field
+from distributions import sample_array, Seeded
+
+class Simulation(Seeded):
+    #the number of dimensions, the box the walks run in (see domain.py, None for
+    #unbounded space) and the obstacles they are kept out of or arrest on (see obstacle.py)
+    def _set_space(self, dimension, domain, obstacles):
+        if dimension not in [2, 3]:
+            raise ValueError(f"dimension must be 2 or 3, not {dimension}")
+        self.dimension = dimension
+        if domain != None:
+            domain.sizes(dimension)
+        self.domain = domain
+        if obstacles != None and dimension != 2:
+            raise ValueError("Obstacles are only available in two dimensions")
+        self.obstacles = obstacles
+
+    #guidance fields, where numbers are constant fields
+    def _set_guidance(self, guidance_strength, guidance_angle):
+        if type(guidance_angle) in [float, int]:
+            self.guidance_angle = constant(guidance_angle)
+        else:
+            self.guidance_angle = guidance_angle
+        if type(guidance_strength) in [float, int]:
+            self.guidance_strength = constant(guidance_strength)
+        else:
+            self.guidance_strength = guidance_strength
+
+    #defines a bias function to nudge walker in the direction of the guiding field
+    #this is used in place of the angle distribution on its own
+    def biased_angle_dist(self, walker):
+        return self.biased_angle(walker.angle, *walker.position)
+
+    #biased_angle_dist for a walker given by its angle and position
+    def biased_angle(self, angle, x, y):
+        k = self.guidance_scale()
+        angle_difference = angle - self.guidance_angle(x, y)
+        unbiased_angle = self.draw_angle()
+        biased_angle = - k * self.guidance_strength(x, y) * maths.sin(angle_difference)
+        if self.obstacles != None and self.obstacles.avoidance > 0:
+            normal, avoidance = self.obstacles.steering(x, y)
+            biased_angle -= k * avoidance * maths.sin(angle - normal)
+        return biased_angle + unbiased_angle
+
+    #replaces non constant guidance fields by grids of their values sampled every
+    #resolution over extent, by default the simulation's domain, which are then
+    #evaluated by bilinear interpolation (see raster.py)
+    def rasterise_guidance(self, extent = None, resolution = 0.1):
+        if extent == None:
+            extent = self.domain
+        if extent == None:
+            raise ValueError("Rasterising guidance needs an extent ((x_min, x_max), (y_min, y_max)) or a domain")
+        self.guidance_angle = raster.rasterised(self.guidance_angle, extent, resolution, angle = True)
+        self.guidance_strength = raster.rasterised(self.guidance_strength, extent, resolution)
+
+    #vectorised biased_angle_dist, giving turning angles for arrays of walkers
+    #strength optionally overrides the guidance strength field with an array
+    def biased_angle_array(self, angles, x, y, strength = None):
+        k = self.guidance_scale()
+        if strength is None:
+            strength = evaluate_field(self.guidance_strength, x, y)
+        angle_difference = angles - evaluate_field(self.guidance_angle, x, y)
+        unbiased_angle = sample_array(self.draw_angle, len(angles))
+        biased_angle = - k * strength * np.sin(angle_difference)
+        if self.obstacles != None and self.obstacles.avoidance > 0:
+            normal, avoidance = self.obstacles.steering(x, y)
+            biased_angle -= k * avoidance * np.sin(angles - normal)
+        return biased_angle + unbiased_angle
+
+    #rotates and moves the tip of walker i by one step, returning the row of its new
+    #point, or None if it stepped out of an absorbing domain or arrested on an obstacle
+    def _step(self, i, state):
+        #item() gives python floats, which are quicker to do scalar maths with
+        x0, y0, angle = state.x.item(i), state.y.item(i), state.angle.item(i)
+        angle = (angle + self.biased_angle(angle, x0, y0)) % (2*maths.pi)
+        distance = self.draw_step()
+        x = distance * maths.cos(angle) + x0
+        y = distance * maths.sin(angle) + y0
+        if self.domain != None or self.obstacles != None:
+            moved = self._confine(x0, y0, x, y, angle)
+            if moved == None:
+                return None
+            x, y, angle = moved
+        return state.advance(i, x, y, angle)
+
+    #wraps or reflects a step from (x0, y0) to (x, y) into the domain and out of the
+    #obstacles, returning the new (x, y, angle), or None if the walker stops there
+    def _confine(self, x0, y0, x, y, angle):
+        if self.domain != None:
+            moved = self.domain.move(x, y, angle)
+            if moved == None:
+                return None
+            x, y, angle = moved
+        if self.obstacles != None:
+            return self.obstacles.move(x0, y0, x, y, angle)
+        return x, y, angle
+
+    #vectorised _confine for steps from starts to positions (n, 2) facing angles,
+    #returning the new positions and angles and which walkers didn't stop
+    def _confine_many(self, starts, positions, angles):
+        inside = np.ones(len(positions), dtype = bool)
+        if self.domain != None:
+            positions, angles, inside = self.domain.move_many(positions, angles)
+        if self.obstacles != None:
+            positions, angles, free = self.obstacles.move_many(starts, positions, angles)
+            inside = inside & free
+        return positions, angles, inside
+
+    #raises a ValueError for methods that only simulate two dimensional walks
+    def _check_planar(self, method):
+        if self.dimension != 2:
+            raise ValueError(f"{method} is only available in two dimensions")
+
+    #raises a ValueError for methods that only simulate walks in unbounded space
+    def _check_unbounded(self, method):
+        if self.domain != None or self.obstacles != None:
+            raise ValueError(f"{method} is only available without a domain or obstacles")
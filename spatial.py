@@ -0,0 +1,514 @@
+"""
+Spatial indexes used to speed up the annihilation checks of the simulations
+
+Every index stores integer point ids (the row of each point in the position
+history arrays) and answers a query with a superset of the ids that lie within
+the annihilation radius of a position. The exact distance test is still carried
+out by the simulation on those candidates, so an index only changes how many
+points get tested, never which points annihilate a walker.
+
+Indexes can either be filled point by point with insert, or kept in step with a
+TrajectoryBuffer by calling update, which inserts the rows appended since the
+previous call. query_many(positions) answers the queries of many positions at
+once, as a list of candidate sets, and query_radius(position, distance) gives
+the candidates within any other distance.
+
+Each row of a TrajectoryBuffer also stands for the segment walked to reach it,
+from the previous point of the same branch. Indexes made with swept = True store
+those segments, and query_segment(start, end) returns a superset of the segments
+within the radius of the segment start -> end, for swept collision checks
+"""
+import itertools
+import math as maths
+import numpy as np
+
+import aux
+from storage import TrajectoryBuffer
+
+"""
+1: Brute force index, every stored point is a candidate
+"""
+class BruteForceIndex:
+    def insert(self, point_id, position):
+        pass
+
+    def update(self, points):
+        pass
+
+    def insert_many(self, point_ids, positions):
+        pass
+
+    #slicing with slice(None) returns views of the whole history arrays
+    def query(self, position):
+        return slice(None)
+
+    def query_many(self, positions):
+        return [slice(None)] * len(positions)
+
+    def query_radius(self, position, distance):
+        return slice(None)
+
+    def query_segment(self, start, end):
+        return slice(None)
+
+"""
+2: Uniform grid (cell list / spatial hash)
+
+Points are hashed into square cells at least as wide as the radius, so any
+point within the radius of a position lies in the 3x3 block of cells around it.
+
+When swept, each segment is stored in every cell it passes through, found with a
+DDA traversal (stepping from cell to cell across whichever boundary the segment
+meets first). Two segments within the radius of each other then pass through
+neighbouring cells, so a segment query gathers the 3x3 blocks around the cells
+the queried segment passes through. Segments crossing more than max_cells cells,
+from the rare very long steps of heavy tailed step distributions, are kept in a
+list of long segments which are candidates for every query
+"""
+#the cells of the given size which the segment start -> end passes through, in order
+def traverse(start, end, cell_size):
+    x0, y0 = start[0] / cell_size, start[1] / cell_size
+    x1, y1 = end[0] / cell_size, end[1] / cell_size
+    cx, cy = maths.floor(x0), maths.floor(y0)
+    n = abs(maths.floor(x1) - cx) + abs(maths.floor(y1) - cy)
+    dx, dy = x1 - x0, y1 - y0
+    step_x, step_y = (1 if dx > 0 else -1), (1 if dy > 0 else -1)
+    #distance along the segment, as a fraction of its length, between boundaries
+    #and to the next boundary in each direction
+    delta_x = abs(1 / dx) if dx != 0 else maths.inf
+    delta_y = abs(1 / dy) if dy != 0 else maths.inf
+    next_x = ((cx + 1 - x0) if dx > 0 else (x0 - cx)) * delta_x if dx != 0 else maths.inf
+    next_y = ((cy + 1 - y0) if dy > 0 else (y0 - cy)) * delta_y if dy != 0 else maths.inf
+    cells = [(cx, cy)]
+    for _ in range(n):
+        if next_x < next_y:
+            cx += step_x
+            next_x += delta_x
+        else:
+            cy += step_y
+            next_y += delta_y
+        cells.append((cx, cy))
+    return cells
+
+#number of cells the segment start -> end passes through
+def cell_count(start, end, cell_size):
+    return (abs(maths.floor(end[0] / cell_size) - maths.floor(start[0] / cell_size)) +
+            abs(maths.floor(end[1] / cell_size) - maths.floor(start[1] / cell_size)) + 1)
+
+class GridIndex:
+    def __init__(self, radius, reach = None, swept = False, max_cells = 4096):
+        #cells are made marginally wider than the radius, so that rounding in
+        #the floor division can never push a point within range out of the block
+        self.cell_size = radius * (1 + 1e-9)
+        self.cells = {}
+        #optional second layer of coarse cells, for query_radius up to reach
+        self.coarse_size = None if reach == None else reach * (1 + 1e-9)
+        self.coarse = {}
+        self.swept = swept
+        self.max_cells = max_cells
+        self.long = []
+        #number of buffer rows inserted so far by update
+        self.count = 0
+
+    def cell(self, position):
+        return (maths.floor(position[0] / self.cell_size),
+                maths.floor(position[1] / self.cell_size))
+
+    def insert(self, point_id, position):
+        self.cells.setdefault(self.cell(position), []).append(point_id)
+        if self.coarse_size != None:
+            coarse_cell = (maths.floor(position[0] / self.coarse_size),
+                           maths.floor(position[1] / self.coarse_size))
+            self.coarse.setdefault(coarse_cell, []).append(point_id)
+
+    def insert_many(self, point_ids, positions):
+        for point_id, position in zip(point_ids, positions):
+            self.insert(point_id, position)
+
+    def insert_segment(self, segment_id, start, end):
+        if cell_count(start, end, self.cell_size) > self.max_cells:
+            self.long.append(segment_id)
+            return
+        for cell in traverse(start, end, self.cell_size):
+            self.cells.setdefault(cell, []).append(segment_id)
+
+    def update(self, points):
+        if self.count < points.size:
+            rows = range(self.count, points.size)
+            new_positions = points.positions[self.count:].tolist()
+            if self.swept:
+                starts = points.segment_starts(np.arange(self.count, points.size)).tolist()
+                for row, start, end in zip(rows, starts, new_positions):
+                    self.insert_segment(row, start, end)
+            else:
+                self.insert_many(rows, new_positions)
+            self.count = points.size
+
+    def query(self, position):
+        cx, cy = self.cell(position)
+        candidates = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                candidates.extend(self.cells.get((cx + dx, cy + dy), ()))
+        return np.array(candidates, dtype=int)
+
+    #candidates for each of an array of positions, as a list of arrays
+    def query_many(self, positions):
+        return [self.query(p) for p in np.asarray(positions).tolist()]
+
+    #candidates within any distance, from the 3x3 block of coarse cells when the
+    #distance is within reach, and otherwise the square block of cells covering it
+    def query_radius(self, position, distance):
+        if self.coarse_size != None and distance <= self.coarse_size:
+            cx = maths.floor(position[0] / self.coarse_size)
+            cy = maths.floor(position[1] / self.coarse_size)
+            candidates = []
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    candidates.extend(self.coarse.get((cx + dx, cy + dy), ()))
+            return np.array(candidates, dtype=int)
+
+        cx, cy = self.cell(position)
+        n = maths.ceil(distance / self.cell_size)
+        candidates = []
+        for dx in range(-n, n + 1):
+            for dy in range(-n, n + 1):
+                candidates.extend(self.cells.get((cx + dx, cy + dy), ()))
+        return np.array(candidates, dtype=int)
+
+    #candidate segments for a segment, without repeats. Long queries test everything
+    def query_segment(self, start, end):
+        if cell_count(start, end, self.cell_size) > self.max_cells:
+            return slice(None)
+        block = set()
+        for cx, cy in traverse(start, end, self.cell_size):
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    block.add((cx + dx, cy + dy))
+        candidates = list(self.long)
+        for cell in block:
+            candidates.extend(self.cells.get(cell, ()))
+        return np.unique(np.array(candidates, dtype=int))
+
+"""
+2b: Uniform grid in three dimensions
+
+The same cell list for three dimensional points, a point within the radius of a
+position lying in the 3x3x3 block of cells around it. Only points are stored,
+swept collisions are two dimensional
+"""
+#offsets of the 27 cells of a 3x3x3 block from its centre
+BLOCK_3D = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
+
+class GridIndex3D:
+    def __init__(self, radius):
+        self.cell_size = radius * (1 + 1e-9)
+        self.cells = {}
+        self.count = 0
+
+    def cell(self, position):
+        return (maths.floor(position[0] / self.cell_size),
+                maths.floor(position[1] / self.cell_size),
+                maths.floor(position[2] / self.cell_size))
+
+    def insert(self, point_id, position):
+        self.cells.setdefault(self.cell(position), []).append(point_id)
+
+    def insert_many(self, point_ids, positions):
+        cells = np.floor(np.asarray(positions) / self.cell_size).astype(int).tolist()
+        for point_id, cell in zip(point_ids, cells):
+            self.cells.setdefault(tuple(cell), []).append(point_id)
+
+    def update(self, points):
+        if self.count < points.size:
+            self.insert_many(range(self.count, points.size), points.positions[self.count:])
+            self.count = points.size
+
+    def query(self, position):
+        return self.__block(self.cell(position))
+
+    #the cells of all the positions are found in one go
+    def query_many(self, positions):
+        cells = np.floor(np.asarray(positions) / self.cell_size).astype(int).tolist()
+        return [self.__block(cell) for cell in cells]
+
+    def query_radius(self, position, distance):
+        cx, cy, cz = self.cell(position)
+        n = maths.ceil(distance / self.cell_size)
+        candidates = []
+        for dx in range(-n, n + 1):
+            for dy in range(-n, n + 1):
+                for dz in range(-n, n + 1):
+                    candidates.extend(self.cells.get((cx + dx, cy + dy, cz + dz), ()))
+        return np.array(candidates, dtype=int)
+
+    def __block(self, cell):
+        cx, cy, cz = cell
+        candidates = []
+        for dx, dy, dz in BLOCK_3D:
+            candidates.extend(self.cells.get((cx + dx, cy + dy, cz + dz), ()))
+        return np.array(candidates, dtype=int)
+
+"""
+2c: Uniform grid in a periodic box
+
+In a periodic Domain the cells tile the box, so the cell indexes along each axis
+wrap round, and the neighbours of a cell on one side of the box are the cells on
+the other side. Each axis is cut into as many whole cells as fit at least the
+radius wide, so there can be fewer than 3, in which case the wrapped block of a
+cell repeats cells and they are only gathered once. Works in two and three
+dimensions, for points
+"""
+class PeriodicGridIndex:
+    def __init__(self, radius, domain, dimension = 2):
+        size = domain.sizes(dimension)
+        self.lower = -size / 2
+        self.counts = np.maximum(np.floor(size / (radius * (1 + 1e-9))), 1).astype(int)
+        self.cell_sizes = size / self.counts
+        self.offsets = list(itertools.product((-1, 0, 1), repeat = dimension))
+        self.cells = {}
+        self.count = 0
+
+    #cells of an array of positions, as lists of whole cell indexes
+    def cells_of(self, positions):
+        cells = np.floor((np.asarray(positions, dtype = float) - self.lower) / self.cell_sizes).astype(int)
+        return np.mod(cells, self.counts).tolist()
+
+    def insert(self, point_id, position):
+        self.insert_many([point_id], [position])
+
+    def insert_many(self, point_ids, positions):
+        for point_id, cell in zip(point_ids, self.cells_of(positions)):
+            self.cells.setdefault(tuple(cell), []).append(point_id)
+
+    def update(self, points):
+        if self.count < points.size:
+            self.insert_many(range(self.count, points.size), points.positions[self.count:])
+            self.count = points.size
+
+    def query(self, position):
+        return self.__block(self.cells_of([position])[0], 1)
+
+    def query_many(self, positions):
+        return [self.__block(cell, 1) for cell in self.cells_of(positions)]
+
+    def query_radius(self, position, distance):
+        return self.__block(self.cells_of([position])[0], maths.ceil(distance / self.cell_sizes.min()))
+
+    #points in the cells up to n cells away along every axis, wrapping round the box
+    def __block(self, cell, n):
+        counts = self.counts.tolist()
+        offsets = self.offsets if n == 1 else itertools.product(range(-n, n + 1), repeat = len(cell))
+        block = {tuple((c + d) % m for c, d, m in zip(cell, offset, counts)) for offset in offsets}
+        candidates = []
+        for neighbour in block:
+            candidates.extend(self.cells.get(neighbour, ()))
+        return np.array(candidates, dtype=int)
+
+"""
+3: KD-tree over the frozen history, plus a buffer of recent points
+
+A scipy cKDTree cannot be added to, so it is built over the points known at the
+last rebuild, and points inserted since then are kept in a small buffer which is
+searched by brute force. The tree is rebuilt once the buffer holds more than
+about sqrt(n log n) of the n points, which balances the cost of the rebuilds
+against that of searching the buffer, and adapts to the size of the history.
+Unlike the grid, memory use only depends on the number of points, however
+unevenly they are spread. It works in any dimension, and in a periodic Domain
+the tree is built over the box with scipy's periodic boxsize
+"""
+class KDTreeIndex:
+    def __init__(self, radius, min_buffer = 256, dimension = 2, domain = None):
+        from scipy.spatial import cKDTree
+        self.tree_type = cKDTree
+        #queried marginally wider than the radius, so rounding can't drop a point
+        self.search_radius = radius * (1 + 1e-9)
+        self.min_buffer = min_buffer
+        #the point ids and positions, of which the first frozen are in the tree
+        self.points = TrajectoryBuffer(dimension = dimension)
+        self.frozen = 0
+        self.tree = None
+        #number of points at which the tree is next rebuilt
+        self.next_rebuild = min_buffer
+        #number of buffer rows inserted so far by update
+        self.count = 0
+        #periodic trees hold positions measured from the lower corner of the box
+        self.box = None if domain == None or not domain.periodic else domain.sizes(dimension)
+
+    #positions as the tree holds them
+    def shifted(self, positions):
+        if self.box is None:
+            return positions
+        shifted = np.mod(np.asarray(positions, dtype = float) + self.box / 2, self.box)
+        #rounding can leave a coordinate just below 0 on the box size itself
+        return np.where(shifted < self.box, shifted, 0.0)
+
+    def insert(self, point_id, position):
+        self.points.append(position, point_id, 0)
+        self.rebuild_if_due()
+
+    def insert_many(self, point_ids, positions):
+        point_ids = np.asarray(point_ids, dtype = int)
+        if len(point_ids):
+            self.points.extend(np.asarray(positions, dtype = float), point_ids, 0)
+            self.rebuild_if_due()
+
+    def update(self, points):
+        if self.count < points.size:
+            self.insert_many(np.arange(self.count, points.size), points.positions[self.count:])
+            self.count = points.size
+
+    def rebuild_if_due(self):
+        n = self.points.size
+        if n > self.next_rebuild:
+            self.frozen = n
+            if self.box is None:
+                self.tree = self.tree_type(self.points.positions)
+            else:
+                self.tree = self.tree_type(self.shifted(self.points.positions), boxsize = self.box)
+            self.next_rebuild = n + max(self.min_buffer, int(maths.sqrt(n * maths.log2(n))))
+
+    def query(self, position):
+        recent = self.points.index[self.frozen:]
+        if self.tree is None:
+            return recent
+        rows = self.tree.query_ball_point(self.shifted(position), self.search_radius, return_sorted = False)
+        return np.concatenate([self.points.index[rows], recent])
+
+    def query_radius(self, position, distance):
+        recent = self.points.index[self.frozen:]
+        if self.tree is None:
+            return recent
+        rows = self.tree.query_ball_point(self.shifted(position), distance * (1 + 1e-9), return_sorted = False)
+        return np.concatenate([self.points.index[rows], recent])
+
+    #query for an array of positions, the tree is searched for all of them in one call
+    def query_many(self, positions):
+        recent = self.points.index[self.frozen:]
+        if self.tree is None:
+            return [recent] * len(positions)
+        rows = self.tree.query_ball_point(self.shifted(positions), self.search_radius, return_sorted = False)
+        index = self.points.index
+        return [np.concatenate([index[r], recent]) for r in rows]
+
+"""
+4: Cached clearances, letting walkers skip annihilation checks
+
+After a full check finds walker i safe, refresh(i, ...) measures its clearance c,
+the distance from its tip to the nearest point it could hit. Every walker moves
+at most max_step per iteration, and new points are only laid down by walkers
+moving away from points that already exist (children start on their parent's
+tip), so for the next a iterations nothing can come within c - 2 a max_step of
+the tip. The walker can therefore skip the next (c - radius) / (2 max_step)
+full checks, up to horizon of them. Only points within reach of the tip are
+looked at, so c is capped at reach.
+
+The walker's own recent past is always close by, so its own points from the
+last window iterations are left out of c. Those, and the points it lays down
+while skipping, are kept in a trail which check(i, ...) tests instead, with the
+same own past rule as the full check. Clearances are only cached once walkers
+are too old for the exclusion windows of their relatives to apply. When a walker
+can't skip, it waits a growing number of full checks before trying again
+"""
+class Clearance:
+    def __init__(self, radius, max_step, horizon = 16):
+        self.radius = radius
+        self.radius_squared = radius * radius
+        self.max_step = max_step
+        self.horizon = horizon
+        self.reach = radius + 2 * horizon * max_step
+        #own points older than the window are usually further away than reach
+        self.window = maths.ceil(self.reach / max_step) + 1 if 0 < max_step < maths.inf else horizon
+        #walker id -> [checks left to skip, trail of (x, y, iteration) own points]
+        self.walkers = {}
+        #walker id -> [full checks left before the next refresh, next wait]
+        self.waits = {}
+        self.skipped = 0
+
+    #unbounded steps can't give a clearance
+    def enabled(self):
+        return maths.isfinite(self.max_step)
+
+    #None if walker i needs a full check, otherwise whether its trail annihilates it
+    def check(self, i, state):
+        entry = self.walkers.get(i)
+        if entry is None or entry[0] == 0:
+            return None
+        entry[0] -= 1
+        x, y, iteration = state.x.item(i), state.y.item(i), state.iteration.item(i)
+        trail = entry[1]
+        last = iteration - aux.k - 1
+        radius_squared = self.radius_squared
+        for px, py, point_iter in trail:
+            if point_iter <= last:
+                dx, dy = px - x, py - y
+                if 1e-9 <= dx*dx + dy*dy < radius_squared:
+                    return True
+        trail.append((x, y, iteration))
+        self.skipped += 1
+        return False
+
+    #caches the number of checks walker i can skip after passing a full check.
+    #index must already hold every stored point. candidates and distance_squared
+    #are those of the full check, reused when they already cover every point
+    def refresh(self, i, state, index, candidates = None, distance_squared = None):
+        iteration = state.iteration.item(i)
+        if iteration < aux.k + 1:
+            return
+        wait = self.waits.get(i)
+        if wait is not None and wait[0] > 0:
+            wait[0] -= 1
+            return
+
+        position = (state.x.item(i), state.y.item(i))
+        if not isinstance(candidates, slice):
+            candidates = index.query_radius(position, self.reach)
+            diff = state.points.positions[candidates] - np.array(position)
+            distance_squared = np.einsum('ij,ij->i', diff, diff)
+        recent = (state.points.index[candidates] == i) & (state.points.iteration[candidates] > iteration - self.window)
+
+        others = distance_squared[~recent]
+        clearance = min(maths.sqrt(others.min()), self.reach) if len(others) else self.reach
+        if self.max_step > 0:
+            skips = min(self.horizon, int((clearance - self.radius - 1e-9) / (2 * self.max_step)))
+        else:
+            skips = self.horizon
+        if skips < 1:
+            self.walkers.pop(i, None)
+            backoff = 1 if wait is None else min(2 * wait[1], self.horizon)
+            self.waits[i] = [backoff, backoff]
+            return
+        self.waits.pop(i, None)
+
+        #trail of the walker's recent own points within reach, further ones can't be hit
+        rows = np.flatnonzero(recent & (distance_squared < self.reach * self.reach))
+        if not isinstance(candidates, slice):
+            rows = candidates[rows]
+        positions = state.points.positions[rows]
+        trail = list(zip(positions[:, 0].tolist(), positions[:, 1].tolist(),
+                         state.points.iteration[rows].tolist()))
+        self.walkers[i] = [skips, trail]
+
+"""
+5: Constructor used by the simulations to pick an index by name
+"""
+#reach is the largest distance query_radius will be used with, if any, and swept
+#asks for an index of segments. The KD-tree only stores points. dimension 3 gives
+#indexes of three dimensional points, and a periodic domain wrapping indexes
+def make_index(search, radius, reach = None, swept = False, dimension = 2, domain = None):
+    periodic = domain != None and domain.periodic
+    if swept and periodic:
+        raise ValueError("Swept collisions can't be used in a periodic domain")
+    if search == "brute":
+        return BruteForceIndex()
+    if search == "grid":
+        if periodic:
+            return PeriodicGridIndex(radius, domain, dimension)
+        if dimension == 3:
+            return GridIndex3D(radius)
+        return GridIndex(radius, reach, swept)
+    if search == "kdtree":
+        if swept:
+            raise ValueError("Swept collisions need search = 'brute' or 'grid'")
+        return KDTreeIndex(radius, dimension = dimension, domain = domain)
+    raise ValueError(f"Unknown search method '{search}', use 'brute', 'grid' or 'kdtree'")
@@ -0,0 +1,78 @@
+"""
+Headings on the sphere, for random walks in three dimensions
+
+In three dimensions a walker's heading is a unit vector. A turning angle drawn
+from angle_dist tilts the heading by that angle away from itself, towards a
+direction picked uniformly at random around it (the azimuth of the turn), so the
+new headings lie on a cone about the old one. Branching tilts the two children
+by |branch angle| towards opposite sides of the same random azimuth, so a parent
+and its children stay in one plane, as they do in two dimensions.
+
+Guidance fields are functions of (x, y) as in two dimensions, and are evaluated
+at the projection of the tip onto the xy plane. guidance_angle gives a target
+direction in the xy plane, and the heading is turned towards it by
+k * strength * sin(angle between them), which is the two dimensional rule
+-k * strength * sin(angle - guidance angle) for headings in the plane
+"""
+
+import math as maths
+import numpy as np
+
+from aux import evaluate_field
+
+"""
+1: Positions and headings from the simulations' settings
+"""
+#a position as a 3D point, missing coordinates being 0, eg (x, y) -> (x, y, 0)
+def point(position):
+    position = tuple(float(c) for c in position)
+    if len(position) > 3:
+        raise ValueError(f"A position in three dimensions has at most 3 coordinates, not {len(position)}")
+    return position + (0.0,) * (3 - len(position))
+
+#a unit heading from an initial angle, scalars being azimuths in the xy plane
+#and vectors being normalised
+def heading_vector(angle):
+    if np.ndim(angle) == 0:
+        return np.array([maths.cos(angle), maths.sin(angle), 0.0])
+    heading = np.asarray(angle, dtype = float)
+    norm = np.linalg.norm(heading)
+    if heading.shape != (3,) or norm == 0:
+        raise ValueError(f"A heading in three dimensions is an angle or a non zero 3 vector, not {angle}")
+    return heading / norm
+
+"""
+2: Turning and guiding arrays of headings
+"""
+#two unit vectors perpendicular to each heading and to each other
+def perpendiculars(headings):
+    #crossing with an axis far from parallel to the heading keeps the result well scaled
+    axis = np.where(np.abs(headings[:, 2:3]) < 0.9, np.array([0.0, 0.0, 1.0]), np.array([1.0, 0.0, 0.0]))
+    u = np.cross(axis, headings)
+    u /= np.linalg.norm(u, axis = 1, keepdims = True)
+    return u, np.cross(headings, u)
+
+#headings tilted by the polar angles towards the given azimuths around them.
+#the results are renormalised, so rounding errors don't build up over a walk
+def turned(headings, polar, azimuth):
+    u, v = perpendiculars(headings)
+    side = np.cos(azimuth)[:, None] * u + np.sin(azimuth)[:, None] * v
+    new = np.cos(polar)[:, None] * headings + np.sin(polar)[:, None] * side
+    return new / np.linalg.norm(new, axis = 1, keepdims = True)
+
+#headings turned by the guidance fields towards the guidance angle, at the
+#positions of the tips. strength optionally overrides the guidance strength field
+#with an array, and scale is the guidance strength scaler of the simulation
+def guided(headings, positions, guidance_angle, guidance_strength, scale, strength = None):
+    if strength is None:
+        if getattr(guidance_strength, "value", None) == 0:
+            return headings
+        strength = evaluate_field(guidance_strength, positions[:, 0], positions[:, 1])
+    target_angle = evaluate_field(guidance_angle, positions[:, 0], positions[:, 1])
+    target = np.column_stack([np.cos(target_angle), np.sin(target_angle), np.zeros(len(headings))])
+    #part of the target perpendicular to the heading, of length sin(angle between them)
+    across = target - np.einsum('ij,ij->i', target, headings)[:, None] * headings
+    sin_angle = np.linalg.norm(across, axis = 1)
+    turn = scale * strength * sin_angle
+    towards = across / np.where(sin_angle > 1e-12, sin_angle, 1)[:, None]
+    return np.cos(turn)[:, None] * headings + np.sin(turn)[:, None] * towards
@@ -0,0 +1,395 @@
+"""
+Containers for the data generated while a simulation is running
+
+The annihilating simulations need the full history of visited points as numpy
+arrays on every step. Growing those arrays with np.vstack / np.hstack copies the
+whole history on each append, so these containers over-allocate instead and
+double their capacity whenever they fill up, giving amortised O(1) appends.
+"""
+import math as maths
+import numpy as np
+
+from aux import Particle, exclusion_windows
+
+#copies the filled prefix of a column into a new column of the given capacity
+def resized(column, size, capacity):
+    new_column = np.empty((capacity,) + column.shape[1:], dtype = column.dtype)
+    new_column[:size] = column[:size]
+    return new_column
+
+"""
+1: Columnar buffer of every point visited so far
+"""
+class TrajectoryBuffer:
+    def __init__(self, capacity = 1024, dimension = 2):
+        self.size = 0
+        self.capacity = capacity
+        self._positions = np.empty((capacity, dimension))
+        self._index = np.empty(capacity, dtype=int)
+        self._iteration = np.empty(capacity, dtype=int)
+        self._angle = np.empty(capacity)
+        #row of the previous point of the same branch, -1 for the first point of a
+        #root, so that every row also describes the segment walked to reach it
+        self._previous = np.empty(capacity, dtype=int)
+
+    def __len__(self):
+        return self.size
+
+    #the filled prefix of each column, returned as views rather than copies
+    @property
+    def positions(self):
+        return self._positions[:self.size]
+
+    @property
+    def index(self):
+        return self._index[:self.size]
+
+    @property
+    def iteration(self):
+        return self._iteration[:self.size]
+
+    @property
+    def angle(self):
+        return self._angle[:self.size]
+
+    @property
+    def previous(self):
+        return self._previous[:self.size]
+
+    #start points of the segments ending at the given rows (an index array or
+    #slice), the point itself for rows with no previous point
+    def segment_starts(self, rows):
+        rows = np.arange(self.size)[rows]
+        previous = self._previous[rows]
+        return self._positions[np.where(previous >= 0, previous, rows)]
+
+    #adds one point, returning the row it was stored in
+    def append(self, position, walker_index, iteration, angle = 0.0, previous = -1):
+        row = self.size
+        if row == self.capacity:
+            self.grow()
+        #writing coordinates one at a time avoids converting the tuple to an array
+        positions = self._positions
+        for d, value in enumerate(position):
+            positions[row, d] = value
+        self._index[row] = walker_index
+        self._iteration[row] = iteration
+        self._angle[row] = angle
+        self._previous[row] = previous
+        self.size += 1
+        return row
+
+    #adds many points at once, returning the rows they were stored in
+    def extend(self, positions, walker_index, iteration, angle = 0.0, previous = -1):
+        n = len(walker_index)
+        while self.size + n > self.capacity:
+            self.grow()
+        rows = np.arange(self.size, self.size + n)
+        self._positions[rows] = positions
+        self._index[rows] = walker_index
+        self._iteration[rows] = iteration
+        self._angle[rows] = angle
+        self._previous[rows] = previous
+        self.size += n
+        return rows
+
+    #doubles the capacity of every column, keeping the filled prefix
+    def grow(self):
+        capacity = 2 * max(self.capacity, 1)
+        self.capacity = capacity
+        self._positions = resized(self._positions, self.size, capacity)
+        self._index = resized(self._index, self.size, capacity)
+        self._iteration = resized(self._iteration, self.size, capacity)
+        self._angle = resized(self._angle, self.size, capacity)
+        self._previous = resized(self._previous, self.size, capacity)
+
+"""
+2: Structure of arrays store for the walkers (branches) of a simulation
+
+Every branch owns one row of the typed columns x, y, angle, iteration (the
+current state of its tip), parent, sibling, branch_time and alive, plus the
+start_x, start_y, start_angle it was created with. Missing parents / siblings /
+branch times are stored as -1. The sample column says which replicate a branch
+belongs to, so that ensembles of independent walks can share one store. lineage_id and lineage_bound hold the exclusion
+windows of aux.exclusion_windows, computed once when the branch is created.
+tip_row is the row of the point log holding the branch's tip.
+
+Every point a branch moves to is logged in the TrajectoryBuffer self.points,
+which doubles as the annihilation history. Only root branches log their starting
+point, as a child starts on its parent's tip, which is already logged under the
+parent.
+
+to_dict() rebuilds the legacy walker_dict format on demand, so the output of the
+simulations can still be passed straight to WalkData. to_dicts() does the same
+for an ensemble, giving one walker_dict per sample with the branches renumbered
+from 0 within each sample
+"""
+class WalkerState:
+    def __init__(self, branching = True, branch_times = False, capacity = 64):
+        #flags deciding which optional keys the legacy dictionary has
+        self.branching = branching
+        self.branch_times = branch_times
+
+        self.size = 0
+        self.x = np.empty(capacity)
+        self.y = np.empty(capacity)
+        self.angle = np.empty(capacity)
+        self.iteration = np.empty(capacity, dtype=int)
+        self.parent = np.empty(capacity, dtype=int)
+        self.sibling = np.empty(capacity, dtype=int)
+        self.branch_time = np.empty(capacity, dtype=int)
+        self.alive = np.empty(capacity, dtype=bool)
+        self.sample = np.empty(capacity, dtype=int)
+        self.start_x = np.empty(capacity)
+        self.start_y = np.empty(capacity)
+        self.start_angle = np.empty(capacity)
+        self.lineage_id = np.empty((capacity, 4), dtype=int)
+        self.lineage_bound = np.empty((capacity, 4), dtype=int)
+        self.tip_row = np.empty(capacity, dtype=int)
+
+        self.points = TrajectoryBuffer()
+
+    def __len__(self):
+        return self.size
+
+    #ids of the branches still moving
+    def active(self):
+        return np.flatnonzero(self.alive[:self.size])
+
+    #adds a new branch with its tip at position, returning its id
+    def add_branch(self, position, angle, parent = -1, sibling = -1, branch_time = -1, sample = 0):
+        if self.size == len(self.alive):
+            self.grow()
+        i = self.size
+        self.x[i], self.y[i] = position
+        self.angle[i] = angle % (2*maths.pi)
+        self.iteration[i] = 0
+        self.parent[i] = parent
+        self.sibling[i] = sibling
+        self.branch_time[i] = branch_time
+        self.alive[i] = True
+        self.sample[i] = sample
+        self.start_x[i], self.start_y[i] = position
+        self.start_angle[i] = self.angle[i]
+        ids, bounds = self.exclusion_windows([parent], [sibling])
+        self.lineage_id[i], self.lineage_bound[i] = ids[0], bounds[0]
+        self.size += 1
+        if parent < 0:
+            self.tip_row[i] = self.points.append(position, i, 0, self.angle[i])
+        else:
+            self.tip_row[i] = self.tip_row[parent]
+        return i
+
+    #vectorised add_branch, returning the ids of the new branches
+    def add_branches(self, positions, angles, parents, siblings, branch_times = -1, samples = 0):
+        n = len(angles)
+        while self.size + n > len(self.alive):
+            self.grow()
+        ids = np.arange(self.size, self.size + n)
+        self.x[ids] = positions[:, 0]
+        self.y[ids] = positions[:, 1]
+        self.angle[ids] = np.mod(angles, 2*maths.pi)
+        self.iteration[ids] = 0
+        self.parent[ids] = parents
+        self.sibling[ids] = siblings
+        self.branch_time[ids] = branch_times
+        self.alive[ids] = True
+        self.sample[ids] = samples
+        self.start_x[ids] = positions[:, 0]
+        self.start_y[ids] = positions[:, 1]
+        self.start_angle[ids] = self.angle[ids]
+        self.lineage_id[ids], self.lineage_bound[ids] = self.exclusion_windows(self.parent[ids], self.sibling[ids])
+        self.size += n
+        roots = self.parent[ids] < 0
+        self.tip_row[ids[~roots]] = self.tip_row[self.parent[ids[~roots]]]
+        self.tip_row[ids[roots]] = self.points.extend(positions[roots], ids[roots], 0, self.angle[ids[roots]])
+        return ids
+
+    #moves the tip of branch i one step, logging the new point and returning its row
+    def advance(self, i, x, y, angle):
+        iteration = self.iteration.item(i) + 1
+        self.x[i] = x
+        self.y[i] = y
+        self.angle[i] = angle
+        self.iteration[i] = iteration
+        row = self.points.append((x, y), i, iteration, angle, self.tip_row.item(i))
+        self.tip_row[i] = row
+        return row
+
+    #vectorised advance, for an array of distinct branch ids
+    def advance_many(self, ids, x, y, angles):
+        self.x[ids] = x
+        self.y[ids] = y
+        self.angle[ids] = angles
+        self.iteration[ids] += 1
+        rows = self.points.extend(np.column_stack([x, y]), ids, self.iteration[ids], angles, self.tip_row[ids])
+        self.tip_row[ids] = rows
+        return rows
+
+    #moves the tips of the branches ids through whole segments of lengths[b] steps
+    #at once, given the points they visit concatenated branch by branch, in order.
+    #returns the rows the points were stored in
+    def advance_segments(self, ids, lengths, x, y, angles):
+        last = np.cumsum(lengths) - 1
+        owner = np.repeat(ids, lengths)
+        iterations = self.iteration[owner] + np.arange(len(owner)) - np.repeat(last - lengths, lengths)
+        self.x[ids] = x[last]
+        self.y[ids] = y[last]
+        self.angle[ids] = angles[last]
+        self.iteration[ids] += lengths
+        #within a segment each point follows the one before it
+        rows = self.points.extend(np.column_stack([x, y]), owner, iterations, angles)
+        previous = rows - 1
+        previous[last - lengths + 1] = self.tip_row[ids]
+        self.points._previous[rows] = previous
+        self.tip_row[ids] = rows[last]
+        return rows
+
+    #exclusion windows for new branches with the given parents and siblings
+    #whole columns are passed, so that the lookups of missing (-1) parents stay in bounds
+    def exclusion_windows(self, parents, siblings):
+        return exclusion_windows(parents, siblings, self.parent, self.sibling, self.iteration)
+
+    #start and end of the segment branch i walked to reach its tip, both the
+    #tip itself before its first step
+    def segment(self, i):
+        row = self.tip_row.item(i)
+        end = self.points._positions[row]
+        if self.iteration.item(i) == 0:
+            return end, end
+        return self.points._positions[self.points._previous[row]], end
+
+    #number of points logged by each branch, including its starting point
+    def lengths(self):
+        return self.iteration[:self.size] + 1
+
+    #per branch offset table: rows of the point log ordered by branch, such that
+    #branch b owns order[offsets[b]:offsets[b+1]], in the order they were visited
+    def branch_offsets(self):
+        order = np.argsort(self.points.index, kind = "stable")
+        counts = np.bincount(self.points.index, minlength = self.size)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return order, offsets
+
+    #names of the per branch columns, resized together by grow
+    COLUMNS = ["x", "y", "angle", "iteration", "parent", "sibling", "branch_time", "alive", "sample",
+               "start_x", "start_y", "start_angle", "lineage_id", "lineage_bound", "tip_row"]
+
+    def grow(self):
+        capacity = 2 * max(len(self.alive), 1)
+        for column in self.COLUMNS:
+            setattr(self, column, resized(getattr(self, column), self.size, capacity))
+
+    #positions of the tip and start of branch b, as tuples of floats
+    def tip_position(self, b):
+        return (float(self.x[b]), float(self.y[b]))
+
+    def start_position(self, b):
+        return (float(self.start_x[b]), float(self.start_y[b]))
+
+    #rebuilds the legacy dictionary of dictionaries used by WalkData
+    def to_dict(self):
+        return self.__walker_dict(range(self.size), *self.__trajectories())
+
+    #rebuilds one legacy dictionary per sample of an ensemble, as a list
+    def to_dicts(self, num_samples):
+        trajectories = self.__trajectories()
+        samples = self.sample[:self.size]
+        return [self.__walker_dict(np.flatnonzero(samples == s).tolist(), *trajectories)
+                for s in range(num_samples)]
+
+    #positions and angles of every logged point as lists ordered by branch,
+    #with the offsets giving each branch's slice of them
+    def __trajectories(self):
+        order, offsets = self.branch_offsets()
+        positions = self.points.positions[order]
+        positions = list(zip(*positions.T.tolist()))
+        angles = self.points.angle[order].tolist()
+        return positions, angles, offsets
+
+    #walker_dict of the given (increasing) branch ids, numbered from 0 in that order
+    def __walker_dict(self, branches, positions, angles, offsets):
+        local = {b: n for n, b in enumerate(branches)}
+        walker_dict = {}
+        for n, b in enumerate(branches):
+            first, last = offsets[b], offsets[b+1]
+            parent = int(self.parent[b])
+            branch_positions = positions[first:last]
+            branch_angles = angles[first:last]
+            #children did not log their starting point
+            if parent >= 0:
+                branch_positions.insert(0, self.start_position(b))
+                branch_angles.insert(0, float(self.start_angle[b]))
+
+            position = self.tip_position(b)
+            walker_dict[n] = {"walker" : Particle(position, float(self.angle[b]), int(self.iteration[b])),
+                              "dead" : not self.alive[b],
+                              "positions" : branch_positions,
+                              "angles" : branch_angles,
+                              "parent" : local[parent] if parent >= 0 else None}
+            if self.branching:
+                sibling = int(self.sibling[b])
+                walker_dict[n]["sibling"] = local[sibling] if sibling >= 0 else None
+            if self.branch_times:
+                walker_dict[n]["branch_time"] = int(self.branch_time[b])
+        return walker_dict
+
+"""
+3: Walker store for walks in three dimensions
+
+Adds the z and start_z columns, and the heading of every tip as a unit vector
+(heading and start_heading). The angle columns and the angles logged with every
+point hold the azimuth of the heading, its angle in the xy plane, so the angle
+graphs of Analysis still work; the rest of the heading can be read off the
+positions. Points are logged with three coordinates, and the walker_dict positions
+are (x, y, z) tuples. Branches are added and moved with arrays of positions and
+headings, rather than of coordinates and angles
+"""
+#azimuths in [0, 2pi) of an array of headings
+def azimuths(headings):
+    return np.mod(np.arctan2(headings[:, 1], headings[:, 0]), 2*maths.pi)
+
+class WalkerState3D(WalkerState):
+    COLUMNS = WalkerState.COLUMNS + ["z", "start_z", "heading", "start_heading"]
+
+    def __init__(self, branching = True, branch_times = False, capacity = 64):
+        super().__init__(branching, branch_times, capacity)
+        self.z = np.empty(capacity)
+        self.start_z = np.empty(capacity)
+        self.heading = np.empty((capacity, 3))
+        self.start_heading = np.empty((capacity, 3))
+        self.points = TrajectoryBuffer(dimension = 3)
+
+    #adds a new branch with its tip at position (x, y, z), facing the unit vector heading
+    def add_branch(self, position, heading, parent = -1, sibling = -1, branch_time = -1, sample = 0):
+        ids = self.add_branches(np.array([position], dtype = float), np.array([heading], dtype = float),
+                                parent, sibling, branch_time, sample)
+        return int(ids[0])
+
+    #positions and headings are (n, 3) arrays
+    def add_branches(self, positions, headings, parents, siblings, branch_times = -1, samples = 0):
+        ids = super().add_branches(positions, azimuths(headings), parents, siblings, branch_times, samples)
+        self.z[ids] = positions[:, 2]
+        self.start_z[ids] = positions[:, 2]
+        self.heading[ids] = headings
+        self.start_heading[ids] = headings
+        return ids
+
+    #moves the tips of an array of distinct branch ids to positions, now facing headings
+    def advance_many(self, ids, positions, headings):
+        angles = azimuths(headings)
+        self.x[ids] = positions[:, 0]
+        self.y[ids] = positions[:, 1]
+        self.z[ids] = positions[:, 2]
+        self.angle[ids] = angles
+        self.heading[ids] = headings
+        self.iteration[ids] += 1
+        rows = self.points.extend(positions, ids, self.iteration[ids], angles, self.tip_row[ids])
+        self.tip_row[ids] = rows
+        return rows
+
+    def tip_position(self, b):
+        return (float(self.x[b]), float(self.y[b]), float(self.z[b]))
+
+    def start_position(self, b):
+        return (float(self.start_x[b]), float(self.start_y[b]), float(self.start_z[b]))
@@ -5,7 +5,7 @@ from time import time
 t0 = time()
 import math as maths
 
-from aux import swirl, polygon, angle, sample, vonmis
+from aux import swirl, polygon, angle, sample, run_ensemble, vonmis
 from rw import RandomWalk
 from barw import BranchingRandomWalk
 from analysis import WalkData, Analysis
@@ -29,7 +29,7 @@ BRW = BranchingRandomWalk(
     guidance_angle= maths.pi
 )
 
-#sim_data = sample(200, BRW.get_barw, 150, 1.5, initial_angle = maths.pi)
+#sim_data = run_ensemble(200, BRW.get_barw, 150, 1.5, initial_angle = maths.pi, seed = 0)
 #sim_data = sample(30, RW.get_rw, 150)
 #data = WalkData(sim_data)
 #data.save("BARW-pb-0.1")